@@ -0,0 +1,60 @@
+import sys
+import os.path as path
+
+main_directory = path.dirname(path.dirname(path.realpath(__file__)))
+tools_directory = path.join(main_directory, "tools")
+sys.path.append(main_directory)
+sys.path.append(tools_directory)
+
+from operation import Operation
+Operation.discover(path.join(tools_directory, "operations"), "tools.operations")
+
+import os
+import json
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import config as datasets_config
+
+class Workspace:
+    """Sources, recipes and build output of a test, in a temporary directory."""
+
+    def __init__(self, directory: str):
+        self.sources_directory = path.join(directory, "sources")
+        self.recipes_directory = path.join(directory, "recipes")
+        self.output_directory = path.join(directory, "built")
+        os.makedirs(self.sources_directory)
+        os.makedirs(self.recipes_directory)
+
+    def write_parquet(self, source_name: str, file_name: str, rows: dict[str, list]) -> str:
+        """Write a parquet file to the directory of a source, creating the source if needed."""
+        directory = path.join(self.sources_directory, source_name)
+        os.makedirs(directory, exist_ok=True)
+        json_path = path.join(self.sources_directory, source_name + ".json")
+        if not path.isfile(json_path):
+            with open(json_path, "w") as f:
+                json.dump({ "source_type": "parquet", "source_path": f"./{source_name}" }, f)
+        file_path = path.join(directory, file_name)
+        pq.write_table(pa.table(rows), file_path)
+        return file_path
+
+    def write_recipe(self, recipe_name: str, recipe: dict):
+        with open(path.join(self.recipes_directory, recipe_name + ".json"), "w") as f:
+            json.dump(recipe, f)
+
+    def builder(self, **options):
+        from recipe_builder import RecipeBuilder, BuildOptions
+        from warm_cache import warm_cache
+        # Start every build like a new run of the CLI, with nothing loaded yet
+        RecipeBuilder.recipe_cache.clear()
+        RecipeBuilder.source_cache.clear()
+        warm_cache.invalidate(lambda key: True)
+        return RecipeBuilder(self.sources_directory, self.recipes_directory, self.output_directory, BuildOptions(**options))
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    from warm_cache import warm_cache
+    monkeypatch.setattr(datasets_config, "HF_DATASETS_CACHE", str(tmp_path / "hf_cache"))
+    warm_cache.invalidate(lambda key: True)
+    yield Workspace(str(tmp_path))
+    warm_cache.invalidate(lambda key: True)
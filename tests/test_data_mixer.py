@@ -0,0 +1,61 @@
+import numpy as np
+from datasets import Dataset, config as datasets_config
+from data_mixer import mixture_counts, mixture_schedule, mix_datasets
+
+def counts(lengths, probabilities, epochs=None, total_rows=None, stopping_strategy="first_exhausted"):
+    epochs = epochs if epochs is not None else [ 1 ] * len(lengths)
+    return mixture_counts(np.array(lengths, dtype=np.int64), np.array(probabilities, dtype=np.float64),
+                          np.array(epochs, dtype=np.float64), total_rows, stopping_strategy).tolist()
+
+def test_first_exhausted_stops_with_the_first_source():
+    # 100 rows at 50% means 200 rows in total
+    assert counts([ 100, 1000 ], [ 0.5, 0.5 ]) == [ 100, 100 ]
+    assert counts([ 100, 1000 ], [ 0.25, 0.75 ]) == [ 100, 300 ]
+
+def test_all_exhausted_upsamples_the_other_sources():
+    assert counts([ 100, 1000 ], [ 0.5, 0.5 ], stopping_strategy="all_exhausted") == [ 1000, 1000 ]
+
+def test_largest_remainder():
+    # 10 rows split three ways can't be exact, the largest remainders get the extra rows
+    assert counts([ 100, 100, 100 ], [ 1, 1, 1 ], total_rows=10) == [ 4, 3, 3 ]
+    assert counts([ 100, 100, 100 ], [ 0.5, 0.3, 0.2 ], total_rows=7) == [ 4, 2, 1 ]
+    assert sum(counts([ 1000, 1000, 1000 ], [ 0.37, 0.21, 0.42 ], total_rows=999)) == 999
+
+def test_probabilities_are_relative():
+    assert counts([ 100, 100 ], [ 3, 1 ], total_rows=40) == [ 30, 10 ]
+
+def test_epochs():
+    # Each source provides lengths * epochs rows before it's exhausted
+    assert counts([ 100, 1000 ], [ 0.5, 0.5 ], epochs=[ 2, 1 ]) == [ 200, 200 ]
+    assert counts([ 100, 1000 ], [ 0.5, 0.5 ], epochs=[ 0.5, 1 ]) == [ 50, 50 ]
+
+def test_total_rows_is_capped_by_first_exhausted():
+    assert counts([ 10, 1000 ], [ 0.5, 0.5 ], total_rows=100) == [ 10, 50 ]
+    assert counts([ 10, 1000 ], [ 0.5, 0.5 ], total_rows=100, stopping_strategy="all_exhausted") == [ 50, 50 ]
+
+def test_schedule_reads_every_source_in_order():
+    sources, rows = mixture_schedule(np.array([ 5, 3 ]), np.array([ 3, 10 ]), seed=0)
+    assert len(sources) == 8
+    assert sorted(sources.tolist()) == [ 0, 0, 0, 0, 0, 1, 1, 1 ]
+    # Sources go back to their first row once exhausted
+    assert rows[sources == 0].tolist() == [ 0, 1, 2, 0, 1 ]
+    assert rows[sources == 1].tolist() == [ 0, 1, 2 ]
+
+def test_schedule_is_deterministic():
+    first = mixture_schedule(np.array([ 50, 70 ]), np.array([ 100, 100 ]), seed=3)
+    second = mixture_schedule(np.array([ 50, 70 ]), np.array([ 100, 100 ]), seed=3)
+    other = mixture_schedule(np.array([ 50, 70 ]), np.array([ 100, 100 ]), seed=4)
+    assert (first[0] == second[0]).all() and (first[1] == second[1]).all()
+    assert not (first[0] == other[0]).all()
+
+def test_mix_datasets(tmp_path, monkeypatch):
+    monkeypatch.setattr(datasets_config, "HF_DATASETS_CACHE", str(tmp_path))
+    a = Dataset.from_dict({ "x": list(range(100)) })
+    b = Dataset.from_dict({ "x": list(range(100, 130)), "y": [ "b" ] * 30 })
+    mixed = mix_datasets([ a, b ], [ "a", "b" ], [ 0.75, 0.25 ], [ 1, 1 ], 0, "test-mix-datasets", source_column="source")
+    assert len(mixed) == 120
+    assert mixed.cache_files[0]["filename"].startswith(str(tmp_path))
+    assert mixed["source"].count("a") == 90 and mixed["source"].count("b") == 30
+    assert sorted(x for x, source in zip(mixed["x"], mixed["source"]) if source == "b") == list(range(100, 130))
+    # Columns missing from a source are filled with nulls
+    assert all(y is None for y, source in zip(mixed["y"], mixed["source"]) if source == "a")
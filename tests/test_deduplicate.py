@@ -0,0 +1,49 @@
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+import tools.operations.deduplicate as deduplicate
+from operation import Operation
+
+def test_empty_dataset():
+    dataset = Dataset.from_dict({ "text": [ "a", "b" ] }).select([ ])
+    output = Operation.create("deduplicate")(dataset, columns=[ "text" ])
+    assert len(output) == 0
+    assert output.column_names == [ "text" ]
+
+def test_find_duplicates_without_rows():
+    deduplicate.shared_keys = pa.table({ "key": pa.array([ ], pa.uint64()) })
+    try:
+        duplicates, first_rows = deduplicate.find_duplicates(([ "key" ], 0, 1))
+    finally:
+        deduplicate.shared_keys = None
+    assert len(duplicates) == 0 and len(first_rows) == 0
+
+def test_exact_duplicates():
+    dataset = Dataset.from_dict({ "text": [ "a", "b", "a", "c", "b", "a" ], "id": list(range(6)) })
+    output = Operation.create("deduplicate")(dataset, columns=[ "text" ], num_shards=4)
+    assert output["id"] == [ 0, 1, 3 ]
+
+def test_exact_duplicates_of_several_columns():
+    dataset = Dataset.from_dict({ "text": [ "a", "a", "a" ], "label": [ 1, 2, 1 ], "id": [ 0, 1, 2 ] })
+    output = Operation.create("deduplicate")(dataset, columns=[ "text", "label" ])
+    assert output["id"] == [ 0, 1 ]
+
+def test_minhash_near_duplicates():
+    generator = np.random.default_rng(0)
+    words = [ f"word{i}" for i in range(1000) ]
+    documents = [ " ".join(generator.choice(words, 200)) for _ in range(20) ]
+    # One word changed out of 200 is a near duplicate, a whole new text isn't
+    near_duplicate = documents[3].split()
+    near_duplicate[100] = "changed"
+    texts = documents + [ " ".join(near_duplicate) ]
+    dataset = Dataset.from_dict({ "text": texts, "id": list(range(len(texts))) })
+    output = Operation.create("deduplicate")(dataset, columns=[ "text" ], method="minhash", num_perm=128, bands=32, ngram=3)
+    assert output["id"] == list(range(20))
+
+def test_report_column_counts(capsys):
+    dataset = Dataset.from_dict({ "text": [ "a", "a", "b", "a", "b", "c" ], "source": [ "x", "y", "x", "y", "y", "x" ] })
+    output = Operation.create("deduplicate")(dataset, columns=[ "text" ], report_column="source")
+    assert len(output) == 3
+    lines = [ line.split() for line in capsys.readouterr().out.splitlines() if "rows removed" in line ]
+    counts = { line[-4]: int(line[-3]) for line in lines }
+    assert counts == { "y": 3 }
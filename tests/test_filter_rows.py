@@ -0,0 +1,63 @@
+import pytest
+import pyarrow as pa
+from datasets import Dataset
+from operation import Operation
+from tools.operations.filter_rows import compile_condition, condition_columns
+
+table = pa.table({
+    "id": [ 0, 1, 2, 3, 4, 5 ],
+    "text": [ "apple", "Banana", "cherry pie", None, "date", "elderberry" ],
+    "score": [ 0.1, 0.9, 0.5, 0.7, None, 0.3 ],
+    "tokens": [ [ 1 ], [ 1, 2 ], [ 1, 2, 3 ], [ ], [ 1, 2 ], None ]
+})
+
+def kept(condition: dict) -> list[int]:
+    return table.filter(compile_condition(condition))["id"].to_pylist()
+
+def test_comparisons():
+    assert kept({ "column": "score", "op": ">", "value": 0.5 }) == [ 1, 3 ]
+    assert kept({ "column": "score", "op": "<=", "value": 0.5 }) == [ 0, 2, 5 ]
+    assert kept({ "column": "id", "op": "==", "value": 2 }) == [ 2 ]
+    assert kept({ "column": "id", "op": "!=", "value": 2 }) == [ 0, 1, 3, 4, 5 ]
+    assert kept({ "column": "id", "op": "in", "value": [ 1, 4, 7 ] }) == [ 1, 4 ]
+
+def test_lengths():
+    assert kept({ "length": "text", "op": ">=", "value": 6 }) == [ 1, 2, 5 ]
+    assert kept({ "list_length": "tokens", "op": "==", "value": 2 }) == [ 1, 4 ]
+
+def test_is_null_and_regex():
+    assert kept({ "is_null": "text" }) == [ 3 ]
+    assert kept({ "regex": "text", "pattern": "^[a-c]" }) == [ 0, 2 ]
+    assert kept({ "regex": "text", "pattern": "^[a-c]", "ignore_case": True }) == [ 0, 1, 2 ]
+
+def test_and_or_not():
+    high = { "column": "score", "op": ">=", "value": 0.5 }
+    short = { "length": "text", "op": "<", "value": 6 }
+    assert kept({ "and": [ high, { "not": short } ] }) == [ 1, 2 ]
+    assert kept({ "or": [ high, short ] }) == [ 0, 1, 2, 3, 4 ]
+    assert kept({ "not": { "is_null": "score" } }) == [ 0, 1, 2, 3, 5 ]
+    assert kept({ "and": [ { "or": [ high, short ] }, { "column": "id", "op": "<", "value": 3 } ] }) == [ 0, 1, 2 ]
+
+def test_invalid_conditions():
+    with pytest.raises(ValueError):
+        compile_condition({ "and": [ ] })
+    with pytest.raises(ValueError):
+        compile_condition({ "column": "id", "op": "~", "value": 1 })
+    with pytest.raises(ValueError):
+        compile_condition({ "value": 1 })
+
+def test_condition_columns():
+    assert condition_columns({ "and": [
+        { "column": "id", "op": ">", "value": 0 },
+        { "not": { "or": [ { "regex": "text", "pattern": "a" }, { "is_null": "score" } ] } },
+        { "list_length": "tokens", "op": ">", "value": 1 }
+    ] }) == { "id", "text", "score", "tokens" }
+
+def test_streaming_matches_batch():
+    dataset = Dataset(table)
+    where = { "or": [ { "and": [ { "column": "score", "op": ">", "value": 0.2 }, { "not": { "is_null": "text" } } ] },
+                      { "list_length": "tokens", "op": "==", "value": 2 } ] }
+    batch = Operation.create("filter")(dataset, where=where)
+    streamed = Operation.create("filter")(dataset.to_iterable_dataset(), where=where, batch_size=4)
+    assert batch["id"] == [ 1, 2, 4, 5 ]
+    assert [ row["id"] for row in streamed ] == batch["id"]
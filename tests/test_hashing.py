@@ -0,0 +1,24 @@
+import pyarrow as pa
+from hashing import hash_array, hash_columns, assign_splits, hash_key
+
+def test_struct_columns():
+    table = pa.table({
+        "id": [ 0, 1, 2, 3 ],
+        "meta": pa.array([ { "a": 1, "b": "x" }, { "a": 1, "b": "y" }, None, { "a": 1, "b": "x" } ]),
+        "chat": pa.array([ [ { "role": "user", "content": "hi" } ], [ { "role": "assistant", "content": "hi" } ], None, [ ] ]),
+    })
+    assert len(assign_splits(table, [ 0.9, 0.1 ])) == len(table)
+
+    hashes = hash_array(table["meta"], hash_key(0, "high"))
+    assert hashes[0] == hashes[3]
+    assert len({ int(hashes[0]), int(hashes[1]), int(hashes[2]) }) == 3
+
+    chat_hashes = hash_array(table["chat"], hash_key(0, "high"))
+    assert chat_hashes[0] != chat_hashes[1]
+
+def test_struct_hashes_are_stable_across_batches():
+    table = pa.table({ "meta": pa.array([ { "a": i, "b": str(i) } for i in range(100) ]) })
+    high, low = hash_columns(table, [ "meta" ])
+    sliced_high, sliced_low = hash_columns(table.slice(50), [ "meta" ])
+    assert (high[50:] == sliced_high).all()
+    assert (low[50:] == sliced_low).all()
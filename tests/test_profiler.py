@@ -0,0 +1,22 @@
+import threading
+from profiler import BuildProfiler
+
+def test_sampler_stops_after_the_last_stage():
+    threads = threading.active_count()
+    profiler = BuildProfiler(enabled=True)
+    profiler.begin_recipe("recipe")
+    with profiler.stage("outer", "load"):
+        with profiler.stage("inner", "operation"):
+            assert profiler.sampler is not None
+        assert profiler.sampler is not None
+    assert profiler.sampler is None
+    assert threading.active_count() == threads
+    stages = { stage["stage"]: stage for stage in profiler.stages }
+    assert stages.keys() == { "outer", "inner" }
+    assert stages["outer"]["peak_rss"] is None or stages["outer"]["peak_rss"] > 0
+
+def test_disabled_profiler_starts_no_sampler():
+    profiler = BuildProfiler()
+    with profiler.stage("stage", "load"):
+        assert profiler.sampler is None
+    assert profiler.stages == [ ]
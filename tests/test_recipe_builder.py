@@ -0,0 +1,85 @@
+import re
+import json
+import pytest
+import os.path as path
+from shard_writer import load_output
+
+def rows(start: int, count: int) -> dict[str, list]:
+    return { "id": list(range(start, start + count)), "text": [ f"row {i}" for i in range(start, start + count) ] }
+
+def read_index(directory: str) -> dict:
+    with open(path.join(directory, "shards.json"), "rb") as f:
+        return json.loads(f.read())
+
+def test_new_files_are_appended(workspace):
+    workspace.write_parquet("source", "part0.parquet", rows(0, 100))
+    workspace.write_recipe("recipe", { "sources": [ "source" ] })
+    recipe = workspace.builder().build("recipe")
+    assert len(recipe.built_dataset) == 100
+    shards = read_index(recipe.built_directory)["shards"]
+
+    workspace.write_parquet("source", "part1.parquet", rows(100, 50))
+    builder = workspace.builder()
+    new_files = builder.appendable_files(builder.get_recipe("recipe"))
+    assert [ path.basename(file) for file in new_files["source"] ] == [ "part1.parquet" ]
+    recipe = builder.build("recipe")
+
+    # The shards of the first build are kept as they were and the new rows follow them
+    index = read_index(recipe.built_directory)
+    assert index["num_rows"] == 150
+    assert index["shards"][:len(shards)] == shards
+    appended = index["shards"][len(shards):]
+    assert len(appended) > 0
+    assert appended[0]["offset"] == 100
+    assert sum(shard["num_rows"] for shard in appended) == 50
+    for shard in index["shards"]:
+        assert path.isfile(path.join(recipe.built_directory, shard["filename"]))
+    assert sorted(load_output(recipe.built_directory)["id"]) == list(range(150))
+
+    # Appending leaves the recipe up to date
+    builder = workspace.builder()
+    assert builder.is_up_to_date(builder.get_recipe("recipe"))
+
+def test_changed_file_rebuilds(workspace):
+    workspace.write_parquet("source", "part0.parquet", rows(0, 100))
+    workspace.write_recipe("recipe", { "sources": [ "source" ] })
+    workspace.builder().build("recipe")
+
+    workspace.write_parquet("source", "part0.parquet", rows(0, 80))
+    workspace.write_parquet("source", "part1.parquet", rows(100, 50))
+    builder = workspace.builder()
+    assert builder.appendable_files(builder.get_recipe("recipe")) is None
+    recipe = builder.build("recipe")
+
+    # Nothing of the first build is left in the output
+    index = read_index(recipe.built_directory)
+    assert index["num_rows"] == 130
+    assert all(re.fullmatch(r"data-\d{5}-of-\d{5}\.arrow", shard["filename"]) for shard in index["shards"])
+    assert sorted(load_output(recipe.built_directory)["id"]) == list(range(80)) + list(range(100, 150))
+
+def test_circular_dependencies(workspace):
+    workspace.write_recipe("a", { "sources": { "b": { "type": "recipe" } } })
+    workspace.write_recipe("b", { "sources": { "a": { "type": "recipe" } } })
+    with pytest.raises(RecursionError, match="a -> b -> a"):
+        workspace.builder().resolve_dependencies("a")
+
+def test_diamond_dependencies(workspace, capsys):
+    workspace.write_parquet("source", "part0.parquet", rows(0, 100))
+    workspace.write_recipe("base", { "sources": [ "source" ] })
+    workspace.write_recipe("left", { "sources": { "base": { "type": "recipe" } } })
+    workspace.write_recipe("right", { "sources": { "base": { "type": "recipe" } } })
+    workspace.write_recipe("top", { "sources": { "left": { "type": "recipe" }, "right": { "type": "recipe" } } })
+
+    builder = workspace.builder()
+    graph = builder.resolve_dependencies("top")
+    assert graph == { "base": [ ], "left": [ "base" ], "right": [ "base" ], "top": [ "left", "right" ] }
+    order = list(graph)
+    assert order.index("base") < order.index("left") < order.index("top")
+    assert order.index("base") < order.index("right") < order.index("top")
+
+    # The shared dependency is only built once
+    recipe = builder.build("top")
+    output = capsys.readouterr().out
+    for name in ("base", "left", "right", "top"):
+        assert output.count(f"Building recipe '{name}'") == 1
+    assert len(recipe.built_dataset) == 200
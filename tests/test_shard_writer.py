@@ -0,0 +1,105 @@
+import json
+import pytest
+import os.path as path
+import pyarrow as pa
+from datasets import Dataset
+from data_recipe import DataRecipeOutputConfig
+from shard_writer import ShardWriter, write_dataset, load_output, output_files, json_lines
+
+formats = [ "arrow", "parquet", "jsonl" ]
+
+def sample(num_rows: int) -> Dataset:
+    return Dataset.from_dict({
+        "id": list(range(num_rows)),
+        "text": [ f"row {i} " + "x" * (i % 17) for i in range(num_rows) ],
+        "score": [ i / 7 if i % 5 else None for i in range(num_rows) ],
+        "tokens": [ list(range(i % 4)) for i in range(num_rows) ]
+    })
+
+def read_index(directory: str) -> dict:
+    with open(path.join(directory, "shards.json"), "rb") as f:
+        return json.loads(f.read())
+
+def check_index(directory: str, num_rows: int):
+    index = read_index(directory)
+    assert index["num_rows"] == num_rows
+    offset = 0
+    for shard in index["shards"]:
+        assert shard["offset"] == offset
+        assert shard["num_bytes"] == path.getsize(path.join(directory, shard["filename"]))
+        offset += shard["num_rows"]
+    assert offset == num_rows
+    return index
+
+@pytest.mark.parametrize("format", formats)
+def test_write_dataset_round_trip(tmp_path, format):
+    dataset = sample(1000)
+    output = DataRecipeOutputConfig(format=format, row_group_size=100)
+    assert write_dataset(dataset, str(tmp_path), output) == 1000
+    check_index(str(tmp_path), 1000)
+    loaded = load_output(str(tmp_path))
+    assert loaded.features == dataset.features
+    assert loaded.to_list() == dataset.to_list()
+
+@pytest.mark.parametrize("format", formats)
+def test_shard_writer_round_trip(tmp_path, format):
+    dataset = sample(1000)
+    writer = ShardWriter(str(tmp_path), 300, dataset.features, output=DataRecipeOutputConfig(format=format, row_group_size=100))
+    for table in dataset.with_format("arrow").iter(batch_size=128):
+        writer.write(table)
+    assert writer.close() == 1000
+    index = check_index(str(tmp_path), 1000)
+    assert [ shard["num_rows"] for shard in index["shards"] ] == [ 300, 300, 300, 100 ]
+    assert len(output_files(str(tmp_path))) == 4
+    assert load_output(str(tmp_path)).to_list() == dataset.to_list()
+
+@pytest.mark.parametrize("format", formats)
+def test_shard_writer_append(tmp_path, format):
+    dataset = sample(500)
+    output = DataRecipeOutputConfig(format=format)
+    writer = ShardWriter(str(tmp_path), 1000, dataset.features, output=output)
+    writer.write(dataset.data.table.slice(0, 300))
+    writer.close()
+    writer = ShardWriter(str(tmp_path), 1000, dataset.features, prefix="data-appended", append=True, output=output)
+    writer.write(dataset.data.table.slice(300))
+    writer.close()
+    index = check_index(str(tmp_path), 500)
+    assert [ shard["offset"] for shard in index["shards"] ] == [ 0, 300 ]
+    assert load_output(str(tmp_path)).to_list() == dataset.to_list()
+
+def test_write_dataset_splits_at_max_shard_size(tmp_path):
+    dataset = sample(1000)
+    max_shard_size = dataset.data.nbytes // 4 + 1
+    write_dataset(dataset, str(tmp_path), DataRecipeOutputConfig(max_shard_size=max_shard_size))
+    index = check_index(str(tmp_path), 1000)
+    assert len(index["shards"]) == 4
+    assert [ shard["filename"] for shard in index["shards"] ] == [ f"data-{i:05d}-of-00004.arrow" for i in range(4) ]
+    assert load_output(str(tmp_path))["id"] == list(range(1000))
+
+def test_shard_writer_splits_at_max_shard_size(tmp_path):
+    dataset = sample(1000)
+    max_shard_size = dataset.data.nbytes // 4
+    writer = ShardWriter(str(tmp_path), 1_000_000, dataset.features, output=DataRecipeOutputConfig(max_shard_size=max_shard_size))
+    tables = [ pa.Table.from_batches([ batch ]) for batch in dataset.data.table.to_batches(max_chunksize=50) ]
+    for table in tables:
+        writer.write(table)
+    writer.close()
+    index = check_index(str(tmp_path), 1000)
+    assert len(index["shards"]) > 1
+    # Shards are closed by the first table that takes them to max_shard_size
+    for shard in index["shards"][:-1]:
+        shard_tables = tables[shard["offset"] // 50:(shard["offset"] + shard["num_rows"]) // 50]
+        sizes = [ table.nbytes for table in shard_tables ]
+        assert sum(sizes) >= max_shard_size > sum(sizes[:-1])
+    assert load_output(str(tmp_path))["id"] == list(range(1000))
+
+def test_empty_output_is_loadable(tmp_path):
+    dataset = sample(0)
+    writer = ShardWriter(str(tmp_path), 100, dataset.features)
+    assert writer.close() == 0
+    check_index(str(tmp_path), 0)
+    assert len(load_output(str(tmp_path))) == 0
+
+def test_json_lines():
+    table = pa.table({ "id": [ 1, 2 ], "score": [ float("nan"), 0.1 + 0.2 ] })
+    assert [ json.loads(line) for line in json_lines(table) ] == [ { "id": 1, "score": None }, { "id": 2, "score": 0.1 + 0.2 } ]
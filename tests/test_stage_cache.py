@@ -0,0 +1,72 @@
+import os
+import json
+import os.path as path
+from datasets import Dataset
+from stage_cache import StageCache, fingerprint
+
+def stored_size(cache: StageCache, key: str) -> int:
+    with open(path.join(cache.entry_directory(key), "stage.json"), "rb") as f:
+        return json.loads(f.read())["size"]
+
+def test_store_and_load(tmp_path):
+    cache = StageCache(str(tmp_path), 1024**3)
+    key = fingerprint("stage", 0)
+    assert cache.load(key) is None
+    cache.store(key, Dataset.from_dict({ "id": [ 1, 2, 3 ] }), "stage")
+    assert cache.load(key)["id"] == [ 1, 2, 3 ]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_disabled_cache(tmp_path):
+    cache = StageCache(str(tmp_path / "stages"), 0)
+    key = fingerprint("stage", 0)
+    cache.store(key, Dataset.from_dict({ "id": [ 1 ] }), "stage")
+    assert not cache.contains(key)
+    assert not path.exists(tmp_path / "stages")
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = StageCache(str(tmp_path), 1024**3)
+    keys = [ fingerprint("stage", i) for i in range(4) ]
+    for i, key in enumerate(keys):
+        cache.store(key, Dataset.from_dict({ "id": list(range(100)) }), f"stage {i}")
+    # Use times in the order 2, 0, 3, 1
+    for key, used in zip(keys, [ 200, 400, 100, 300 ]):
+        os.utime(path.join(cache.entry_directory(key), "stage.json"), (used, used))
+
+    # A later build with room for two entries, which used the least recent one itself
+    cache = StageCache(str(tmp_path), stored_size(cache, keys[0]) * 2)
+    cache.used.add(keys[2])
+    cache.evict()
+    assert [ cache.contains(key) for key in keys ] == [ False, True, True, False ]
+
+def test_load_marks_entry_as_recently_used(tmp_path):
+    cache = StageCache(str(tmp_path), 1024**3)
+    keys = [ fingerprint("stage", i) for i in range(2) ]
+    for i, key in enumerate(keys):
+        cache.store(key, Dataset.from_dict({ "id": list(range(100)) }), f"stage {i}")
+        os.utime(path.join(cache.entry_directory(key), "stage.json"), (100 + i, 100 + i))
+
+    cache = StageCache(str(tmp_path), stored_size(cache, keys[0]))
+    cache.load(keys[0])
+    cache.used.clear()
+    cache.evict()
+    assert [ cache.contains(key) for key in keys ] == [ True, False ]
+
+def test_unchanged_prefix_is_reused(workspace, capsys):
+    workspace.write_parquet("source", "part0.parquet", { "id": list(range(100)), "text": [ f"row {i % 50}" for i in range(100) ] })
+    def write_recipe(minimum: int):
+        workspace.write_recipe("recipe", { "sources": { "source": { "operations": [
+            { "name": "deduplicate", "args": { "columns": [ "text" ] } },
+            { "name": "filter", "args": { "where": { "column": "id", "op": ">=", "value": minimum } } }
+        ] } } })
+    write_recipe(10)
+    recipe = workspace.builder().build("recipe")
+    assert sorted(recipe.built_dataset["id"]) == list(range(10, 50))
+    capsys.readouterr()
+
+    # Only the filter changed, so deduplicate's output comes from the stage cache
+    write_recipe(20)
+    builder = workspace.builder()
+    recipe = builder.build("recipe")
+    assert "Reusing cached output of 'deduplicate'" in capsys.readouterr().out
+    assert builder.stage_cache.hits == 1
+    assert sorted(recipe.built_dataset["id"]) == list(range(20, 50))
@@ -0,0 +1,49 @@
+import pytest
+from datasets import Dataset
+from operation import Operation
+
+@pytest.fixture(scope="module")
+def tokenizer_directory(tmp_path_factory):
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import WhitespaceSplit
+    from transformers import BertConfig, PreTrainedTokenizerFast
+    directory = str(tmp_path_factory.mktemp("tokenizer"))
+    vocabulary = [ "[PAD]", "[UNK]", "[SEP]" ] + [ f"word{i}" for i in range(100) ]
+    tokenizer = Tokenizer(WordLevel({ token: i for i, token in enumerate(vocabulary) }, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = WhitespaceSplit()
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]", sep_token="[SEP]").save_pretrained(directory)
+    BertConfig(vocab_size=len(vocabulary), max_position_embeddings=64).save_pretrained(directory)
+    return directory
+
+def documents(num_rows: int) -> Dataset:
+    return Dataset.from_dict({ "text": [ " ".join(f"word{(i + j) % 100}" for j in range(i % 37 + 1)) for i in range(num_rows) ], "id": list(range(num_rows)) })
+
+def test_packed_blocks_have_max_sequence_length(tokenizer_directory):
+    dataset = documents(3000)
+    packed = Operation.create("tokenize_text")(dataset, model=tokenizer_directory, text_column="text", max_sequence_length=32, packing=True)
+    assert packed.column_names == [ "input_ids", "attention_mask" ]
+    assert all(len(block) == 32 for block in packed["input_ids"])
+    assert all(len(mask) == 32 for mask in packed["attention_mask"])
+    # Every token of the documents is kept in order, except for the last partial block
+    total_tokens = sum(len(text.split()) + 1 for text in dataset["text"])
+    assert len(packed) == total_tokens // 32
+    assert packed["input_ids"][0][:2] == [ 3, 2 ]
+
+def test_streamed_packed_blocks_have_max_sequence_length(tokenizer_directory):
+    dataset = documents(3000)
+    packed = Operation.create("tokenize_text")(dataset.to_iterable_dataset(num_shards=4), model=tokenizer_directory, text_column="text",
+                                               max_sequence_length=32, packing=True)
+    blocks = [ row["input_ids"] for row in packed ]
+    expected = Operation.create("tokenize_text")(dataset, model=tokenizer_directory, text_column="text", max_sequence_length=32, packing=True)
+    assert blocks == expected["input_ids"]
+
+def test_unknown_separator_token(tokenizer_directory):
+    with pytest.raises(ValueError, match="\\[MISSING\\]"):
+        Operation.create("tokenize_text")(documents(10), model=tokenizer_directory, text_column="text", max_sequence_length=32,
+                                          packing=True, separator_token="[MISSING]")
+
+def test_separator_token(tokenizer_directory):
+    packed = Operation.create("tokenize_text")(documents(10), model=tokenizer_directory, text_column="text", max_sequence_length=4,
+                                               packing=True, separator_token="[PAD]")
+    assert packed["input_ids"][0][:2] == [ 3, 0 ]
@@ -1,4 +1,14 @@
 from .common import *
 from .data_source import *
 from .data_recipe import *
-from .recipe_builder import *
\ No newline at end of file
+from .stage_cache import *
+from .warm_cache import *
+from .shard_writer import *
+from .data_mixer import *
+from .hashing import *
+from .profiler import *
+from .recipe_builder import *
+from .build_client import *
+from .build_server import *
+from .build_planner import *
+from .benchmark import *
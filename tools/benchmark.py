@@ -0,0 +1,299 @@
+import os
+import os.path as path
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass, asdict, field
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import time
+from typing import Optional
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+import datasets
+from recipe_builder import *
+from profiler import *
+from stage_cache import directory_size
+from common import *
+
+@dataclass
+class BenchmarkOptions:
+    # Rows of every synthetic source
+    rows: int = 100_000
+    # Number of feature columns added to every source besides id, text, label and score
+    width: int = 8
+    # Number of files every source is split into
+    files: int = 4
+    # Number of times each benchmark is run, the fastest run is kept
+    repeat: int = 3
+    # Benchmarks to run, all of them if empty
+    only: list[str] = field(default_factory=list)
+    seed: int = 0
+
+# Sources read by each benchmark, the recipe of a benchmark has the same name
+benchmark_sources: dict[str, list[str]] = {
+    "remap": [ "parquet_0" ],
+    "interleave": [ "parquet_0", "parquet_1", "csv_0" ],
+    "nested": [ "parquet_0", "parquet_1", "parquet_2", "csv_0" ],
+    "split_save": [ "parquet_0", "parquet_1" ],
+    "tokenize": [ "parquet_0" ]
+}
+
+# Measured on their own, they don't build anything
+other_benchmarks = [ "startup" ]
+
+# Modules that are slow to import and must only be imported by the operations that need them
+heavy_modules = [ "transformers", "torch" ]
+
+# Imports the tools and discovers the operations like the command line does before running any command
+startup_code = """
+import sys, json, resource
+sys.path.append({tools_directory!r})
+sys.path.insert(0, {main_directory!r})
+from tools import *
+from operation import Operation
+Operation.discover({operations_directory!r}, "tools.operations")
+print(json.dumps({{ "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                   "modules": [ name for name in {heavy_modules!r} if name in sys.modules ] }}))
+"""
+
+vocabulary = [ f"w{i}" for i in range(2000) ]
+
+def synthetic_table(generator: np.random.Generator, rows: int, width: int, offset: int = 0) -> pa.Table:
+    """Random rows with an id, a text of 8 to 128 words, a label, a score and width feature columns."""
+    lengths = generator.integers(8, 129, rows)
+    offsets = np.concatenate([ [ 0 ], np.cumsum(lengths) ]).astype(np.int32)
+    words = pa.array(vocabulary).take(generator.integers(0, len(vocabulary), int(offsets[-1])))
+    columns = {
+        "id": np.arange(offset, offset + rows, dtype=np.int64),
+        "text": pc.binary_join(pa.ListArray.from_arrays(offsets, words), " "),
+        "label": pa.array([ "a", "b", "c", "d" ]).take(generator.integers(0, 4, rows)),
+        "score": generator.random(rows)
+    }
+    for i in range(width):
+        columns[f"feature_{i}"] = generator.random(rows) if i % 2 == 0 else generator.integers(0, 1 << 31, rows)
+    return pa.table(columns)
+
+def write_sources(directory: str, options: BenchmarkOptions):
+    """Write the synthetic sources used by the benchmarks, with their source configs."""
+    generator = np.random.default_rng(options.seed)
+    names = sorted(set(source for sources in benchmark_sources.values() for source in sources))
+    for name in names:
+        source_type = name.split("_")[0]
+        os.makedirs(path.join(directory, name), exist_ok=True)
+        for i, rows in enumerate(np.diff(np.linspace(0, options.rows, options.files + 1).astype(np.int64))):
+            table = synthetic_table(generator, int(rows), options.width, i * options.rows)
+            file_path = path.join(directory, name, f"part-{i:05d}.{source_type}")
+            if source_type == "csv":
+                pcsv.write_csv(table, file_path)
+            else:
+                pq.write_table(table, file_path, row_group_size=10000)
+        with open(path.join(directory, name + ".json"), "w") as f:
+            json.dump({ "source_type": source_type, "source_path": f"./{name}" }, f, indent=4)
+    log_info(f"Wrote {len(names)} sources of {options.rows} rows to {directory}")
+
+def write_tokenizer(directory: str, max_sequence_length: int = 512):
+    """Save a word level tokenizer over the synthetic vocabulary, so tokenization runs offline."""
+    # Only needed by the tokenize benchmark, transformers is slow to import
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import WhitespaceSplit
+    from transformers import BertConfig, PreTrainedTokenizerFast
+    special_tokens = [ "[PAD]", "[UNK]", "[SEP]" ]
+    tokenizer = Tokenizer(WordLevel({ token: i for i, token in enumerate(special_tokens + vocabulary) }, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = WhitespaceSplit()
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]", sep_token="[SEP]",
+                            eos_token="[SEP]").save_pretrained(directory)
+    BertConfig(vocab_size=len(special_tokens) + len(vocabulary), max_position_embeddings=max_sequence_length).save_pretrained(directory)
+
+def write_recipes(directory: str, tokenizer_directory: str):
+    """Write the recipe of every benchmark."""
+    def remapped(probability: float = 1.0) -> dict:
+        return {
+            "probability": probability,
+            "operations": [ { "name": "remap", "args": { "columns": { "id": "id", "text": "text", "score": "score" }, "remove_others": True } } ]
+        }
+    recipes = {
+        "remap": {
+            "sources": { "parquet_0": { "operations": [ { "name": "remap", "args": { "columns": { "text": "content", "feature_0": "" } } } ] } }
+        },
+        "interleave": {
+            "sources": { "parquet_0": remapped(0.5), "parquet_1": remapped(0.3), "csv_0": remapped(0.2) },
+            "source_column": "source"
+        },
+        "nested_a": {
+            "sources": { "parquet_0": remapped(0.6), "parquet_1": remapped(0.4) }
+        },
+        "nested_b": {
+            "sources": { "parquet_2": remapped(0.5), "csv_0": remapped(0.5) }
+        },
+        "nested": {
+            "sources": { "nested_a": { "type": "recipe", "probability": 0.5 }, "nested_b": { "type": "recipe", "probability": 0.5 } }
+        },
+        "split_save": {
+            "sources": { "parquet_0": remapped(0.5), "parquet_1": remapped(0.5) },
+            "splits": { "train": 0.98, "validation": 0.01, "test": 0.01 },
+            "output": { "format": "parquet" }
+        },
+        "tokenize": {
+            "sources": { "parquet_0": remapped() },
+            "final_operations": [ { "name": "tokenize_text", "args": { "model": tokenizer_directory, "text_column": "text", "max_sequence_length": 128 } } ]
+        }
+    }
+    os.makedirs(directory, exist_ok=True)
+    for name, recipe in recipes.items():
+        with open(path.join(directory, name + ".json"), "w") as f:
+            json.dump(recipe, f, indent=4)
+
+def source_bytes(directory: str, sources: list[str]) -> int:
+    return sum(directory_size(path.join(directory, source)) for source in sources)
+
+def run_benchmark(task: tuple[str, str, int, int]) -> dict:
+    """Build the recipe of a benchmark from scratch inside a fresh process, and measure it."""
+    workspace, name, run, rows = task
+    # Nothing may be reused from another run, including the datasets library's own cache
+    datasets.config.HF_DATASETS_CACHE = path.join(workspace, "cache", f"{name}-{run}")
+    RecipeBuilder.recipe_cache.clear()
+    RecipeBuilder.source_cache.clear()
+    builder = RecipeBuilder(path.join(workspace, "sources"), path.join(workspace, "recipes"),
+                            path.join(workspace, "built", f"{name}-{run}"), BuildOptions(cache_size=0, inference_cache_size=0))
+    start = time()
+    recipe = builder.build(name)
+    seconds = time() - start
+    rss, children_rss = peak_rss()
+    rows_in = rows * len(benchmark_sources[name])
+    bytes_in = source_bytes(path.join(workspace, "sources"), benchmark_sources[name])
+    return {
+        "seconds": seconds,
+        "rows_in": rows_in,
+        "rows_out": dataset_size(recipe.built_dataset)[0],
+        "bytes_in": bytes_in,
+        "rows_per_second": rows_in / seconds,
+        "bytes_per_second": bytes_in / seconds,
+        "peak_rss": rss,
+        "peak_rss_workers": children_rss
+    }
+
+def run_startup() -> dict:
+    """Start a fresh interpreter that imports the tools like the command line does, and measure it."""
+    tools_directory = path.dirname(path.realpath(__file__))
+    code = startup_code.format(tools_directory=tools_directory, main_directory=path.dirname(tools_directory),
+                               operations_directory=path.join(tools_directory, "operations"), heavy_modules=heavy_modules)
+    start = time()
+    process = subprocess.run([ sys.executable, "-c", code ], capture_output=True, text=True, check=True)
+    seconds = time() - start
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    return {
+        "seconds": seconds,
+        "rows_in": None,
+        "rows_out": None,
+        "bytes_in": None,
+        "rows_per_second": None,
+        "bytes_per_second": None,
+        "peak_rss": result["peak_rss"],
+        "peak_rss_workers": None,
+        "heavy_modules": result["modules"]
+    }
+
+def run_benchmarks(options: BenchmarkOptions, workspace: Optional[str] = None) -> dict:
+    """Generate the synthetic data and run every benchmark on it.
+
+    Each run builds in its own process, so memory peaks of one run don't carry over to the next.
+    Returns the options and the results of the fastest run of each benchmark.
+    """
+    names = options.only or list(benchmark_sources.keys()) + other_benchmarks
+    for name in names:
+        if name not in benchmark_sources and name not in other_benchmarks:
+            raise ValueError(f"Unknown benchmark '{name}', available benchmarks are {', '.join(list(benchmark_sources.keys()) + other_benchmarks)}")
+
+    keep_workspace = workspace is not None
+    workspace = workspace or tempfile.mkdtemp(prefix="vz-datatools-benchmark-")
+    try:
+        write_sources(path.join(workspace, "sources"), options)
+        tokenizer_directory = path.join(workspace, "tokenizer")
+        if "tokenize" in names:
+            # Keep transformers out of the process benchmarks are forked from, it would count towards their memory
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("fork")) as pool:
+                pool.submit(write_tokenizer, tokenizer_directory).result()
+        write_recipes(path.join(workspace, "recipes"), tokenizer_directory)
+
+        results = { }
+        for name in names:
+            runs = [ ]
+            for run in range(options.repeat):
+                log_info(f"Running benchmark '{name}' ({run + 1}/{options.repeat})...")
+                if name == "startup":
+                    runs.append(run_startup())
+                    continue
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("fork")) as pool:
+                    runs.append(pool.submit(run_benchmark, (workspace, name, run, options.rows)).result())
+                shutil.rmtree(path.join(workspace, "built", f"{name}-{run}"), ignore_errors=True)
+                shutil.rmtree(path.join(workspace, "cache", f"{name}-{run}"), ignore_errors=True)
+            results[name] = min(runs, key=lambda result: result["seconds"])
+            # Memory is compared against the worst run so a single lucky run can't hide a regression
+            results[name]["peak_rss"] = max(result["peak_rss"] or 0 for result in runs) or None
+            results[name]["peak_rss_workers"] = max(result["peak_rss_workers"] or 0 for result in runs) or None
+    finally:
+        if not keep_workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        "options": { key: value for key, value in asdict(options).items() if key in ("rows", "width", "files", "seed") },
+        "platform": { "python": platform.python_version(), "machine": platform.machine(), "cpu_count": os.cpu_count() },
+        "results": results
+    }
+
+def compare_benchmarks(report: dict, baseline: Optional[dict], tolerance: float) -> list[str]:
+    """Log the results of a benchmark run next to a baseline.
+
+    A benchmark regresses if its throughput drops, or its peak memory grows,
+    by more than tolerance. Benchmarks that don't read rows compare their time instead,
+    and startup also regresses whenever it imports one of the heavy modules.
+    Returns the names of the benchmarks that regressed.
+    """
+    if baseline is not None and baseline["options"] != report["options"]:
+        log_failed(f"Baseline was run with {baseline['options']}, not comparing it to {report['options']}")
+        baseline = None
+
+    def megabytes(value: Optional[int]) -> str:
+        return f"{value / 1024**2:.0f}MB" if value is not None else "-"
+
+    def per_second(value: Optional[float], scale: float = 1, digits: int = 0) -> str:
+        return f"{value / scale:.{digits}f}" if value is not None else "-"
+
+    regressions = [ ]
+    log_info(f"{'benchmark':<12} {'seconds':>9} {'rows/s':>12} {'MB/s':>9} {'peak rss':>10} {'workers rss':>12}")
+    for name, result in report["results"].items():
+        log_info(f"{name:<12} {result['seconds']:>9.3f} {per_second(result['rows_per_second']):>12} {per_second(result['bytes_per_second'], 1024**2, 1):>9} "
+                 f"{megabytes(result['peak_rss']):>10} {megabytes(result['peak_rss_workers']):>12}")
+        if len(result.get("heavy_modules", [ ])) > 0:
+            regressions.append(name)
+            log_failed(f"{name} imported {', '.join(result['heavy_modules'])} before any operation needed it")
+            continue
+        expected = baseline["results"].get(name) if baseline is not None else None
+        if expected is None:
+            continue
+        if result["rows_per_second"] is not None and expected["rows_per_second"]:
+            throughput = result["rows_per_second"] / expected["rows_per_second"] - 1
+        else:
+            # Benchmarks that don't read rows are compared by their time instead
+            throughput = expected["seconds"] / result["seconds"] - 1
+        messages = [ f"throughput {throughput * 100:+.1f}%" ]
+        regressed = throughput < -tolerance
+        for metric in ("peak_rss", "peak_rss_workers"):
+            if result[metric] is not None and expected[metric]:
+                growth = result[metric] / expected[metric] - 1
+                messages.append(f"{metric} {growth * 100:+.1f}%")
+                regressed = regressed or growth > tolerance
+        if regressed:
+            regressions.append(name)
+            log_failed(f"{name} regressed against the baseline: {', '.join(messages)}")
+        else:
+            log_ok(f"{name}: {', '.join(messages)}")
+    return regressions
@@ -0,0 +1,22 @@
+import os.path as path
+import json
+from multiprocessing.connection import Client
+from common import *
+
+def server_info_path(output_directory: str) -> str:
+    """File where a running build server records its address and key."""
+    return path.join(output_directory, ".server.json")
+
+def submit_request(output_directory: str, request: dict) -> dict:
+    """Send a request to the build server of an output directory and wait for its response.
+
+    Raises ConnectionRefusedError if no server is running.
+    """
+    try:
+        with open(server_info_path(output_directory), "rb") as f:
+            info = json.loads(f.read())
+    except FileNotFoundError:
+        raise ConnectionRefusedError("No build server is running, start one with 'vz-datatools.py serve'")
+    with Client(tuple(info["address"]), authkey=bytes.fromhex(info["authkey"])) as connection:
+        connection.send(request)
+        return connection.recv()
@@ -0,0 +1,429 @@
+import io
+import os.path as path
+import json
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from time import time
+from typing import Callable, Optional
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.json as pjson
+import pyarrow.parquet as pq
+from datasets import Dataset, disable_progress_bars, enable_progress_bars, load_dataset_builder
+from datasets.table import InMemoryTable
+from recipe_builder import *
+from common import *
+
+# Bytes read from the start of text files to estimate how many rows they hold
+text_sample_size = 1024**2
+
+@dataclass
+class StagePlan:
+    name: str
+    # "run", "cached" if its output is in the stage cache, or "skipped" if a later stage is cached
+    action: str
+    rows: Optional[int] = None
+    num_bytes: Optional[int] = None
+    seconds: Optional[float] = None
+    # Whether rows were extrapolated instead of read from metadata
+    estimated: bool = False
+    depth: int = 0
+
+@dataclass
+class RecipePlan:
+    name: str
+    # "up to date", "append" or "rebuild"
+    action: str
+    rows: Optional[int] = None
+    num_bytes: Optional[int] = None
+    estimated: bool = False
+    stages: list[StagePlan] = field(default_factory=list)
+    splits: dict[str, Optional[int]] = field(default_factory=dict)
+    # First rows of the output, for the recipes using this one
+    sample: Optional[pa.Table] = None
+
+    @property
+    def seconds(self) -> float:
+        return sum(stage.seconds or 0 for stage in self.stages)
+
+def read_text_sample(file: str, file_format: str, num_bytes: int = text_sample_size) -> tuple[pa.Table, int]:
+    """Parse the whole lines at the start of a csv or jsonl file. Returns them and the bytes they take in the file."""
+    with open(file, "rb") as f:
+        data = f.read(num_bytes)
+        if len(data) == num_bytes and f.read(1) != b"":
+            data = data[:data.rfind(b"\n") + 1]
+    reader = pcsv.read_csv if file_format == "csv" else pjson.read_json
+    return reader(io.BytesIO(data)), len(data)
+
+def file_statistics(files: list[str], file_format: str, columns: Optional[set[str]] = None) -> tuple[Optional[int], Optional[int], bool]:
+    """Rows and bytes in memory of the given columns of some files, without reading their data.
+
+    Parquet and Arrow files are counted from their metadata. Text formats are extrapolated
+    from the start of their first file. Returns whether the counts are exact.
+    """
+    if len(files) == 0:
+        return 0, 0, True
+    rows = 0
+    num_bytes = 0
+    match file_format:
+        case "parquet":
+            for file in files:
+                metadata = pq.ParquetFile(file).metadata
+                rows += metadata.num_rows
+                file_bytes = sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+                if columns is not None and metadata.num_row_groups > 0:
+                    # Columns take about the same share of every row group
+                    row_group = metadata.row_group(0)
+                    chunks = [ row_group.column(i) for i in range(row_group.num_columns) ]
+                    selected = sum(chunk.total_uncompressed_size for chunk in chunks if chunk.path_in_schema.split(".")[0] in columns)
+                    file_bytes = file_bytes * selected // max(sum(chunk.total_uncompressed_size for chunk in chunks), 1)
+                num_bytes += file_bytes
+            return rows, num_bytes, True
+        case "arrow":
+            for file in files:
+                # Memory-mapped, only the headers of the record batches are read
+                with pa.memory_map(file) as source:
+                    for batch in pa.ipc.open_stream(source):
+                        rows += batch.num_rows
+                        num_bytes += sum(batch.column(i).nbytes for i, name in enumerate(batch.schema.names) if columns is None or name in columns)
+            return rows, num_bytes, True
+        case "csv" | "jsonl":
+            try:
+                sample, sample_bytes = read_text_sample(files[0], file_format)
+            except (pa.ArrowInvalid, OSError):
+                return None, None, False
+            if len(sample) == 0:
+                return 0, 0, False
+            total_bytes = sum(path.getsize(file) for file in files)
+            rows = round(total_bytes * len(sample) / max(sample_bytes, 1))
+            if columns is not None:
+                sample = sample.select([ name for name in sample.column_names if name in columns ])
+            return rows, sample.nbytes * rows // len(sample), False
+    return None, None, False
+
+def sample_files(files: list[str], file_format: str, num_rows: int, columns: Optional[set[str]] = None) -> Optional[pa.Table]:
+    """Read the first rows of some files."""
+    tables = [ ]
+    remaining = num_rows
+    for file in files:
+        if remaining <= 0:
+            break
+        match file_format:
+            case "parquet":
+                parquet = pq.ParquetFile(file)
+                names = [ name for name in parquet.schema_arrow.names if columns is None or name in columns ]
+                table = next((pa.Table.from_batches([ batch ]) for batch in parquet.iter_batches(batch_size=remaining, columns=names)), None)
+            case "arrow":
+                table = Dataset.from_file(file).data.table.slice(0, remaining)
+            case "csv" | "jsonl":
+                table = read_text_sample(file, file_format)[0].slice(0, remaining)
+            case _:
+                return None
+        if table is None:
+            continue
+        if columns is not None:
+            table = table.select([ name for name in table.column_names if name in columns ])
+        tables.append(table)
+        remaining -= len(table)
+    if len(tables) == 0:
+        return None
+    return pa.concat_tables(tables, promote_options="permissive")
+
+def output_statistics(directory: str) -> tuple[Optional[int], Optional[int], dict[str, int]]:
+    """Rows and bytes of a built output, and rows of each of its splits."""
+    splits = { }
+    num_bytes = 0
+    for split, split_directory in output_directories(directory).items():
+        index_json = path.join(split_directory, "shards.json")
+        if path.isfile(index_json):
+            with open(index_json, "rb") as f:
+                index = json.loads(f.read())
+            splits[split] = index["num_rows"]
+            if index["format"] == "parquet":
+                # Sizes in memory like everything else, not compressed
+                num_bytes += file_statistics([ path.join(split_directory, shard["filename"]) for shard in index["shards"] ], "parquet")[1]
+            else:
+                num_bytes += sum(shard["num_bytes"] for shard in index["shards"])
+        else:
+            dataset = Dataset.load_from_disk(split_directory)
+            splits[split] = len(dataset)
+            num_bytes += dataset.data.nbytes
+    return sum(splits.values()), num_bytes, splits
+
+def output_format(directory: str) -> str:
+    index_json = path.join(next(iter(output_directories(directory).values())), "shards.json")
+    if not path.isfile(index_json):
+        return "arrow"
+    with open(index_json, "rb") as f:
+        return json.loads(f.read())["format"]
+
+class BuildPlanner:
+    """Works out what building a recipe would do without building it.
+
+    Sizes are read from the metadata of the files sources read from, and followed
+    through the mixture. The rows and time of every operation that would run are
+    extrapolated from running it on the first sample_rows rows of its input.
+    Stages found in the stage cache are reported as reused, like the build would.
+    """
+
+    def __init__(self, builder: RecipeBuilder, sample_rows: int = 1000):
+        self.builder = builder
+        self.sample_rows = sample_rows
+        self.plans: dict[str, RecipePlan] = { }
+
+    def plan(self, recipe_name: str) -> list[RecipePlan]:
+        """Plan a recipe and every recipe it depends on, dependencies first."""
+        graph = self.builder.resolve_dependencies(recipe_name)
+        disable_progress_bars()
+        try:
+            return [ self.plan_recipe(name) for name in graph.keys() ]
+        finally:
+            enable_progress_bars()
+
+    def plan_recipe(self, recipe_name: str) -> RecipePlan:
+        plan = self.plans.get(recipe_name)
+        if plan is not None:
+            return plan
+        recipe = self.builder.get_recipe(recipe_name)
+        if self.builder.is_up_to_date(recipe):
+            rows, num_bytes, splits = output_statistics(recipe.built_directory)
+            files = output_files(recipe.built_directory)
+            plan = RecipePlan(recipe_name, "up to date", rows, num_bytes, splits=splits if len(recipe.splits) > 0 else { },
+                              sample=sample_files(files, output_format(recipe.built_directory), self.sample_rows))
+            self.plans[recipe_name] = plan
+            return plan
+
+        new_files = self.builder.appendable_files(recipe)
+        plan = RecipePlan(recipe_name, "append" if new_files is not None else "rebuild")
+        interleave_key = self.builder.interleave_fingerprint(recipe)
+        if new_files is not None:
+            interleave_key = fingerprint("append", interleave_key, new_files)
+        stages, rows, num_bytes, estimated, sample = self.plan_operations(
+            self.builder.operation_fingerprints(interleave_key, recipe.config.final_operations),
+            recipe.config.final_operations,
+            lambda columns: self.plan_mixture(recipe, interleave_key, new_files))
+        plan.stages = stages
+
+        if new_files is not None and rows is not None:
+            built_rows, built_bytes, _ = output_statistics(recipe.built_directory)
+            rows += built_rows
+            num_bytes = (num_bytes or 0) + built_bytes
+        plan.rows, plan.num_bytes, plan.estimated, plan.sample = rows, num_bytes, estimated, sample
+        # Ratios are relative to each other, like assign_splits() uses them
+        total_ratio = sum(recipe.splits.values())
+        plan.splits = { split: round(rows * ratio / total_ratio) if rows is not None else None for split, ratio in recipe.splits.items() }
+        self.plans[recipe_name] = plan
+        return plan
+
+    def plan_mixture(self, recipe: DataRecipe, interleave_key: str,
+                     new_files: Optional[dict[str, list[str]]]) -> tuple[list[StagePlan], Optional[pa.Table]]:
+        """Plan every source of a recipe and how many rows the mixture takes from each."""
+        if self.builder.stage_cache.contains(interleave_key):
+            dataset = Dataset.load_from_disk(self.builder.stage_cache.entry_directory(interleave_key))
+            rows, num_bytes = dataset_size(dataset)
+            return [ StagePlan("interleave", "cached", rows, num_bytes) ], dataset.with_format("arrow")[:self.sample_rows]
+
+        stages = [ ]
+        sources = [ ]
+        for source_name, source_config in recipe.sources.items():
+            files = None
+            key = self.builder.source_fingerprint(recipe, source_name, source_config)
+            if new_files is not None:
+                files = new_files[source_name]
+                if len(files) == 0:
+                    continue
+                key = fingerprint("files", key, files)
+            source_stages, rows, num_bytes, estimated, sample = self.plan_operations(
+                self.builder.operation_fingerprints(key, source_config.operations),
+                source_config.operations,
+                lambda columns: self.plan_source(source_name, source_config, columns, files),
+                depth=1)
+            stages += source_stages
+            sources.append((source_name, source_config, rows, num_bytes, estimated, sample))
+
+        stage = StagePlan("interleave", "run", estimated=any(source[4] for source in sources))
+        lengths = [ source[2] for source in sources ]
+        sample = None
+        if all(length is not None for length in lengths):
+            counts = mixture_counts(np.array(lengths, dtype=np.int64),
+                                    np.array([ source[1].probability for source in sources ], dtype=np.float64),
+                                    np.array([ source[1].epochs for source in sources ], dtype=np.float64),
+                                    recipe.config.total_rows if new_files is None else None,
+                                    recipe.config.stopping_strategy)
+            stage.rows = int(counts.sum())
+            stage.num_bytes = int(sum(count * (source[3] or 0) // max(source[2], 1) for count, source in zip(counts, sources)))
+            # Sample every source in proportion to the rows the mixture takes from it
+            tables = [ ]
+            for count, (source_name, _, _, _, _, source_sample) in zip(counts, sources):
+                if source_sample is None:
+                    continue
+                table = source_sample.slice(0, round(self.sample_rows * count / max(stage.rows, 1)))
+                if recipe.config.source_column is not None:
+                    table = table.append_column(recipe.config.source_column, pa.array([ source_name ] * len(table), pa.string()))
+                tables.append(table)
+            if len(tables) > 0:
+                sample = pa.concat_tables(tables, promote_options="permissive")
+        elif recipe.config.total_rows is not None and new_files is None:
+            stage.rows = recipe.config.total_rows
+        stages.append(stage)
+        return stages, sample
+
+    def plan_source(self, source_name: str, source_config: DataRecipeSourceConfig, columns: Optional[set[str]],
+                    files: Optional[list[str]]) -> tuple[list[StagePlan], Optional[pa.Table]]:
+        """Size up a source, or only the given files of it, from its metadata."""
+        stage = StagePlan(f"load {source_name}", "run", depth=1)
+        sample = None
+        if source_config.type == "recipe":
+            dependency = self.plan_recipe(source_name)
+            if files is not None:
+                file_format = output_format(self.builder.get_recipe(source_name).built_directory)
+                stage.rows, stage.num_bytes, exact = file_statistics(files, file_format, columns)
+                stage.estimated = not exact
+                sample = sample_files(files, file_format, self.sample_rows, columns)
+            else:
+                stage.rows, stage.num_bytes, stage.estimated = dependency.rows, dependency.num_bytes, dependency.estimated
+                sample = dependency.sample
+                if sample is not None and columns is not None:
+                    sample = sample.select([ name for name in sample.column_names if name in columns ])
+            return [ stage ], sample
+
+        source = self.builder.get_source(source_name)
+        match source.config.source_type:
+            case "parquet" | "csv" | "jsonl":
+                file_format = source.config.source_type
+                if files is None:
+                    files = [ file for file in source.files() if file.endswith(".parquet") ] if file_format == "parquet" else source.data_files()
+                if file_format != "parquet":
+                    # Text files already converted by an earlier build are counted exactly
+                    arrow_files = [ source.cached_arrow_file(file) for file in files ]
+                    if all(arrow_file is not None for arrow_file in arrow_files):
+                        files, file_format = arrow_files, "arrow"
+                stage.rows, stage.num_bytes, exact = file_statistics(files, file_format, columns)
+                stage.estimated = not exact
+                sample = sample_files(files, file_format, self.sample_rows, columns)
+            case "hf_disk":
+                # Memory-mapped, nothing is read until it's used
+                dataset = Dataset.load_from_disk(source.source_path)
+                dataset = concatenate_splits(dataset)
+                if columns is not None:
+                    dataset = dataset.select_columns([ name for name in dataset.column_names if name in columns ])
+                stage.rows, stage.num_bytes = dataset_size(dataset)
+                sample = dataset.with_format("arrow")[:self.sample_rows]
+            case "hf_hub":
+                # Only what the hub records about the dataset, streaming a sample would take too long
+                try:
+                    info = load_dataset_builder(source.source_path).info
+                    stage.rows = sum(split.num_examples for split in (info.splits or { }).values()) or None
+                    stage.num_bytes = info.dataset_size
+                except Exception as e:
+                    log_trace(f"Couldn't get the size of {source.source_path}: {e}")
+        return [ stage ], sample
+
+    def plan_operations(self, keys: list[str], operations: list[DataRecipeOperationConfig],
+                        plan_input: Callable[[Optional[set[str]]], tuple[list[StagePlan], Optional[pa.Table]]],
+                        depth: int = 0) -> tuple[list[StagePlan], Optional[int], Optional[int], bool, Optional[pa.Table]]:
+        """Plan a chain of operations like RecipeBuilder.apply_operations() would run it.
+
+        The chain resumes from the last stage found in the stage cache, and plan_input is only
+        called if nothing could be reused. Returns the stages, the rows, bytes and sample of
+        the output, and whether its size is an estimate.
+        """
+        stages = [ ]
+        start = 0
+        for i in range(len(operations), 0, -1):
+            if self.builder.stage_cache.contains(keys[i]):
+                dataset = Dataset.load_from_disk(self.builder.stage_cache.entry_directory(keys[i]))
+                stages += [ StagePlan(op_config.name, "skipped", depth=depth) for op_config in operations[:i - 1] ]
+                rows, num_bytes = dataset_size(dataset)
+                stages.append(StagePlan(operations[i - 1].name, "cached", rows, num_bytes, depth=depth))
+                sample = dataset.with_format("arrow")[:self.sample_rows]
+                estimated = False
+                start = i
+                break
+        if start == 0:
+            columns, _ = self.builder.plan_operations(operations)
+            stages, sample = plan_input(columns)
+            rows, num_bytes, estimated = stages[-1].rows, stages[-1].num_bytes, stages[-1].estimated
+
+        for op_config in operations[start:]:
+            stage = StagePlan(op_config.name, "run", estimated=True, depth=depth)
+            if sample is not None and len(sample) > 0 and self.sample_rows > 0:
+                try:
+                    seconds_per_row, setup_seconds, output = self.measure(op_config, sample)
+                    if rows is not None:
+                        stage.seconds = setup_seconds + seconds_per_row * rows
+                        stage.rows = round(rows * len(output) / len(sample))
+                        stage.num_bytes = output.nbytes * stage.rows // max(len(output), 1)
+                    sample = output
+                except Exception as e:
+                    log_failed(f"Couldn't run '{op_config.name}' on a sample: {e!r}")
+                    sample = None
+            else:
+                sample = None
+            rows, num_bytes, estimated = stage.rows, stage.num_bytes, True
+            stages.append(stage)
+        return stages, rows, num_bytes, estimated, sample
+
+    def measure(self, op_config: DataRecipeOperationConfig, sample: pa.Table) -> tuple[float, float, pa.Table]:
+        """Time an operation on slices of a sample of different sizes, to tell its cost per row
+        from the cost of setting it up, like loading a model.
+
+        Returns the seconds per row, the setup time and the output on the whole sample.
+        """
+        def run(num_rows: int) -> tuple[float, pa.Table]:
+            dataset = Dataset(InMemoryTable(sample.slice(0, num_rows)))
+            op = Operation.create(op_config.name)
+            start = time()
+            # Operations log what they do, which isn't what is being planned
+            with redirect_stdout(io.StringIO()):
+                output = op(dataset, **op_config.args)
+                output = concatenate_splits(output)
+                output = output.with_format("arrow")[:]
+            return time() - start, output
+
+        setup_rows = min(16, len(sample))
+        setup_seconds, output = run(setup_rows)
+        if len(sample) <= setup_rows:
+            return 0.0, setup_seconds, output
+        small_rows = max(setup_rows, len(sample) // 4)
+        small_seconds, _ = run(small_rows)
+        seconds, output = run(len(sample))
+        if len(sample) == small_rows:
+            return seconds / len(sample), setup_seconds, output
+        return max(seconds - small_seconds, 0.0) / (len(sample) - small_rows), setup_seconds, output
+
+    def report(self, plans: list[RecipePlan]):
+        def count(value: Optional[int], estimated: bool) -> str:
+            if value is None:
+                return "?"
+            return f"~{value}" if estimated else str(value)
+
+        def size(value: Optional[int]) -> str:
+            if value is None:
+                return "?"
+            for unit in ("B", "KB", "MB", "GB"):
+                if value < 1024:
+                    return f"{value:.1f} {unit}"
+                value /= 1024
+            return f"{value:.1f} TB"
+
+        for plan in plans:
+            match plan.action:
+                case "up to date":
+                    log_ok(f"'{plan.name}' is up to date ({plan.rows} rows, {size(plan.num_bytes)})")
+                    continue
+                case "append":
+                    log_info(f"New files would be appended to '{plan.name}':")
+                case "rebuild":
+                    log_info(f"'{plan.name}' would be rebuilt:")
+            log_info(f"\t{'stage':<40} {'action':<8} {'rows':>14} {'size':>10} {'time':>10}")
+            for stage in plan.stages:
+                name = "  " * stage.depth + stage.name
+                seconds = f"{stage.seconds:.1f}s" if stage.seconds is not None else ""
+                log_info(f"\t{name:<40} {stage.action:<8} {count(stage.rows, stage.estimated):>14} {size(stage.num_bytes):>10} {seconds:>10}")
+            log_info(f"\tOutput: {count(plan.rows, plan.estimated)} rows, {size(plan.num_bytes)}")
+            for split, rows in plan.splits.items():
+                log_info(f"\t\t{split:<20} {count(rows, True)} rows")
+        seconds = sum(plan.seconds for plan in plans)
+        log_info(f"Operations would take about {seconds:.1f} seconds, without loading, interleaving and saving")
@@ -0,0 +1,227 @@
+import os
+import os.path as path
+import io
+import sys
+import json
+import queue
+import secrets
+import threading
+import traceback
+from contextlib import redirect_stdout
+from dataclasses import asdict
+from multiprocessing.connection import Listener, Connection
+from multiprocessing import AuthenticationError
+from pathlib import Path
+from typing import Optional
+from recipe_builder import *
+from build_client import *
+from warm_cache import warm_cache
+from common import *
+
+class OutputTee(io.TextIOBase):
+    """Writes the log of a build to the server's console and keeps it to send back to the client."""
+
+    def __init__(self, console: io.TextIOBase):
+        self.console = console
+        self.buffer = io.StringIO()
+
+    def write(self, text: str) -> int:
+        self.console.write(text)
+        return self.buffer.write(text)
+
+    def flush(self):
+        self.console.flush()
+
+class BuildServer:
+    """Builds recipes in a single long-running process, so the sources, tokenizers and models
+    loaded by one build stay in memory for the next ones.
+
+    Builds are submitted by clients with submit_request() and run one at a time.
+    Recipes and sources are checked for changes before every build, and anything loaded
+    from one that changed is forgotten. When watching, recipes affected by a change
+    are also rebuilt as soon as it's noticed.
+    """
+
+    def __init__(self, sources_directory: str, recipes_directory: str, output_directory: str, options: BuildOptions,
+                 memory: int, watch: Optional[list[str]] = None, interval: float = 2.0):
+        self.sources_directory = sources_directory
+        self.recipes_directory = recipes_directory
+        self.output_directory = output_directory
+        self.options = options
+        # Recipes rebuilt when they're affected by a change, None when not watching
+        # and empty to rebuild every recipe that was built before
+        self.watch = watch
+        self.interval = interval
+        self.requests: queue.Queue[Connection] = queue.Queue()
+        self.running = False
+        warm_cache.max_size = memory
+        self.snapshot = self.scan()
+
+    def serve(self):
+        """Accept requests until a client asks the server to stop."""
+        authkey = secrets.token_bytes(32)
+        listener = Listener(("127.0.0.1", 0), authkey=authkey)
+        info_path = server_info_path(self.output_directory)
+        # Only the user running the server can read the key
+        with open(os.open(info_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({ "address": list(listener.address), "authkey": authkey.hex(), "pid": os.getpid() }, f)
+        threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+        log_ok(f"Build server listening on {listener.address[0]}:{listener.address[1]}")
+        if self.watch is not None:
+            log_info(f"Watching {self.recipes_directory} and {self.sources_directory} for changes")
+
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    connection = self.requests.get(timeout=self.interval)
+                except queue.Empty:
+                    if self.watch is not None:
+                        self.rebuild(self.refresh())
+                    continue
+                self.handle(connection)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            if path.isfile(info_path):
+                os.remove(info_path)
+            log_info("Build server stopped")
+
+    def accept(self, listener: Listener):
+        """Queue incoming connections for the main thread, which runs every build."""
+        while True:
+            try:
+                self.requests.put(listener.accept())
+            except AuthenticationError:
+                log_failed("Rejected a client with the wrong key")
+            except OSError:
+                # The listener was closed
+                return
+
+    def handle(self, connection: Connection):
+        try:
+            request = connection.recv()
+            match request.get("action"):
+                case "build":
+                    tee = OutputTee(sys.stdout)
+                    with redirect_stdout(tee):
+                        self.rebuild(self.refresh())
+                        options = BuildOptions(**{ **asdict(self.options), **request.get("options", { }) })
+                        succeeded = self.build(request["recipe"], options)
+                    connection.send({ "ok": succeeded, "output": tee.buffer.getvalue() })
+                case "status":
+                    connection.send({ "ok": True, "output": self.status() })
+                case "stop":
+                    self.running = False
+                    connection.send({ "ok": True, "output": "Build server stopping\n" })
+                case action:
+                    connection.send({ "ok": False, "output": f"Unknown request '{action}'\n" })
+        except (EOFError, OSError):
+            log_trace("Client disconnected before receiving its response")
+        except Exception as e:
+            # A malformed request must not stop the server
+            log_trace(traceback.format_exc())
+            log_failed(f"Invalid request: {e!r}")
+            try:
+                connection.send({ "ok": False, "output": f"Invalid request: {e!r}\n" })
+            except (EOFError, OSError):
+                pass
+        finally:
+            connection.close()
+
+    def builder(self, options: Optional[BuildOptions] = None) -> RecipeBuilder:
+        # Recipes keep whether they were built, so they're reloaded for every build
+        RecipeBuilder.recipe_cache.clear()
+        return RecipeBuilder(self.sources_directory, self.recipes_directory, self.output_directory, options or self.options)
+
+    def build(self, recipe_name: str, options: Optional[BuildOptions] = None) -> bool:
+        """Build a recipe, keeping the server alive whatever goes wrong. Returns whether it succeeded."""
+        builder = self.builder(options)
+        try:
+            builder.build(recipe_name)
+            return True
+        except FileNotFoundError:
+            log_failed(f"Invalid recipe '{recipe_name}'")
+        except Exception as e:
+            log_trace(traceback.format_exc())
+            log_failed(f"Building '{recipe_name}' failed: {e!r}")
+        finally:
+            builder.stage_cache.evict()
+            evict_arrow_cache()
+            log_trace(f"Warm cache holds {len(warm_cache.entries)} objects, {warm_cache.size() / 1024**3:.2f} GB")
+        return False
+
+    def scan(self) -> dict[tuple[str, str], object]:
+        """Size and modification time of every recipe, and of every source's config and files."""
+        snapshot = { }
+        for recipe_json in Path(self.recipes_directory).glob("*.json"):
+            stat = recipe_json.stat()
+            snapshot[("recipe", recipe_json.stem)] = (stat.st_size, stat.st_mtime)
+        for source_json in Path(self.sources_directory).glob("*.json"):
+            stat = source_json.stat()
+            try:
+                files = [ ]
+                for file in DataSource(str(source_json)).files():
+                    file_stat = os.stat(file)
+                    files.append((file, file_stat.st_size, file_stat.st_mtime))
+            except (OSError, ValueError):
+                files = None
+            snapshot[("source", source_json.stem)] = (stat.st_size, stat.st_mtime, files)
+        return snapshot
+
+    def refresh(self) -> set[str]:
+        """Forget everything loaded from the recipes and sources that changed since the last check.
+
+        Returns the recipes that use any of them, directly or through other recipes.
+        """
+        snapshot = self.scan()
+        changed = { key for key in snapshot.keys() | self.snapshot.keys() if snapshot.get(key) != self.snapshot.get(key) }
+        self.snapshot = snapshot
+        if len(changed) == 0:
+            return set()
+        changed_recipes = { name for kind, name in changed if kind == "recipe" }
+        changed_sources = { name for kind, name in changed if kind == "source" }
+        for name in changed_sources:
+            RecipeBuilder.source_cache.pop(name, None)
+        warm_cache.invalidate(lambda key: key[0] == "source" and key[1] in changed_sources)
+        log_info(f"Changed since the last check: {', '.join(sorted(f'{kind} {name}' for kind, name in changed))}")
+
+        affected = set()
+        builder = self.builder()
+        for kind, name in snapshot.keys():
+            if kind != "recipe":
+                continue
+            try:
+                graph = builder.resolve_dependencies(name)
+            except Exception:
+                # Broken recipes are reported when something tries to build them
+                continue
+            for recipe_name in graph.keys():
+                recipe = builder.get_recipe(recipe_name)
+                if recipe_name in changed_recipes or any(source.type == "source" and source_name in changed_sources
+                                                         for source_name, source in recipe.sources.items()):
+                    affected.add(name)
+                    break
+        return affected
+
+    def rebuild(self, affected: set[str]):
+        """Rebuild the watched recipes among the affected ones."""
+        if self.watch is None or len(affected) == 0:
+            return
+        if len(self.watch) > 0:
+            watched = set(self.watch)
+        else:
+            watched = { name for name in affected if path.isfile(path.join(self.output_directory, name, "build.json")) }
+        for name in sorted(affected & watched):
+            log_info(f"Rebuilding '{name}' after a change")
+            self.build(name)
+
+    def status(self) -> str:
+        lines = [ f"Warm cache: {len(warm_cache.entries)} objects, {warm_cache.size() / 1024**3:.2f} of "
+                  f"{warm_cache.max_size / 1024**3:.2f} GB, {warm_cache.hits} hits, {warm_cache.misses} misses" ]
+        for key, (_, size) in reversed(warm_cache.entries.items()):
+            lines.append(f"\t{' '.join(str(part) for part in key if part is not None):<60} {size / 1024**2:.1f} MB")
+        if self.watch is not None:
+            lines.append(f"Watching: {', '.join(self.watch) if len(self.watch) > 0 else 'every built recipe'}")
+        return "\n".join(lines) + "\n"
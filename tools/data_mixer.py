@@ -0,0 +1,135 @@
+import os
+import os.path as path
+from datasets import Dataset, Features, Value, config as datasets_config
+from typing import Literal, Optional
+from common import *
+import numpy as np
+import pyarrow as pa
+
+type StoppingStrategy = Literal["first_exhausted", "all_exhausted"]
+
+def mixture_counts(lengths: np.ndarray, probabilities: np.ndarray, epochs: np.ndarray,
+                   total_rows: Optional[int] = None, stopping_strategy: StoppingStrategy = "first_exhausted") -> np.ndarray:
+    """Work out exactly how many rows are taken from each source.
+
+    Each source provides lengths * epochs rows before it is exhausted. Unless total_rows is given,
+    the mixture stops when the first source is exhausted, or when all of them are, in which case
+    the others are upsampled. Counts are split by probability with the largest remainder method.
+    """
+    probabilities = probabilities / probabilities.sum()
+    budgets = np.round(lengths * epochs).astype(np.int64)
+    if total_rows is None:
+        used = probabilities > 0
+        totals = budgets[used] / probabilities[used]
+        total_rows = int(totals.min() if stopping_strategy == "first_exhausted" else totals.max()) if used.any() else 0
+
+    exact = probabilities * total_rows
+    counts = np.floor(exact).astype(np.int64)
+    remainder = total_rows - counts.sum()
+    if remainder > 0:
+        counts[np.argsort(counts - exact, kind="stable")[:remainder]] += 1
+    if stopping_strategy == "first_exhausted":
+        counts = np.minimum(counts, budgets)
+    return counts
+
+def mixture_schedule(counts: np.ndarray, lengths: np.ndarray, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    """Shuffle the rows of every source together.
+
+    Returns the source and the row within that source of every output row.
+    Sources are read in order, going back to their first row once exhausted.
+    """
+    if np.any((counts > 0) & (lengths == 0)):
+        raise ValueError("Can't take rows from an empty source")
+    sources = np.random.default_rng(seed).permutation(np.repeat(np.arange(len(counts), dtype=np.int32), counts))
+    order = np.argsort(sources, kind="stable")
+    ranks = np.empty(len(sources), dtype=np.int64)
+    ranks[order] = np.arange(len(sources)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return sources, ranks % np.maximum(lengths, 1)[sources]
+
+# Tables of the sources being mixed, shared with the workers of mix_datasets()
+shared_tables: Optional[list[pa.Table]] = None
+
+def gather_rows(batch: pa.Table, source_schema: pa.Schema, schema: pa.Schema, source_names: pa.Array,
+                source_column: Optional[str]) -> pa.Table:
+    """Take the rows of a batch of the schedule from the sources, in schedule order."""
+    batch_sources = batch["source"].to_numpy()
+    batch_rows = batch["row"].to_numpy()
+    order = np.argsort(batch_sources, kind="stable")
+    parts = [ ]
+    for source in np.unique(batch_sources):
+        part = shared_tables[source].take(batch_rows[order][batch_sources[order] == source])
+        for field in source_schema:
+            if field.name not in part.column_names:
+                part = part.append_column(field, pa.nulls(len(part), field.type))
+        parts.append(part.select(source_schema.names).cast(source_schema))
+    if len(parts) == 0:
+        return schema.empty_table()
+    table = pa.concat_tables(parts)
+    if source_column is not None:
+        table = table.append_column(source_column, pa.DictionaryArray.from_arrays(batch_sources[order], source_names).cast(pa.string()))
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.arange(len(order))
+    return table.take(inverse)
+
+def mix_datasets(datasets: list[Dataset], names: list[str], probabilities: list[float], epochs: list[float], seed: int,
+                 key: str, total_rows: Optional[int] = None, stopping_strategy: StoppingStrategy = "first_exhausted",
+                 source_column: Optional[str] = None) -> Dataset:
+    """Mix datasets by probability into a single contiguous dataset, following a schedule computed upfront.
+
+    The rows taken from each source are logged exactly. If source_column is set,
+    the name of the source of each row is written to it.
+    """
+    datasets = [ dataset.flatten_indices(num_proc=num_proc) if dataset._indices is not None else dataset for dataset in datasets ]
+
+    lengths = np.array([ len(dataset) for dataset in datasets ], dtype=np.int64)
+    counts = mixture_counts(lengths, np.array(probabilities, dtype=np.float64), np.array(epochs, dtype=np.float64),
+                            total_rows, stopping_strategy)
+    sources, rows = mixture_schedule(counts, lengths, seed)
+
+    # Columns missing from some of the sources are filled with nulls
+    features = Features()
+    for dataset in datasets:
+        for column, feature in dataset.features.items():
+            if column not in features:
+                features[column] = feature
+    source_schema = features.arrow_schema
+    if source_column is not None:
+        features[source_column] = Value("string")
+    schema = features.arrow_schema
+    source_names = pa.array(names, type=pa.string())
+
+    # The schedule and the mixture are written to cache files, so neither has to fit in memory
+    directory = path.join(datasets_config.HF_DATASETS_CACHE, "mixtures")
+    os.makedirs(directory, exist_ok=True)
+    schedule_path = path.join(directory, f"schedule-{key}.arrow")
+    temp_path = f"{schedule_path}.tmp{os.getpid()}"
+    schedule_table = pa.table({ "source": pa.array(sources, pa.int32()), "row": pa.array(rows, pa.int64()) })
+    with pa.OSFile(temp_path, "wb") as sink, pa.ipc.new_stream(sink, schedule_table.schema) as writer:
+        writer.write_table(schedule_table, max_chunksize=10000)
+    os.replace(temp_path, schedule_path)
+    schedule = Dataset.from_file(schedule_path)
+
+    global shared_tables
+    # Inherited by the forked workers instead of being pickled for every job
+    shared_tables = [ dataset.data.table for dataset in datasets ]
+    try:
+        dataset = schedule.with_format("arrow").map(gather_rows,
+                                                    batched=True,
+                                                    batch_size=10000,
+                                                    writer_batch_size=10000,
+                                                    remove_columns=schedule.column_names,
+                                                    features=features,
+                                                    fn_kwargs={ "source_schema": source_schema, "schema": schema,
+                                                                "source_names": source_names, "source_column": source_column },
+                                                    cache_file_name=path.join(directory, f"mixture-{key}.arrow"),
+                                                    new_fingerprint=key,
+                                                    num_proc=num_proc if len(schedule) > 0 else None,
+                                                    desc="Interleaving").with_format(None)
+    finally:
+        shared_tables = None
+
+    total = max(int(counts.sum()), 1)
+    for i, name in enumerate(names):
+        used = f"{counts[i] / lengths[i]:.2f} epochs" if lengths[i] > 0 else "empty"
+        log_info(f"\t{name:<40} {counts[i]} of {lengths[i]} rows ({counts[i] / total * 100:.2f}%, {used})")
+    return dataset
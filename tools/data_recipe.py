@@ -6,6 +6,9 @@ from pydantic import BaseModel
 from pydantic_core import from_json
 
 type DataRecipeSourceType = Literal["source", "recipe"]
+type DataRecipeStoppingStrategy = Literal["first_exhausted", "all_exhausted"]
+type DataRecipeOutputFormat = Literal["arrow", "parquet", "jsonl"]
+type DataRecipeCompression = Literal["zstd", "snappy", "gzip", "none"]
 
 class DataRecipeOperationConfig(BaseModel):
     name: str
@@ -14,12 +17,25 @@ class DataRecipeOperationConfig(BaseModel):
 class DataRecipeSourceConfig(BaseModel):
     type: Optional[DataRecipeSourceType] = "source"
     probability: Optional[float] = 1.0
+    epochs: Optional[float] = 1.0
     operations: Optional[list[DataRecipeOperationConfig]] = [ ]
 
+class DataRecipeOutputConfig(BaseModel):
+    format: Optional[DataRecipeOutputFormat] = "arrow"
+    max_shard_size: Optional[int | str] = "500MB"
+    compression: Optional[DataRecipeCompression] = "zstd"
+    row_group_size: Optional[int] = 10000
+
 class DataRecipeConfig(BaseModel):
     sources: dict[str, DataRecipeSourceConfig] | list[str]
     final_operations: Optional[list[DataRecipeOperationConfig]] = [ ]
     test_split_ratio: float = 0.0
+    splits: Optional[dict[str, float]] = None
+    split_columns: Optional[list[str]] = None
+    source_column: Optional[str] = None
+    total_rows: Optional[int] = None
+    stopping_strategy: Optional[DataRecipeStoppingStrategy] = "first_exhausted"
+    output: Optional[DataRecipeOutputConfig] = DataRecipeOutputConfig()
 
 class DataRecipe:
     def __init__(self, json_path: str):
@@ -27,6 +43,7 @@ class DataRecipe:
         self.sources: dict[str, DataRecipeSourceConfig] = { }
         self.built_dataset: Dataset | DatasetDict = None
         self.built_directory = ""
+        self.fingerprint = ""
         self.built = False
         self.building = False
         self.modified = False
@@ -37,6 +54,15 @@ class DataRecipe:
             self.config = DataRecipeConfig.model_validate_json(f.read().decode("utf-8"))
         self.modification_time = path.getmtime(json_path)
 
+        # Share of the rows that goes to each split, empty if the output isn't split
+        self.splits: dict[str, float] = { }
+        if self.config.splits is not None:
+            if any(ratio < 0 for ratio in self.config.splits.values()) or sum(self.config.splits.values()) <= 0:
+                raise ValueError(f"Invalid split ratios in recipe '{self.name}'")
+            self.splits = self.config.splits
+        elif self.config.test_split_ratio > 0:
+            self.splits = { "train": 1 - self.config.test_split_ratio, "test": self.config.test_split_ratio }
+
         if isinstance(self.config.sources, dict):
             for source_name, source_config in self.config.sources.items():
                 self.sources[source_name] = source_config
@@ -1,11 +1,120 @@
+import os
 import os.path as path
-from multiprocessing import cpu_count
-from datasets import Dataset, DatasetDict, load_dataset
+import json
+import hashlib
+from multiprocessing import cpu_count, get_context
+from datasets import Dataset, DatasetDict, IterableDataset, IterableDatasetDict, concatenate_datasets, load_dataset
+from datasets.table import InMemoryTable
 from typing import Literal, Optional
 from pydantic import BaseModel, model_validator
 from pydantic_core import from_json
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.json as pjson
+import pyarrow.parquet as pq
+from stage_cache import fingerprint
+from warm_cache import warm_cache
+from common import *
 
-type DataSourceType = Literal["hf_hub", "hf_disk", "parquet", "csv"]
+type DataSourceType = Literal["hf_hub", "hf_disk", "parquet", "csv", "jsonl"]
+
+# Files of a source_path that csv and jsonl sources read, compressed files are decompressed while converting
+source_extensions = {
+    "csv": (".csv", ".csv.gz", ".csv.bz2"),
+    "jsonl": (".jsonl", ".json", ".jsonl.gz", ".json.gz", ".jsonl.bz2", ".json.bz2"),
+}
+
+# Where csv and jsonl files are converted to Arrow, set by the builder.
+# Without one, files are converted to a .arrow directory next to the source's config.
+arrow_cache_directory: Optional[str] = None
+
+def configure_arrow_cache(directory: str):
+    global arrow_cache_directory
+    arrow_cache_directory = directory
+
+def file_checksum(file: str) -> str:
+    hasher = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(1 << 20):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def write_arrow(file: str, source_type: str, arrow_path: str) -> int:
+    """Parse a csv or jsonl file into an Arrow file. Returns the number of rows written."""
+    if source_type == "csv":
+        try:
+            # Stream the file a block at a time, so it never has to fit in memory
+            reader = pcsv.open_csv(file)
+            num_rows = 0
+            with pa.OSFile(arrow_path, "wb") as sink, pa.ipc.new_stream(sink, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+                    num_rows += batch.num_rows
+            return num_rows
+        except pa.ArrowInvalid as e:
+            # Types are inferred from the first block, and a later one didn't fit them
+            log_trace(f"Reading {file} in one go: {e}")
+            table = pcsv.read_csv(file)
+    else:
+        table = pjson.read_json(file)
+    with pa.OSFile(arrow_path, "wb") as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return table.num_rows
+
+def convert_file(task: tuple[str, str, str]) -> dict:
+    """Convert a csv or jsonl file to an Arrow file, and record what it was converted from next to it."""
+    file, source_type, arrow_path = task
+    stat = os.stat(file)
+    checksum = file_checksum(file)
+    temp_path = f"{arrow_path}.tmp{os.getpid()}"
+    try:
+        num_rows = write_arrow(file, source_type, temp_path)
+        os.replace(temp_path, arrow_path)
+    finally:
+        if path.exists(temp_path):
+            os.remove(temp_path)
+    info = { "file": path.abspath(file), "source_type": source_type, "size": stat.st_size, "mtime": stat.st_mtime,
+             "sha256": checksum, "num_rows": num_rows, "arrow_size": path.getsize(arrow_path) }
+    write_arrow_info(arrow_path, info)
+    return info
+
+def write_arrow_info(arrow_path: str, info: dict):
+    temp_path = f"{arrow_path}.tmp{os.getpid()}.json"
+    with open(temp_path, "w") as f:
+        json.dump(info, f, indent=4)
+    os.replace(temp_path, arrow_path[:-len(".arrow")] + ".json")
+
+def evict_arrow_cache():
+    """Remove the converted files whose csv or jsonl file doesn't exist anymore."""
+    if arrow_cache_directory is None or not path.isdir(arrow_cache_directory):
+        return
+    for file in os.listdir(arrow_cache_directory):
+        if not file.endswith(".json") or ".tmp" in file:
+            continue
+        info_path = path.join(arrow_cache_directory, file)
+        try:
+            with open(info_path, "rb") as f:
+                source_file = json.loads(f.read())["file"]
+        except (FileNotFoundError, ValueError, KeyError):
+            continue
+        if not path.exists(source_file):
+            for removed in (info_path, info_path[:-len(".json")] + ".arrow"):
+                if path.exists(removed):
+                    os.remove(removed)
+            log_trace(f"Evicted the Arrow conversion of {source_file}")
+
+def concatenate_splits(dataset: Dataset | DatasetDict | IterableDataset | IterableDatasetDict) -> Dataset | IterableDataset:
+    """Merge the splits of a dataset into one.
+
+    Splits without an indices mapping are only referenced by the merged dataset, nothing is copied.
+    """
+    if not isinstance(dataset, (DatasetDict, IterableDatasetDict)):
+        return dataset
+    splits = list(dataset.values())
+    if len(splits) == 1:
+        return splits[0]
+    return concatenate_datasets(splits)
 
 class DataSourceConfig(BaseModel):
     source_type: DataSourceType
@@ -22,40 +131,184 @@ class DataSourceConfig(BaseModel):
 class DataSource:
     def __init__(self, json_path: str):
         self.name, extension = path.splitext(path.basename(json_path))
+        self.json_path = json_path
         with open(json_path, "rb") as f:
             self.config = DataSourceConfig.model_validate_json(f.read().decode("utf-8"))
         self.source_path = self.config.source_path
 
-        if self.config.source_type != "hf_hub":
+        if self.config.source_type != "hf_hub" and self.source_path != "":
             if self.source_path.startswith("./") | self.source_path.startswith("../"):
                 self.source_path = path.join(path.dirname(json_path), self.source_path)
             if not path.isdir(self.source_path):
                 raise FileNotFoundError(f"\"{self.source_path}\" is not a valid directory.")
-        
-        # Load the actual dataset
+
+    def files(self) -> list[str]:
+        """Paths of the files the source reads from, empty for hub datasets."""
+        if self.config.source_type == "hf_hub":
+            return [ ]
+        if len(self.config.source_files) > 0:
+            return sorted(self.config.source_files)
+        return sorted(path.join(root, file) for root, _, names in os.walk(self.source_path) for file in names)
+
+    def data_files(self) -> list[str]:
+        """Files a csv or jsonl source reads rows from: its source_files,
+        or the files of its source_path with a matching extension."""
+        if len(self.config.source_files) > 0:
+            return self.files()
+        return [ file for file in self.files() if file.endswith(source_extensions[self.config.source_type]) ]
+
+    def fingerprint(self) -> str:
+        """Fingerprint the source's configuration and the files it reads from,
+        without loading the dataset itself."""
+        files = [ ]
+        for file in self.files():
+            try:
+                stat = os.stat(file)
+                files.append((file, stat.st_size, stat.st_mtime))
+            except FileNotFoundError:
+                files.append((file, None, None))
+        return fingerprint("source", self.config.model_dump(), files)
+
+    @property
+    def dataset(self) -> Dataset | DatasetDict:
+        """The whole dataset. Sources are only loaded on first access."""
+        return self.load()
+
+    def load(self, columns: Optional[set[str]] = None, filter: Optional[pc.Expression] = None) -> Dataset | DatasetDict:
+        """Load the source, reading only the given columns and skipping rows that don't match filter
+        where the source type allows it. Rows that don't match filter may still be returned.
+        """
+        key = ("source", self.name, tuple(sorted(columns)) if columns is not None else None, str(filter) if filter is not None else None)
+        return warm_cache.get(key, lambda: self.load_dataset(columns, filter))
+
+    def load_files(self, files: list[str], columns: Optional[set[str]] = None, filter: Optional[pc.Expression] = None) -> Dataset | DatasetDict:
+        """Load only some of the source's files, like load() does for all of them."""
+        if self.config.source_type not in ("parquet", "csv", "jsonl"):
+            raise ValueError(f"Can't load individual files of {self.config.source_type} source '{self.name}'")
+        return self.load_dataset(columns, filter, files)
+
+    def load_dataset(self, columns: Optional[set[str]], filter: Optional[pc.Expression], data_files: Optional[list[str]] = None) -> Dataset | DatasetDict:
         num_proc = min(cpu_count(), 8)
+        if data_files is not None:
+            files = { "data_files": data_files }
+        elif len(self.config.source_files) > 0:
+            files = { "data_files": self.config.source_files }
+        else:
+            files = { "data_dir": self.source_path }
         match self.config.source_type:
             case "hf_hub":
-                self.dataset = load_dataset(self.source_path, num_proc=num_proc)
+                dataset = load_dataset(self.source_path, num_proc=num_proc)
             case "hf_disk":
-                self.dataset = Dataset.load_from_disk(self.source_path)
+                dataset = Dataset.load_from_disk(self.source_path)
+            case "parquet":
+                if columns is not None:
+                    # Keep the order of the columns in the files
+                    first_file = next((file for file in self.files() if file.endswith(".parquet")), None)
+                    if first_file is None:
+                        raise FileNotFoundError(f"No parquet files in source '{self.name}'")
+                    schema = pq.read_schema(first_file)
+                    columns = [column for column in schema.names if column in columns]
+                    log_trace(f"Reading columns {columns} of {self.name}")
+                if filter is not None:
+                    log_trace(f"Reading rows of {self.name} matching {filter}")
+                return load_dataset("parquet",
+                                    name=self.name,
+                                    columns=columns,
+                                    filters=filter,
+                                    num_proc=num_proc,
+                                    **files)
+            case "csv" | "jsonl":
+                return self.load_arrow(data_files if data_files is not None else self.data_files(), columns)
+        if columns is not None:
+            column_names = dataset.column_names
+            if isinstance(column_names, dict):
+                column_names = next(iter(column_names.values()))
+            dataset = dataset.select_columns([column for column in column_names if column in columns])
+        return dataset
+
+    def arrow_path(self, file: str) -> str:
+        """Where a csv or jsonl file of the source is converted to."""
+        directory = arrow_cache_directory or path.join(path.dirname(self.json_path), ".arrow")
+        os.makedirs(directory, exist_ok=True)
+        return path.join(directory, fingerprint("arrow", path.abspath(file), self.config.source_type) + ".arrow")
+
+    def cached_arrow_file(self, file: str) -> Optional[str]:
+        """The Arrow file a csv or jsonl file was converted to, None if it changed since or was never converted.
+
+        A file whose size and modification time are unchanged is trusted. If only its modification
+        time changed, its checksum decides whether the conversion can still be used.
+        """
+        arrow_path = self.arrow_path(file)
+        try:
+            with open(arrow_path[:-len(".arrow")] + ".json", "rb") as f:
+                info = json.loads(f.read())
+            if path.getsize(arrow_path) != info["arrow_size"]:
+                return None
+            stat = os.stat(file)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        if stat.st_size != info["size"]:
+            return None
+        if stat.st_mtime != info["mtime"]:
+            if file_checksum(file) != info["sha256"]:
+                return None
+            log_trace(f"{file} was touched but its contents are unchanged")
+            write_arrow_info(arrow_path, { **info, "mtime": stat.st_mtime })
+        return arrow_path
+
+    def arrow_files(self, files: list[str]) -> list[str]:
+        """Arrow files holding the rows of csv or jsonl files, converting the files that aren't cached yet."""
+        arrow_paths = [ self.cached_arrow_file(file) for file in files ]
+        tasks = [ (file, self.config.source_type, self.arrow_path(file))
+                  for file, arrow_path in zip(files, arrow_paths) if arrow_path is None ]
+        if len(tasks) > 0:
+            log_info(f"Converting {len(tasks)} {self.config.source_type} files of {self.name} to Arrow...")
+            if len(tasks) == 1:
+                infos = [ convert_file(tasks[0]) ]
+            else:
+                with get_context("fork").Pool(min(num_proc, len(tasks))) as pool:
+                    infos = pool.map(convert_file, tasks)
+            log_trace(f"Converted {sum(info['num_rows'] for info in infos)} rows of {self.name}")
+            converted = iter(task[2] for task in tasks)
+            arrow_paths = [ arrow_path if arrow_path is not None else next(converted) for arrow_path in arrow_paths ]
+        return arrow_paths
+
+    def load_arrow(self, files: list[str], columns: Optional[set[str]]) -> Dataset:
+        """Memory-map the Arrow conversions of csv or jsonl files as a single dataset."""
+        if len(files) == 0:
+            raise FileNotFoundError(f"No {self.config.source_type} files in source '{self.name}'")
+        datasets = [ Dataset.from_file(arrow_path) for arrow_path in self.arrow_files(files) ]
+        if columns is not None:
+            datasets = [ dataset.select_columns([ column for column in dataset.column_names if column in columns ]) for dataset in datasets ]
+        schemas = [ dataset.data.schema.remove_metadata() for dataset in datasets ]
+        if any(schema != schemas[0] for schema in schemas):
+            if any(set(schema.names) != set(schemas[0].names) for schema in schemas):
+                raise ValueError(f"Files of source '{self.name}' don't all have the same columns")
+            # Types are inferred per file, only the files that disagree are cast, in memory
+            schema = pa.unify_schemas(schemas, promote_options="permissive")
+            log_trace(f"Casting files of {self.name} to {schema}")
+            datasets = [ dataset if dataset.data.schema.remove_metadata() == schema
+                         else Dataset(InMemoryTable(dataset.data.table.select(schema.names).cast(schema)))
+                         for dataset in datasets ]
+        return concatenate_datasets(datasets) if len(datasets) > 1 else datasets[0]
+
+    def stream(self) -> IterableDataset | IterableDatasetDict:
+        """Open the source as a stream of rows instead of loading it."""
+        match self.config.source_type:
+            case "hf_hub":
+                return load_dataset(self.source_path, streaming=True)
+            case "hf_disk":
+                dataset = Dataset.load_from_disk(self.source_path)
+                return dataset.to_iterable_dataset(num_shards=len(dataset.cache_files) or 1)
             case "parquet":
                 if len(self.config.source_files) > 0:
-                    self.dataset = load_dataset("parquet", 
-                                            name=self.name,
-                                            data_files=self.config.source_files, 
-                                            num_proc=num_proc
-                                            )
-                else:
-                    self.dataset = load_dataset("parquet", 
-                                            name=self.name,
-                                            data_dir=self.source_path, 
-                                            num_proc=num_proc
-                                            )
-            case "csv":
-                if len(self.config.source_files) > 0:
-                    raise NotImplementedError()
-                self.dataset = load_dataset("csv",
-                                            name=self.name,
-                                            data_dir=self.source_path,
-                                            num_proc=num_proc)
\ No newline at end of file
+                    return load_dataset("parquet",
+                                        data_files=self.config.source_files,
+                                        streaming=True)
+                return load_dataset("parquet",
+                                    data_dir=self.source_path,
+                                    streaming=True)
+            case "csv" | "jsonl":
+                # Streams from the memory-mapped conversions, which later builds reuse
+                dataset = self.load_arrow(self.data_files(), None)
+                return dataset.to_iterable_dataset(num_shards=len(dataset.cache_files) or 1)
@@ -0,0 +1,70 @@
+from typing import Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Odd multiplier used to combine hashes of several values
+combine_multiplier = np.uint64(0x100000001B3)
+
+def hash_key(seed: int, salt: str) -> str:
+    """16 character key for pandas' SipHash, derived from a seed."""
+    return f"{salt[:4]:<4}{seed % 10**12:012d}"
+
+def hash_array(array: pa.Array | pa.ChunkedArray, key: str) -> np.ndarray:
+    """Hash every value of an Arrow array into a uint64 with vectorized SipHash.
+
+    Strings, numbers and booleans are supported, as well as lists and structs of them,
+    nested any number of times. Other types are hashed from their string representation.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    if pa.types.is_fixed_size_list(array.type):
+        array = array.cast(pa.list_(array.type.value_field))
+    if pa.types.is_list(array.type) or pa.types.is_large_list(array.type):
+        offsets = array.offsets.to_numpy()
+        offsets = offsets - offsets[0]
+        values = hash_array(array.flatten(), key)
+        # Mix in each value's position so reordered lists hash differently
+        positions = np.arange(len(values), dtype=np.uint64) - np.repeat(offsets[:-1], np.diff(offsets)).astype(np.uint64)
+        values = values * (positions * np.uint64(2) + np.uint64(1))
+        sums = np.concatenate([ np.zeros(1, dtype=np.uint64), np.cumsum(values, dtype=np.uint64) ])
+        hashes = sums[offsets[1:]] - sums[offsets[:-1]]
+        return hashes * combine_multiplier ^ np.diff(offsets).astype(np.uint64)
+    if pa.types.is_struct(array.type):
+        # Combine the hashes of the fields in order, with their names so renamed fields hash differently
+        names = pd.util.hash_array(np.array([ field.name for field in array.type ], dtype=object), hash_key=key, categorize=False)
+        hashes = np.zeros(len(array), dtype=np.uint64)
+        for name, field in zip(names, array.flatten()):
+            hashes = hashes * combine_multiplier ^ hash_array(field, key) ^ name
+        # Null structs hash differently from structs of nulls
+        return hashes ^ (~array.is_valid().to_numpy(zero_copy_only=False)).astype(np.uint64)
+    if not (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)
+            or pa.types.is_integer(array.type) or pa.types.is_floating(array.type) or pa.types.is_boolean(array.type)):
+        try:
+            array = pc.cast(array, pa.string())
+        except (pa.ArrowNotImplementedError, pa.ArrowInvalid):
+            array = pa.array([ None if value is None else repr(value) for value in array.to_pylist() ], pa.string())
+    return pd.util.hash_array(array.to_numpy(zero_copy_only=False), hash_key=key, categorize=False)
+
+def hash_columns(table: pa.Table, columns: list[str], seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Hash the given columns of every row of a table into a 128 bit hash, split in two uint64 arrays."""
+    high = np.zeros(len(table), dtype=np.uint64)
+    low = np.zeros(len(table), dtype=np.uint64)
+    for column in columns:
+        high = high * combine_multiplier ^ hash_array(table[column], hash_key(seed, "high"))
+        low = low * combine_multiplier ^ hash_array(table[column], hash_key(seed, "low"))
+    return high, low
+
+def assign_splits(table: pa.Table, ratios: list[float], columns: Optional[list[str]] = None, seed: int = 0) -> np.ndarray:
+    """Assign every row of a table to a split from a hash of its columns (all of them by default).
+
+    Returns the index of each row's split. A row always gets the same split,
+    whichever batch or build it is part of.
+    """
+    high, _ = hash_columns(table, columns if columns is not None else sorted(table.column_names), seed)
+    positions = (high >> np.uint64(11)).astype(np.float64) / 2**53
+    bounds = np.cumsum(ratios) / np.sum(ratios)
+    return np.minimum(np.searchsorted(bounds, positions, side="right"), len(ratios) - 1).astype(np.int8)
@@ -0,0 +1,200 @@
+import os
+import os.path as path
+import json
+import shutil
+from itertools import count
+from time import time, time_ns
+from typing import Optional
+import numpy as np
+import pyarrow as pa
+from hashing import hash_columns
+from stage_cache import fingerprint
+from common import *
+
+# Where model outputs are cached and how large the cache can grow, set by the builder.
+# A size of 0 disables the cache.
+cache_directory: Optional[str] = None
+cache_max_size: int = 0
+
+# Segments smaller than this are merged together once an operation is done with them
+compact_rows = 1_000_000
+
+segment_numbers = count()
+
+def configure_inference_cache(directory: str, max_size: int):
+    global cache_directory, cache_max_size
+    cache_directory = directory
+    cache_max_size = max_size
+
+def text_hashes(texts: list[str] | pa.Array) -> tuple[np.ndarray, np.ndarray]:
+    """128 bit hash of every text, split in two uint64 arrays."""
+    return hash_columns(pa.table({ "text": pa.array(texts, pa.large_string()) if isinstance(texts, list) else texts }), [ "text" ])
+
+class InferenceCache:
+    """Persistent cache of the outputs a model gave for texts, shared by every recipe and build.
+
+    Each model configuration gets its own directory of segments. A segment is a pair of .npy
+    files: the hashes of its texts sorted by their high half, and the output for each of them.
+    Segments are memory-mapped and looked up a whole batch at a time with a binary search.
+    Every batch adds a segment for the texts that missed, so worker processes never write to
+    the same file, and small segments are merged by compact() once the operation is done.
+    Once the cache grows past its size limit, the least recently used segments are removed.
+    """
+
+    def __init__(self, directory: str, num_outputs: int):
+        self.directory = directory
+        self.num_outputs = num_outputs
+        self.segments: Optional[list[tuple[str, np.ndarray, np.ndarray]]] = None
+        self.touched: set[str] = set()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def open(namespace: list, num_outputs: int) -> Optional["InferenceCache"]:
+        """Open the cache of a model configuration, None if caching is disabled."""
+        if cache_directory is None or cache_max_size == 0:
+            return None
+        return InferenceCache(path.join(cache_directory, fingerprint("inference", namespace)), num_outputs)
+
+    def __getstate__(self) -> dict:
+        # Workers map the segments themselves instead of receiving a copy
+        return { **self.__dict__, "segments": None, "touched": set() }
+
+    def load_segments(self):
+        self.segments = [ ]
+        for file in sorted(os.listdir(self.directory)):
+            if not file.endswith(".keys.npy"):
+                continue
+            name = file[:-len(".keys.npy")]
+            try:
+                keys = np.load(path.join(self.directory, file), mmap_mode="r")
+                values = np.load(path.join(self.directory, name + ".values.npy"), mmap_mode="r")
+            except (FileNotFoundError, ValueError):
+                # Removed by another process since it was listed
+                continue
+            self.segments.append((name, keys, values))
+        # Search the largest segments first, they're the most likely to hold a text
+        self.segments.sort(key=lambda segment: -segment[1].shape[1])
+
+    def lookup(self, high: np.ndarray, low: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Find the cached output of every text hash. Returns which ones were found, and the outputs."""
+        if self.segments is None:
+            self.load_segments()
+        found = np.zeros(len(high), dtype=bool)
+        outputs = np.zeros((len(high), self.num_outputs), dtype=np.float32)
+        for name, keys, values in self.segments:
+            missing = np.nonzero(~found)[0]
+            if len(missing) == 0:
+                break
+            positions = np.minimum(np.searchsorted(keys[0], high[missing]), keys.shape[1] - 1)
+            hits = (keys[0][positions] == high[missing]) & (keys[1][positions] == low[missing])
+            if not hits.any():
+                continue
+            outputs[missing[hits]] = values[positions[hits]]
+            found[missing[hits]] = True
+            if name not in self.touched:
+                self.touched.add(name)
+                self.touch(name)
+        return found, outputs
+
+    def add(self, high: np.ndarray, low: np.ndarray, outputs: np.ndarray):
+        """Add a segment with the outputs of some texts."""
+        if len(high) == 0:
+            return
+        order = np.argsort(high, kind="stable")
+        name = f"{time_ns():020d}-{os.getpid()}-{next(segment_numbers)}"
+        self.write_segment(name, np.stack([ high[order], low[order] ]), np.asarray(outputs, dtype=np.float32)[order])
+
+    def write_segment(self, name: str, keys: np.ndarray, values: np.ndarray):
+        # Keys are written last, segments are only read once their keys exist
+        for suffix, array in ((".values.npy", values), (".keys.npy", keys)):
+            temp_path = path.join(self.directory, f"{name}.tmp{os.getpid()}{suffix}")
+            np.save(temp_path, array)
+            os.replace(temp_path, path.join(self.directory, name + suffix))
+
+    def touch(self, name: str):
+        try:
+            os.utime(path.join(self.directory, name + ".keys.npy"))
+        except FileNotFoundError:
+            pass
+
+    def compact(self):
+        """Merge the small segments into one, keeping a single output for every text."""
+        self.load_segments()
+        small = [ segment for segment in self.segments if segment[1].shape[1] < compact_rows ]
+        if len(small) < 2:
+            return
+        keys = np.concatenate([ keys for _, keys, _ in small ], axis=1)
+        values = np.concatenate([ values for _, _, values in small ])
+        order = np.lexsort((keys[1], keys[0]))
+        keys, values = keys[:, order], values[order]
+        unique = np.ones(keys.shape[1], dtype=bool)
+        unique[1:] = (keys[0][1:] != keys[0][:-1]) | (keys[1][1:] != keys[1][:-1])
+        self.write_segment(f"{time_ns():020d}-{os.getpid()}-{next(segment_numbers)}", keys[:, unique], values[unique])
+        for name, _, _ in small:
+            for suffix in (".keys.npy", ".values.npy"):
+                try:
+                    os.remove(path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+        self.segments = None
+        log_trace(f"Merged {len(small)} segments of {self.directory} into one of {int(unique.sum())} rows")
+
+    def record(self, hits: int, misses: int):
+        """Add the hits and misses of a run to the statistics kept next to the segments, and log them."""
+        stats_json = path.join(self.directory, "stats.json")
+        stats = { "hits": 0, "misses": 0 }
+        if path.isfile(stats_json):
+            with open(stats_json, "rb") as f:
+                stats = json.loads(f.read())
+        stats["hits"] += hits
+        stats["misses"] += misses
+        stats["updated"] = time()
+        with open(stats_json, "w") as f:
+            json.dump(stats, f, indent=4)
+        total = max(hits + misses, 1)
+        lifetime_total = max(stats["hits"] + stats["misses"], 1)
+        log_info(f"Inference cache: {hits} of {hits + misses} rows reused ({hits / total * 100:.2f}%), "
+                 f"{stats['hits'] / lifetime_total * 100:.2f}% over every build")
+
+def evict_inference_cache():
+    """Remove the least recently used segments of every model until the cache fits in its size limit."""
+    if cache_directory is None or cache_max_size == 0 or not path.isdir(cache_directory):
+        return
+    segments = [ ]
+    total_size = 0
+    for namespace in os.listdir(cache_directory):
+        directory = path.join(cache_directory, namespace)
+        if not path.isdir(directory):
+            continue
+        for file in os.listdir(directory):
+            if ".tmp" in file:
+                # Leftovers of an interrupted write
+                if path.getmtime(path.join(directory, file)) < time() - 3600:
+                    os.remove(path.join(directory, file))
+                continue
+            if not file.endswith(".keys.npy"):
+                continue
+            name = file[:-len(".keys.npy")]
+            keys_path = path.join(directory, file)
+            try:
+                size = path.getsize(keys_path) + path.getsize(path.join(directory, name + ".values.npy"))
+                segments.append((path.getmtime(keys_path), directory, name, size))
+            except FileNotFoundError:
+                # Merged by another process since it was listed
+                continue
+            total_size += size
+
+    segments.sort()
+    for _, directory, name, size in segments:
+        if total_size <= cache_max_size:
+            break
+        for suffix in (".keys.npy", ".values.npy"):
+            try:
+                os.remove(path.join(directory, name + suffix))
+            except FileNotFoundError:
+                pass
+        total_size -= size
+        log_trace(f"Evicted inference cache segment {name} ({size} bytes)")
+    for directory in { directory for _, directory, _, _ in segments }:
+        if not any(file.endswith(".npy") for file in os.listdir(directory)):
+            shutil.rmtree(directory, ignore_errors=True)
@@ -1,20 +1,59 @@
-from datasets import Dataset, DatasetDict
-from typing import Type
+from datasets import Dataset, DatasetDict, IterableDataset
+from typing import Optional, Type
+from glob import glob
 from common import *
+import os.path as path
+import importlib
+import ast
+import pyarrow.compute as pc
 
 class Operation:
+    # Whether the output of this operation is worth storing in the stage cache.
+    # Operations that only touch metadata are cheaper to redo than to save.
+    cacheable = True
+    # Whether each output row only depends on a single input row, so new rows
+    # can be run through the operation on their own and appended to an earlier build.
+    row_independent = False
+
     def __init__(self, name: str):
         self.name = name
 
     def __call__(self, dataset: Dataset | DatasetDict, **kwargs) -> Dataset | DatasetDict:
         raise NotImplementedError
 
+    def required_columns(self, output_columns: Optional[set[str]], **kwargs) -> Optional[set[str]]:
+        """Columns of the input needed to produce the given columns of the output.
+        None stands for every column. By default, operations need every column.
+        """
+        return None
+
+    def pushdown_filter(self, **kwargs) -> Optional[pc.Expression]:
+        """Row filter this operation applies that sources can use to skip rows while loading.
+        Only used when nothing else runs before this operation.
+        """
+        return None
+
     def trace(self, object):
         log_trace(f"{self.__class__.__name__}: {object}")
 
+    @staticmethod
+    def map(dataset: Dataset | IterableDataset, function, **kwargs) -> Dataset | IterableDataset:
+        """Call dataset.map(), dropping the arguments that streamed datasets don't support."""
+        if isinstance(dataset, IterableDataset):
+            for key in ("num_proc", "desc", "load_from_cache_file"):
+                kwargs.pop(key, None)
+            if kwargs.pop("with_rank", False):
+                function = lambda x, f=function: f(x, None)
+        return dataset.map(function, **kwargs)
+
     @staticmethod
     def create(operation_name: str) -> "Operation":
         op_class = Operation.registered_operations.get(operation_name)
+        if op_class is None and operation_name in Operation.discovered_operations:
+            module_name, _ = Operation.discovered_operations[operation_name]
+            log_trace(f"Importing {module_name} for operation '{operation_name}'")
+            importlib.import_module(module_name)
+            op_class = Operation.registered_operations.get(operation_name)
         if op_class is None:
             raise ValueError(f"Invalid operation '{operation_name}'")
         return op_class(operation_name)
@@ -24,7 +63,42 @@ class Operation:
         Operation.registered_operations[name] = cls
         log_trace(f"Registered operation '{name}'")
 
+    @staticmethod
+    def discover(directory: str, package: str):
+        """Find the operations registered by the modules in a directory without importing them.
+
+        Modules are parsed for module-level Class.register("name") calls, and only
+        imported once one of their operations is created.
+        """
+        for script in sorted(glob(path.join(directory, "*.py"))):
+            module_name = path.basename(script)[:-3]
+            if module_name.startswith("_"):
+                continue
+            with open(script, "rb") as f:
+                tree = ast.parse(f.read(), script)
+            docstrings = { node.name: ast.get_docstring(node) or "" for node in tree.body if isinstance(node, ast.ClassDef) }
+            for node in tree.body:
+                if not isinstance(node, ast.Expr) or not isinstance(node.value, ast.Call):
+                    continue
+                call = node.value
+                if not isinstance(call.func, ast.Attribute) or call.func.attr != "register" or not isinstance(call.func.value, ast.Name):
+                    continue
+                if len(call.args) != 1 or not isinstance(call.args[0], ast.Constant):
+                    continue
+                Operation.discovered_operations[call.args[0].value] = (f"{package}.{module_name}", docstrings.get(call.func.value.id, ""))
+                log_trace(f"Discovered operation '{call.args[0].value}' in {module_name}")
+
+    @staticmethod
+    def available_operations() -> dict[str, str]:
+        """Names and docstrings of every registered or discovered operation."""
+        operations = { name: docstring for name, (_, docstring) in Operation.discovered_operations.items() }
+        for name, op_class in Operation.registered_operations.items():
+            operations[name] = op_class.__doc__ or ""
+        return dict(sorted(operations.items()))
+
     registered_operations: dict[str, Type["Operation"]] = { }
+    # Operations that weren't imported yet, mapped to their module and docstring
+    discovered_operations: dict[str, tuple[str, str]] = { }
 
 class RemapOperation(Operation):
     """Rename or remove columns from the data source.
@@ -34,6 +108,8 @@ class RemapOperation(Operation):
                Columns mapped to a blank ("") destination name are removed from the dataset.
     remove_others -- If true, all columns that aren't explicitly mapped will be removed. (Default: false)
     """
+    cacheable = False
+    row_independent = True
 
     def __call__(self, dataset: Dataset | DatasetDict, **kwargs) -> Dataset | DatasetDict:
         mappings: dict[str, str] = kwargs.get("columns", { })
@@ -45,10 +121,23 @@ class RemapOperation(Operation):
         if len(removed) > 0:
             dataset = dataset.remove_columns(removed)
         
-        dataset = dataset.rename_columns(mappings)
+        renames = {k: v for k, v in mappings.items() if k != v}
+        if len(renames) > 0:
+            dataset = dataset.rename_columns(renames)
         self.trace(f"{columns_before} => {dataset.column_names}")
         return dataset
 
+    def required_columns(self, output_columns: Optional[set[str]], **kwargs) -> Optional[set[str]]:
+        mappings: dict[str, str] = kwargs.get("columns", { })
+        kept = {k: v for k, v in mappings.items() if v != ""}
+        # Renamed columns must exist even if nothing uses them afterwards
+        if kwargs.get("remove_others", False):
+            return set(kept.keys())
+        if output_columns is None:
+            return None
+        renamed = {v: k for k, v in kept.items()}
+        return {renamed.get(column, column) for column in output_columns} | set(kept.keys())
+
     @staticmethod
     def filter_removals(src_column: str, column_mappings: dict[str, str], remove_others: bool):
         dst = column_mappings.get(src_column)
@@ -1,47 +1,162 @@
 from operation import *
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from warm_cache import warm_cache
+from inference_cache import *
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
 from pydantic import BaseModel
 from typing import Literal, Optional
+import numpy as np
 import torch
+import os
+
+type ClassifyTextDevice = Literal["auto", "cuda", "cpu"]
+type ClassifyTextDtype = Literal["auto", "bfloat16", "float16", "float32"]
 
 class ClassifyTextArgs(BaseModel):
     model: str
     text_column: str
     labels: list[str]
-    batch_size: Optional[int] = 256
+    batch_size: Optional[int] = 1024
+    max_batch_tokens: Optional[int] = 32768
     max_sequence_length: Optional[int] = 0
+    device: Optional[ClassifyTextDevice] = "auto"
+    dtype: Optional[ClassifyTextDtype] = "auto"
+    num_proc: Optional[int] = 1
+    use_cache: Optional[bool] = True
 
 class ClassifyTextOperation(Operation):
+    """Classify a text column with a sequence classification model.
+
+    Keyword arguments:
+    model -- HF hub name or path of the classifier.
+    text_column -- Column containing the text to classify.
+    labels -- Names of the columns the score of each class is written to.
+    batch_size -- Number of rows sorted by length together. (Default: 1024)
+    max_batch_tokens -- Maximum number of padded tokens in each batch passed to the model. (Default: 32768)
+    max_sequence_length -- Texts are truncated to this many tokens. (Default: max_position_embeddings)
+    device -- "cuda", "cpu" or "auto" to use cuda when available. (Default: "auto")
+    dtype -- Model weight type, "auto" uses bfloat16 on cuda and float32 on cpu. (Default: "auto")
+    num_proc -- Number of processes classifying on the cpu, each with its own model and cores. (Default: 1)
+    use_cache -- If true, scores are kept in the inference cache and texts the model already scored
+                 with the same labels and max_sequence_length aren't classified again. (Default: true)
+    """
+    row_independent = True
+
     def __call__(self, dataset: Dataset | DatasetDict, **kwargs) -> Dataset | DatasetDict:
         self.args = ClassifyTextArgs(**kwargs)
-        self.trace(f"Loading classifier model from {self.args.model}...")
-        self.model = AutoModelForSequenceClassification.from_pretrained(self.args.model, torch_dtype=torch.bfloat16)
-        self.tokenizer = AutoTokenizer.from_pretrained(self.args.model)
-
-        self.device = "cuda"
-        self.model.to(self.device)
+        self.device = self.args.device
+        if self.device == "auto":
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        num_proc = self.args.num_proc
+        if self.device == "cuda" and num_proc > 1:
+            self.trace("num_proc is only used when classifying on the cpu")
+            num_proc = 1
+        self.threads = max(1, (os.cpu_count() or 1) // num_proc)
 
+        # Workers load their own copy of the model, and only once a batch misses the inference cache
+        self.model = None
+        self.tokenizer = warm_cache.get(("tokenizer", self.args.model), lambda: AutoTokenizer.from_pretrained(self.args.model))
         if self.args.max_sequence_length == 0:
-            self.args.max_sequence_length = self.model.config.max_position_embeddings
-        
-        with torch.no_grad():
-            dataset = dataset.map(lambda x: self.batched_classify(x), 
-                                  load_from_cache_file=False, 
-                                  batched=True,
-                                  batch_size=self.args.batch_size,
-                                  desc="Classifying " + self.args.text_column)
+            config = warm_cache.get(("config", self.args.model), lambda: AutoConfig.from_pretrained(self.args.model))
+            self.args.max_sequence_length = config.max_position_embeddings
+        self.dtype = self.args.dtype
+        if self.dtype == "auto":
+            self.dtype = "bfloat16" if self.device == "cuda" else "float32"
+        self.cache = None
+        if self.args.use_cache:
+            self.cache = InferenceCache.open([ "classify_text", self.args.model, self.args.labels, self.args.max_sequence_length, self.dtype ],
+                                             len(self.args.labels))
+
+        dataset = self.map(dataset, lambda x, rank: self.batched_classify(x, rank),
+                           load_from_cache_file=False,
+                           batched=True,
+                           batch_size=self.args.batch_size,
+                           with_rank=True,
+                           num_proc=num_proc if num_proc > 1 else None,
+                           desc="Classifying " + self.args.text_column)
+        if self.cache is not None and isinstance(dataset, Dataset):
+            hits = pc.sum(dataset.data.column("__cache_hit")).as_py() or 0
+            self.cache.record(hits, len(dataset) - hits)
+            self.cache.compact()
+            evict_inference_cache()
+        if self.cache is not None:
+            dataset = dataset.remove_columns("__cache_hit")
         return dataset
-    
-    def batched_classify(self, examples):
-        tokens = self.tokenizer(examples[self.args.text_column], 
-                                    padding="max_length", 
-                                    max_length=self.args.max_sequence_length, 
-                                    truncation=True,
-                                    return_tensors="pt").to(self.device)
-        output = self.model(**tokens).logits.to("cpu")
-        if output.shape[1] > 1:
-            output = output.softmax(1)
-        output = output.transpose(0, 1)
-        return { label: output[i] for i, label in enumerate(self.args.labels) }
-
-ClassifyTextOperation.register("classify_text")
\ No newline at end of file
+
+    def required_columns(self, output_columns: Optional[set[str]], **kwargs) -> Optional[set[str]]:
+        if output_columns is None:
+            return None
+        args = ClassifyTextArgs(**kwargs)
+        return (output_columns - set(args.labels)) | { args.text_column }
+
+    def load_model(self, rank: Optional[int]):
+        """Load the model in the current process and pin it to its share of the cpu cores."""
+        if self.model is not None:
+            return
+        if self.device == "cpu":
+            if rank is not None and hasattr(os, "sched_setaffinity"):
+                cores = sorted(os.sched_getaffinity(0))
+                first = (rank * self.threads) % len(cores)
+                os.sched_setaffinity(0, cores[first:first + self.threads])
+            torch.set_num_threads(self.threads)
+
+        def load() -> torch.nn.Module:
+            self.trace(f"Loading classifier model from {self.args.model}...")
+            model = AutoModelForSequenceClassification.from_pretrained(self.args.model, torch_dtype=getattr(torch, self.dtype))
+            model.to(self.device)
+            model.eval()
+            return model
+        self.model = warm_cache.get(("model", self.args.model, self.device, self.dtype), load)
+
+    def batched_classify(self, examples, rank: Optional[int]):
+        """Score a batch of texts, only running the model on those missing from the inference cache."""
+        texts = examples[self.args.text_column]
+        if self.cache is None:
+            scores = self.classify(texts, rank)
+            return { label: scores[:, i] for i, label in enumerate(self.args.labels) }
+
+        high, low = text_hashes(texts)
+        found, scores = self.cache.lookup(high, low)
+        missing = np.nonzero(~found)[0]
+        if len(missing) > 0:
+            scores[missing] = self.classify([ texts[i] for i in missing ], rank)
+            self.cache.add(high[missing], low[missing], scores[missing])
+        return { "__cache_hit": found, **{ label: scores[:, i] for i, label in enumerate(self.args.labels) } }
+
+    @torch.inference_mode()
+    def classify(self, texts: list[str], rank: Optional[int]) -> np.ndarray:
+        """Score of every label for each text."""
+        self.load_model(rank)
+        encoded = self.tokenizer(texts,
+                                 max_length=self.args.max_sequence_length,
+                                 truncation=True)
+        lengths = np.array([len(ids) for ids in encoded["input_ids"]], dtype=np.int64)
+
+        # Classify rows of similar length together, padded only as far as the longest of the batch
+        order = np.argsort(lengths, kind="stable")
+        scores = torch.empty((len(lengths), len(self.args.labels)), dtype=torch.float32)
+        for start, end in self.token_batches(lengths[order]):
+            rows = order[start:end]
+            batch = { }
+            for key, values in encoded.items():
+                padding = self.tokenizer.pad_token_id if key == "input_ids" else 0
+                padded = torch.full((len(rows), lengths[rows[-1]]), padding, dtype=torch.long)
+                for i, row in enumerate(rows):
+                    padded[i, :lengths[row]] = torch.tensor(values[row])
+                batch[key] = padded.to(self.device)
+            output = self.model(**batch).logits.float().to("cpu")
+            if output.shape[1] > 1:
+                output = output.softmax(1)
+            scores[torch.from_numpy(rows)] = output
+        return scores.numpy()
+
+    def token_batches(self, sorted_lengths: np.ndarray):
+        """Split rows sorted by length into batches of at most max_batch_tokens padded tokens."""
+        start = 0
+        for end in range(1, len(sorted_lengths) + 1):
+            if end - start > 1 and (end - start) * sorted_lengths[end - 1] > self.args.max_batch_tokens:
+                yield start, end - 1
+                start = end - 1
+        if start < len(sorted_lengths):
+            yield start, len(sorted_lengths)
+
+ClassifyTextOperation.register("classify_text")
@@ -0,0 +1,217 @@
+from operation import *
+from hashing import *
+from pydantic import BaseModel
+from typing import Literal, Optional
+from multiprocessing import get_context
+import os.path as path
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+type DeduplicateMethod = Literal["exact", "minhash"]
+
+class DeduplicateArgs(BaseModel):
+    columns: list[str]
+    method: Optional[DeduplicateMethod] = "exact"
+    num_perm: Optional[int] = 128
+    bands: Optional[int] = 16
+    ngram: Optional[int] = 5
+    num_shards: Optional[int] = 16
+    batch_size: Optional[int] = 10000
+    report_column: Optional[str] = None
+    seed: Optional[int] = 0
+
+mersenne_prime = np.uint64((1 << 61) - 1)
+max_hash = np.uint64((1 << 32) - 1)
+
+# Key columns of the dataset being deduplicated, inherited by forked workers
+shared_keys: pa.Table = None
+
+def find_duplicates(task: tuple[list[str], int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """Find the rows of one shard of the key space whose key was already used by an earlier row.
+
+    Only the rows whose first key column falls in the shard are kept in memory.
+    Returns the duplicate rows and the first row with the same key for each of them.
+    """
+    columns, shard, num_shards = task
+    rows = [ ]
+    keys = [ [ ] for _ in columns ]
+    offset = 0
+    for batch in shared_keys.to_batches():
+        selected = np.nonzero(batch.column(columns[0]).to_numpy() % np.uint64(num_shards) == shard)[0]
+        rows.append(selected + offset)
+        for i, column in enumerate(columns):
+            keys[i].append(batch.column(column).to_numpy()[selected])
+        offset += len(batch)
+    if len(rows) == 0:
+        # The dataset had no rows, so there were no batches
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows = np.concatenate(rows)
+    keys = [ np.concatenate(k) for k in keys ]
+    if len(rows) == 0:
+        return rows, rows
+
+    order = np.lexsort([ rows ] + keys[::-1])
+    rows = rows[order]
+    keys = [ k[order] for k in keys ]
+    new_group = np.ones(len(rows), dtype=bool)
+    new_group[1:] = np.any([ k[1:] != k[:-1] for k in keys ], axis=0)
+    first_rows = rows[new_group][np.cumsum(new_group) - 1]
+    return rows[~new_group], first_rows[~new_group]
+
+def connected_rows(edges_from: np.ndarray, edges_to: np.ndarray) -> np.ndarray:
+    """Group rows connected by duplicate edges, and return every row that isn't the first of its group."""
+    nodes = np.unique(np.concatenate([ edges_from, edges_to ]))
+    edges_from = np.searchsorted(nodes, edges_from)
+    edges_to = np.searchsorted(nodes, edges_to)
+    # Propagate the smallest row of each group along the edges until nothing changes
+    labels = np.arange(len(nodes))
+    while True:
+        updated = labels.copy()
+        np.minimum.at(updated, edges_from, labels[edges_to])
+        np.minimum.at(updated, edges_to, labels[edges_from])
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    return nodes[labels != np.arange(len(nodes))]
+
+class DeduplicateOperation(Operation):
+    """Remove rows that are exact or near duplicates of an earlier row.
+
+    Keyword arguments:
+    columns -- Columns compared between rows. minhash only supports a single text column.
+    method -- "exact" compares a 128 bit hash of the columns, "minhash" finds near duplicates
+              with MinHash and locality sensitive hashing. (Default: "exact")
+    num_perm -- Number of MinHash permutations. (Default: 128)
+    bands -- Number of LSH bands, more bands find less similar duplicates. (Default: 16)
+    ngram -- Number of words in each MinHash shingle. (Default: 5)
+    num_shards -- Number of parts the keys are split into, bounding the memory used by each process. (Default: 16)
+    report_column -- If set, the number of removed rows is reported for each value of this column.
+    seed -- Seed of the hashes. (Default: 0)
+    """
+
+    def __call__(self, dataset: Dataset | DatasetDict, **kwargs) -> Dataset | DatasetDict:
+        global shared_keys
+        self.args = DeduplicateArgs(**kwargs)
+        if isinstance(dataset, IterableDataset):
+            raise ValueError("deduplicate can't run on streamed datasets")
+        if self.args.method == "minhash":
+            if len(self.args.columns) != 1:
+                raise ValueError("minhash deduplication only supports a single column")
+            if self.args.num_perm % self.args.bands != 0:
+                raise ValueError("num_perm must be a multiple of bands")
+            generator = np.random.default_rng(self.args.seed)
+            self.permutations_a = generator.integers(1, mersenne_prime, self.args.num_perm, dtype=np.uint64)
+            self.permutations_b = generator.integers(0, mersenne_prime, self.args.num_perm, dtype=np.uint64)
+            key_columns = [ [ f"__band_{i}" ] for i in range(self.args.bands) ]
+            hash_function = self.batched_signatures
+        else:
+            key_columns = [ [ "__hash_high", "__hash_low" ] ]
+            hash_function = self.batched_hashes
+
+        num_rows = len(dataset)
+        if num_rows == 0:
+            # Earlier operations may have removed every row
+            self.report(dataset, np.zeros(0, dtype=np.int64))
+            return dataset
+        format_type = dataset.format["type"]
+        keys = self.map(dataset.with_format("arrow"), lambda table: hash_function(table),
+                        batched=True,
+                        batch_size=self.args.batch_size,
+                        remove_columns=dataset.column_names,
+                        num_proc=num_proc,
+                        desc="Hashing")
+
+        tasks = [ (columns, shard, self.args.num_shards) for columns in key_columns for shard in range(self.args.num_shards) ]
+        shared_keys = keys.with_format("arrow").data.table
+        edges_from = [ np.zeros(0, dtype=np.int64) ]
+        edges_to = [ np.zeros(0, dtype=np.int64) ]
+        try:
+            with get_context("fork").Pool(min(num_proc, len(tasks))) as pool:
+                for duplicates, first_rows in pool.imap_unordered(find_duplicates, tasks):
+                    edges_from.append(duplicates)
+                    edges_to.append(first_rows)
+        finally:
+            shared_keys = None
+        removed = connected_rows(np.concatenate(edges_from), np.concatenate(edges_to))
+
+        self.report(dataset, removed)
+        if len(removed) == 0:
+            return dataset
+
+        keep = np.ones(num_rows, dtype=bool)
+        keep[removed] = False
+        with tempfile.TemporaryDirectory() as directory:
+            # Workers memory-map the mask instead of each receiving a copy
+            mask_path = path.join(directory, "keep.npy")
+            np.save(mask_path, keep)
+            dataset = self.map(dataset.with_format("arrow"), lambda table, indices: self.batched_keep(table, indices, mask_path),
+                               batched=True,
+                               with_indices=True,
+                               batch_size=self.args.batch_size,
+                               num_proc=num_proc,
+                               desc="Removing duplicates").with_format(format_type)
+        return dataset
+
+    def required_columns(self, output_columns: Optional[set[str]], **kwargs) -> Optional[set[str]]:
+        if output_columns is None:
+            return None
+        return output_columns | set(DeduplicateArgs(**kwargs).columns)
+
+    def report(self, dataset: Dataset, removed: np.ndarray):
+        log_info(f"Deduplication removed {len(removed)} of {len(dataset)} rows ({len(removed) / max(len(dataset), 1) * 100:.2f}%)")
+        if self.args.report_column is None or len(removed) == 0:
+            return
+        column = dataset.select_columns([ self.args.report_column ]).with_format("arrow")[removed][self.args.report_column]
+        counts = pc.value_counts(column).to_pylist()
+        for count in sorted(counts, key=lambda x: -x["counts"]):
+            log_info(f"\t{str(count['values']):<40} {count['counts']} rows removed")
+
+    def batched_hashes(self, table: pa.Table) -> pa.Table:
+        high, low = hash_columns(table, self.args.columns, self.args.seed)
+        return pa.table({ "__hash_high": high, "__hash_low": low })
+
+    def batched_signatures(self, table: pa.Table) -> pa.Table:
+        """Compute the LSH band hashes of each row's MinHash signature."""
+        words = pc.utf8_split_whitespace(table[self.args.columns[0]].combine_chunks())
+        offsets = words.offsets.to_numpy()
+        offsets = offsets - offsets[0]
+        word_hashes = hash_array(words.flatten(), hash_key(self.args.seed, "word"))
+
+        # Hash every run of ngram words, documents shorter than that get a single shingle
+        lengths = np.diff(offsets)
+        shingle_counts = np.where(lengths > 0, np.maximum(lengths - self.args.ngram + 1, 1), 0)
+        shingle_offsets = np.concatenate([ [ 0 ], np.cumsum(shingle_counts) ])
+        ends = np.repeat(offsets[1:], shingle_counts)
+        starts = np.repeat(offsets[:-1], shingle_counts) + np.arange(shingle_offsets[-1]) - np.repeat(shingle_offsets[:-1], shingle_counts)
+        shingles = np.zeros(len(starts), dtype=np.uint64)
+        for k in range(self.args.ngram):
+            valid = starts + k < ends
+            shingles = np.where(valid, shingles * combine_multiplier ^ word_hashes[np.minimum(starts + k, len(word_hashes) - 1)], shingles)
+        shingles = shingles >> np.uint64(32)
+
+        signatures = np.full((len(table), self.args.num_perm), max_hash, dtype=np.uint64)
+        non_empty = shingle_counts > 0
+        if len(shingles) > 0:
+            for i in range(self.args.num_perm):
+                values = (self.permutations_a[i] * shingles + self.permutations_b[i]) % mersenne_prime & max_hash
+                signatures[non_empty, i] = np.minimum.reduceat(values, shingle_offsets[:-1][non_empty])
+
+        rows = self.args.num_perm // self.args.bands
+        bands = { }
+        for band in range(self.args.bands):
+            band_hash = np.zeros(len(table), dtype=np.uint64)
+            for i in range(band * rows, (band + 1) * rows):
+                band_hash = band_hash * combine_multiplier ^ signatures[:, i]
+            bands[f"__band_{band}"] = band_hash
+        return pa.table(bands)
+
+    def batched_keep(self, table: pa.Table, indices: list[int], mask_path: str) -> pa.Table:
+        if len(indices) == 0:
+            return table
+        keep = np.load(mask_path, mmap_mode="r")[indices[0]:indices[-1] + 1]
+        return table.filter(pa.array(np.asarray(keep)))
+
+DeduplicateOperation.register("deduplicate")
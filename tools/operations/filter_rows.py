@@ -0,0 +1,119 @@
+from operation import *
+from pydantic import BaseModel
+from typing import Any, Optional
+import pyarrow as pa
+import pyarrow.compute as pc
+import numpy as np
+
+class FilterArgs(BaseModel):
+    where: dict[str, Any]
+    batch_size: Optional[int] = 10000
+
+comparisons = {
+    "==": lambda x, y: x == y,
+    "!=": lambda x, y: x != y,
+    "<": lambda x, y: x < y,
+    "<=": lambda x, y: x <= y,
+    ">": lambda x, y: x > y,
+    ">=": lambda x, y: x >= y,
+    "in": lambda x, y: x.isin(y),
+}
+
+def compile_condition(condition: dict[str, Any]) -> pc.Expression:
+    """Turn a declarative filter condition into an Arrow compute expression."""
+    if "and" in condition or "or" in condition:
+        combine = "and" if "and" in condition else "or"
+        expressions = [ compile_condition(c) for c in condition[combine] ]
+        if len(expressions) == 0:
+            raise ValueError(f"Empty '{combine}' in filter condition")
+        result = expressions[0]
+        for expression in expressions[1:]:
+            result = (result & expression) if combine == "and" else (result | expression)
+        return result
+    if "not" in condition:
+        return ~compile_condition(condition["not"])
+    if "is_null" in condition:
+        return pc.field(condition["is_null"]).is_null()
+    if "regex" in condition:
+        return pc.match_substring_regex(pc.field(condition["regex"]), condition["pattern"],
+                                        ignore_case=condition.get("ignore_case", False))
+
+    if "column" in condition:
+        value = pc.field(condition["column"])
+    elif "length" in condition:
+        value = pc.utf8_length(pc.field(condition["length"]))
+    elif "list_length" in condition:
+        value = pc.list_value_length(pc.field(condition["list_length"]))
+    else:
+        raise ValueError(f"Invalid filter condition {condition}")
+    compare = comparisons.get(condition.get("op", ""))
+    if compare is None:
+        raise ValueError(f"Invalid comparison '{condition.get('op')}' in filter condition {condition}")
+    return compare(value, condition["value"])
+
+def condition_columns(condition: dict[str, Any]) -> set[str]:
+    """Columns referenced by a filter condition."""
+    columns = set()
+    for key, value in condition.items():
+        if key in ("and", "or"):
+            for c in value:
+                columns |= condition_columns(c)
+        elif key == "not":
+            columns |= condition_columns(value)
+        elif key in ("column", "length", "list_length", "is_null", "regex"):
+            columns.add(value)
+    return columns
+
+class FilterOperation(Operation):
+    """Keep only the rows matching a condition, evaluated with vectorized Arrow compute.
+
+    Keyword arguments:
+    where -- Condition rows must match. Conditions are objects of one of these forms:
+             {"column": name, "op": op, "value": value}      Compare a column, op is one of ==, !=, <, <=, >, >=, in
+             {"length": name, "op": op, "value": value}      Compare the number of characters of a string column
+             {"list_length": name, "op": op, "value": value} Compare the number of items of a list column
+             {"regex": name, "pattern": regex}               Match a string column against a regex (optional "ignore_case")
+             {"is_null": name}                               Check if a column is null
+             {"and": [conditions]}, {"or": [conditions]}, {"not": condition}
+    batch_size -- Number of rows evaluated at once by each process. (Default: 10000)
+    """
+    row_independent = True
+
+    def __call__(self, dataset: Dataset | DatasetDict, **kwargs) -> Dataset | DatasetDict:
+        self.args = FilterArgs(**kwargs)
+        self.expression = compile_condition(self.args.where)
+        self.trace(f"Filtering with {self.expression}")
+
+        if isinstance(dataset, IterableDataset):
+            # Streamed batches arrive as python objects, they still get evaluated as one table
+            return dataset.filter(lambda batch: self.mask(pa.table(batch)),
+                                  batched=True,
+                                  batch_size=self.args.batch_size)
+
+        rows_before = len(dataset)
+        format_type = dataset.format["type"]
+        # Batches are filtered into a new contiguous table rather than an indices mapping
+        dataset = self.map(dataset.with_format("arrow"), lambda table: table.filter(self.expression),
+                           batched=True,
+                           batch_size=self.args.batch_size,
+                           num_proc=num_proc,
+                           desc="Filtering").with_format(format_type)
+        self.trace(f"Kept {len(dataset)} of {rows_before} rows")
+        return dataset
+
+    def mask(self, table: pa.Table) -> np.ndarray:
+        """Evaluate the condition on a table into a boolean mask."""
+        kept = table.append_column("__row", pa.array(np.arange(len(table)))).filter(self.expression)["__row"]
+        mask = np.zeros(len(table), dtype=bool)
+        mask[kept.to_numpy()] = True
+        return mask
+
+    def required_columns(self, output_columns: Optional[set[str]], **kwargs) -> Optional[set[str]]:
+        if output_columns is None:
+            return None
+        return output_columns | condition_columns(FilterArgs(**kwargs).where)
+
+    def pushdown_filter(self, **kwargs) -> Optional[pc.Expression]:
+        return compile_condition(FilterArgs(**kwargs).where)
+
+FilterOperation.register("filter")
@@ -1,7 +1,12 @@
 from operation import *
+from warm_cache import warm_cache
 from transformers import AutoTokenizer, AutoConfig
 from pydantic import BaseModel
 from typing import Literal, Optional
+from itertools import chain
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 
 type TokenizeSplitType = Literal["paragraph", "sentence"]
 
@@ -10,31 +15,132 @@ class TokenizeTextArgs(BaseModel):
     text_column: str
     split_type: Optional[TokenizeSplitType] = "paragraph"
     max_sequence_length: Optional[int] = 0
+    packing: Optional[bool] = False
+    separator_token: Optional[str] = None
 
 class TokenizeTextOperation(Operation):
+    """Tokenize a text column into input_ids and attention_mask columns.
+
+    Keyword arguments:
+    model -- HF hub name or path of the tokenizer.
+    text_column -- Column containing the text to tokenize, removed from the output.
+    max_sequence_length -- Maximum number of tokens per row. (Default: max_position_embeddings)
+    packing -- If true, documents are concatenated and cut into blocks of exactly max_sequence_length tokens
+               instead of being truncated. The tokens left after the last full block are dropped.
+               All other columns are removed. (Default: false)
+    separator_token -- Token inserted between packed documents. (Default: the eos or sep token)
+    """
+    row_independent = True
+
     def __call__(self, dataset: Dataset | DatasetDict, **kwargs) -> Dataset | DatasetDict:
         self.args = TokenizeTextArgs(**kwargs)
         self.trace(f"Loading tokenizer from {self.args.model}...")
-        self.config = AutoConfig.from_pretrained(self.args.model)
-        self.tokenizer = AutoTokenizer.from_pretrained(self.args.model)
-        self.total_tokens = 0
+        self.config = warm_cache.get(("config", self.args.model), lambda: AutoConfig.from_pretrained(self.args.model))
+        self.tokenizer = warm_cache.get(("tokenizer", self.args.model), lambda: AutoTokenizer.from_pretrained(self.args.model))
 
         if self.args.max_sequence_length == 0:
             self.args.max_sequence_length = self.config.max_position_embeddings
-        dataset = dataset.map(lambda x: self.batched_tokenize(x), 
-                              batched=True,
-                              remove_columns=self.args.text_column, 
-                              desc="Tokenizing")
-        self.trace(f"Encoded {self.total_tokens} tokens")
+        if self.args.packing:
+            separator = self.args.separator_token or self.tokenizer.eos_token or self.tokenizer.sep_token
+            if separator is None:
+                raise ValueError(f"Tokenizer {self.args.model} has no eos or sep token to separate packed documents, set separator_token")
+            self.separator_id = self.tokenizer.convert_tokens_to_ids(separator)
+            # Unknown tokens are converted to the unk token instead of failing
+            if self.separator_id is None or (self.separator_id == self.tokenizer.unk_token_id and separator != self.tokenizer.unk_token):
+                raise ValueError(f"Separator token '{separator}' isn't in the vocabulary of {self.args.model}")
+            dataset = self.pack(dataset)
+        else:
+            dataset = self.map(dataset, lambda x: self.batched_tokenize(x),
+                               batched=True,
+                               num_proc=num_proc,
+                               remove_columns=self.args.text_column,
+                               desc="Tokenizing")
+
+        if isinstance(dataset, Dataset):
+            total_tokens = pc.sum(pc.list_value_length(dataset.data.column("input_ids"))).as_py() or 0
+            self.trace(f"Encoded {total_tokens} tokens in {len(dataset)} sequences")
         return dataset
 
+    def required_columns(self, output_columns: Optional[set[str]], **kwargs) -> Optional[set[str]]:
+        args = TokenizeTextArgs(**kwargs)
+        if args.packing:
+            return { args.text_column }
+        if output_columns is None:
+            return None
+        return (output_columns - { "input_ids", "attention_mask" }) | { args.text_column }
+
     def batched_tokenize(self, examples):
-        tokenized = { "input_ids": [], "attention_mask": [] }
-        for batch in examples[self.args.text_column]:
-            tokens = self.tokenizer(batch, max_length=self.args.max_sequence_length, truncation=True)
-            tokenized["input_ids"].append(tokens["input_ids"])
-            tokenized["attention_mask"].append(tokens["attention_mask"])
-            self.total_tokens += self.args.max_sequence_length
-        return tokenized
-
-TokenizeTextOperation.register("tokenize_text")
\ No newline at end of file
+        tokens = self.tokenizer(examples[self.args.text_column], max_length=self.args.max_sequence_length, truncation=True)
+        return { "input_ids": tokens["input_ids"], "attention_mask": tokens["attention_mask"] }
+
+    def pack(self, dataset: Dataset | DatasetDict | IterableDataset) -> Dataset | DatasetDict | IterableDataset:
+        # Blocks don't line up with the rows they came from
+        if isinstance(dataset, DatasetDict):
+            return DatasetDict({ name: self.pack(split) for name, split in dataset.items() })
+        if isinstance(dataset, IterableDataset):
+            # Streams are mapped in order by a single process, so the tokens left by a batch start the next one
+            self.leftover = [ ]
+            return self.map(dataset, lambda x: self.batched_pack(x),
+                            batched=True,
+                            remove_columns=dataset.column_names)
+
+        documents = self.map(dataset, lambda x: self.batched_encode(x),
+                             batched=True,
+                             num_proc=num_proc,
+                             remove_columns=dataset.column_names,
+                             desc="Tokenizing")
+        global shared_documents, shared_ends
+        # Inherited by the forked workers, every block is cut from the tokens of the documents it spans
+        shared_documents = documents.data.table.column("input_ids")
+        shared_ends = np.cumsum(pc.list_value_length(shared_documents).to_numpy(zero_copy_only=False), dtype=np.int64)
+        try:
+            return documents.with_format("arrow").map(cut_blocks,
+                                                      batched=True,
+                                                      with_indices=True,
+                                                      num_proc=num_proc,
+                                                      fn_kwargs={ "length": self.args.max_sequence_length },
+                                                      remove_columns=documents.column_names,
+                                                      desc="Packing").with_format(None)
+        finally:
+            shared_documents = shared_ends = None
+
+    def batched_encode(self, examples):
+        documents = self.tokenizer(examples[self.args.text_column], add_special_tokens=False)["input_ids"]
+        return { "input_ids": [ document + [ self.separator_id ] for document in documents ] }
+
+    def batched_pack(self, examples):
+        documents = self.tokenizer(examples[self.args.text_column], add_special_tokens=False)["input_ids"]
+        tokens = self.leftover + list(chain.from_iterable(document + [ self.separator_id ] for document in documents))
+        length = self.args.max_sequence_length
+        packed = len(tokens) - len(tokens) % length
+        self.leftover = tokens[packed:]
+        input_ids = [ tokens[i:i + length] for i in range(0, packed, length) ]
+        return { "input_ids": input_ids, "attention_mask": [ [1] * length for _ in input_ids ] }
+
+# Tokens of every document being packed and where each one ends in their concatenation, shared with the workers of pack()
+shared_documents: Optional[pa.ChunkedArray] = None
+shared_ends: Optional[np.ndarray] = None
+
+def cut_blocks(batch: pa.Table, indices: list[int], length: int) -> pa.Table:
+    """Cut the blocks that end within a batch of documents out of the tokens of every document."""
+    token_type = shared_documents.type.value_type
+    first, last = indices[0], indices[-1]
+    start = shared_ends[first - 1] if first > 0 else 0
+    first_block, end_block = int(start // length), int(shared_ends[last] // length)
+    num_blocks = max(end_block - first_block, 0)
+    if num_blocks > 0:
+        token_start = first_block * length
+        first_document = int(np.searchsorted(shared_ends, token_start, side="right"))
+        last_document = int(np.searchsorted(shared_ends, end_block * length - 1, side="right"))
+        document_start = shared_ends[first_document - 1] if first_document > 0 else 0
+        documents = shared_documents.slice(first_document, last_document - first_document + 1).combine_chunks()
+        tokens = documents.flatten().slice(int(token_start - document_start), num_blocks * length)
+    else:
+        tokens = pa.array([ ], token_type)
+    offsets = pa.array(np.arange(num_blocks + 1, dtype=np.int32) * length)
+    return pa.table({
+        "input_ids": pa.ListArray.from_arrays(offsets, tokens.cast(token_type)),
+        "attention_mask": pa.ListArray.from_arrays(offsets, pa.array(np.ones(num_blocks * length, dtype=np.int8))),
+    })
+
+TokenizeTextOperation.register("tokenize_text")
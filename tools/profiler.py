@@ -0,0 +1,211 @@
+import os
+import os.path as path
+import json
+import threading
+from contextlib import contextmanager
+from datasets import Dataset, DatasetDict
+from time import time
+from typing import Any, Optional
+from common import *
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def dataset_size(dataset: Any) -> tuple[Optional[int], Optional[int]]:
+    """Number of rows and bytes of a dataset or a list of datasets, None for streams."""
+    if isinstance(dataset, (DatasetDict, list)):
+        sizes = [ dataset_size(part) for part in (dataset.values() if isinstance(dataset, DatasetDict) else dataset) ]
+        if any(rows is None for rows, _ in sizes):
+            return None, None
+        return sum(rows for rows, _ in sizes), sum(size for _, size in sizes)
+    if not isinstance(dataset, Dataset):
+        return None, None
+    num_bytes = dataset.data.nbytes
+    if dataset._indices is not None and len(dataset.data) > 0:
+        num_bytes = num_bytes * len(dataset) // len(dataset.data)
+    return len(dataset), num_bytes
+
+def peak_rss() -> tuple[Optional[int], Optional[int]]:
+    """Peak resident memory in bytes of this process and of its finished child processes."""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+# Seconds between two samples of the memory used by the stages being profiled
+rss_interval = 0.05
+
+def current_rss() -> tuple[Optional[int], Optional[int]]:
+    """Resident memory in bytes of this process and of its live child processes, None where /proc isn't available."""
+    def statm_rss(pid: str) -> int:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    try:
+        rss = statm_rss("self")
+    except (OSError, ValueError, IndexError):
+        return None, None
+    children_rss = 0
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children", "rb") as f:
+                for pid in f.read().split():
+                    try:
+                        children_rss += statm_rss(pid.decode())
+                    except (OSError, ValueError, IndexError):
+                        # Exited since it was listed
+                        pass
+    except OSError:
+        return rss, None
+    return rss, children_rss
+
+class ProfileStage:
+    """Metrics of one stage of a build. Datasets passed to input() and output() are measured without being read."""
+
+    def __init__(self, recipe: str, name: str, category: str):
+        self.recipe = recipe
+        self.name = name
+        self.category = category
+        self.start = time()
+        self.end = self.start
+        self.rows_in: Optional[int] = None
+        self.bytes_in: Optional[int] = None
+        self.rows_out: Optional[int] = None
+        self.bytes_out: Optional[int] = None
+        self.cache_hit = False
+        # Highest memory sampled while the stage ran, and the memory when it started
+        self.peak_rss: Optional[int] = None
+        self.peak_rss_children: Optional[int] = None
+        self.start_rss: Optional[int] = None
+        self.end_rss: Optional[int] = None
+
+    def sample_rss(self) -> Optional[int]:
+        rss, children_rss = current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+        if children_rss is not None:
+            self.peak_rss_children = max(self.peak_rss_children or 0, children_rss)
+        return rss
+
+    def input(self, dataset: Any):
+        self.rows_in, self.bytes_in = dataset_size(dataset)
+
+    def output(self, dataset: Any, rows: Optional[int] = None):
+        self.rows_out, self.bytes_out = dataset_size(dataset)
+        if rows is not None:
+            self.rows_out = rows
+
+    def report(self) -> dict:
+        seconds = self.end - self.start
+        rows = self.rows_out if self.rows_out is not None else self.rows_in
+        return {
+            "recipe": self.recipe,
+            "stage": self.name,
+            "category": self.category,
+            "start": self.start,
+            "seconds": seconds,
+            "rows_in": self.rows_in,
+            "bytes_in": self.bytes_in,
+            "rows_out": self.rows_out,
+            "bytes_out": self.bytes_out,
+            "rows_per_second": rows / seconds if rows is not None and seconds > 0 else None,
+            "peak_rss": self.peak_rss,
+            "peak_rss_children": self.peak_rss_children,
+            "rss_delta": self.end_rss - self.start_rss if self.start_rss is not None and self.end_rss is not None else None,
+            "cache_hit": self.cache_hit
+        }
+
+class BuildProfiler:
+    """Records the metrics of every stage of the recipes being built.
+
+    When disabled, stages are still handed out but nothing is kept.
+    """
+
+    def __init__(self, enabled: bool = False, chrome_trace: bool = False):
+        self.enabled = enabled or chrome_trace
+        self.chrome_trace = chrome_trace
+        self.recipes: list[str] = [ ]
+        self.stages: list[dict] = [ ]
+        self.start_times: dict[str, float] = { }
+        # Stages running right now, whose memory is sampled in the background
+        self.active: list[ProfileStage] = [ ]
+        self.sampler: Optional[threading.Thread] = None
+        self.stop_sampling: Optional[threading.Event] = None
+
+    def begin_recipe(self, recipe_name: str):
+        """Attribute the stages that follow to a recipe, until end_recipe()."""
+        self.recipes.append(recipe_name)
+        self.start_times[recipe_name] = time()
+
+    def end_recipe(self):
+        self.recipes.pop()
+
+    @contextmanager
+    def stage(self, name: str, category: str):
+        stage = ProfileStage(self.recipes[-1] if len(self.recipes) > 0 else "", name, category)
+        if not self.enabled:
+            yield stage
+            stage.end = time()
+            return
+        stage.start_rss = stage.sample_rss()
+        self.active.append(stage)
+        if self.sampler is None:
+            self.stop_sampling = threading.Event()
+            self.sampler = threading.Thread(target=self.sample, args=(self.stop_sampling,), daemon=True)
+            self.sampler.start()
+        try:
+            yield stage
+        finally:
+            self.active.remove(stage)
+            if len(self.active) == 0:
+                # Nothing is left to sample until the next stage starts
+                self.stop_sampling.set()
+                self.sampler.join()
+                self.sampler = None
+            stage.end = time()
+            stage.end_rss = stage.sample_rss()
+            self.stages.append(stage.report())
+
+    def sample(self, stop: threading.Event):
+        """Sample the memory of every running stage until stop is set."""
+        while not stop.wait(rss_interval):
+            for stage in list(self.active):
+                stage.sample_rss()
+
+    def write(self, recipe_name: str, directory: str, stage_cache_hits: int, stage_cache_misses: int):
+        """Write the report of a recipe's stages to profile.json in its built directory,
+        and to profile.trace.json in the Chrome trace event format if enabled.
+        """
+        if not self.enabled:
+            return
+        stages = [ stage for stage in self.stages if stage["recipe"] == recipe_name ]
+        start = self.start_times.get(recipe_name, time())
+        rss, children_rss = peak_rss()
+        report = {
+            "recipe": recipe_name,
+            "seconds": time() - start,
+            # Highest memory over the life of the process, stages report their own
+            "process_peak_rss": rss,
+            "process_peak_rss_children": children_rss,
+            "stage_cache": { "hits": stage_cache_hits, "misses": stage_cache_misses },
+            "stages": stages
+        }
+        os.makedirs(directory, exist_ok=True)
+        with open(path.join(directory, "profile.json"), "w") as f:
+            json.dump(report, f, indent=4)
+        log_info(f"Wrote build profile to {path.join(directory, 'profile.json')}")
+
+        if self.chrome_trace:
+            events = [ {
+                "name": stage["stage"],
+                "cat": stage["category"],
+                "ph": "X",
+                "ts": (stage["start"] - start) * 1e6,
+                "dur": stage["seconds"] * 1e6,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": { key: value for key, value in stage.items() if key not in ("stage", "category", "start", "seconds") }
+            } for stage in stages ]
+            with open(path.join(directory, "profile.trace.json"), "w") as f:
+                json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, f)
@@ -1,18 +1,52 @@
 from dataclasses import dataclass
-from datasets import Dataset, DatasetDict, interleave_datasets, concatenate_datasets
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import get_context
+from datasets import Dataset, DatasetDict, DatasetInfo, Features, IterableDataset, interleave_datasets, concatenate_datasets
 from data_source import *
 from data_recipe import *
 from operation import *
+from stage_cache import *
+from shard_writer import *
+from data_mixer import *
+from hashing import *
+from profiler import *
+from inference_cache import configure_inference_cache
 from time import time
+from typing import Callable
 from colorama import Fore
 import numpy as np
-import math
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
+import shutil
+
+@dataclass
+class BuildOptions:
+    # Size limit of the stage cache in bytes, 0 disables it
+    cache_size: int = 256 * 1024**3
+    # Number of recipes that can be built at the same time
+    workers: int = 1
+    # Stream sources through the pipeline instead of loading them
+    streaming: bool = False
+    # Number of rows per output shard when streaming
+    shard_rows: int = 100_000
+    # Write a report of every stage's metrics next to each built recipe
+    profile: bool = False
+    # Also write the stages as a Chrome trace
+    chrome_trace: bool = False
+    # Size limit of the cache of model outputs in bytes, 0 disables it
+    inference_cache_size: int = 64 * 1024**3
 
 class RecipeBuilder:
-    def __init__(self, sources_directory: str, recipes_directory: str, output_directory: str):
+    def __init__(self, sources_directory: str, recipes_directory: str, output_directory: str, options: Optional[BuildOptions] = None):
         self.sources_directory = sources_directory
         self.recipes_directory = recipes_directory
         self.output_directory = output_directory
+        self.options = options or BuildOptions()
+        self.stage_cache = StageCache(path.join(output_directory, ".stages"), self.options.cache_size)
+        self.profiler = BuildProfiler(self.options.profile, self.options.chrome_trace)
+        configure_inference_cache(path.join(output_directory, ".inference"), self.options.inference_cache_size)
+        configure_arrow_cache(path.join(output_directory, ".sources"))
         self.loaded_recipes = { }
         self.loaded_sources = { }
 
@@ -22,36 +56,97 @@ class RecipeBuilder:
 
         Returns false if nothing needs to be done.
         """
-        # TODO: Detect circular dependencies
         rebuild = False
         for referenced_name in recipe.references:
             referenced = self.get_recipe(referenced_name)
+            if referenced.built:
+                continue
             if self.load_dependencies(referenced):
                 rebuild = True
-            
-        try:
-            modification_time = 0.0
-            if recipe.config.test_split_ratio > 0:
-                modification_time = path.getmtime(path.join(recipe.built_directory, "dataset_dict.json"))
-            else:
-                modification_time = path.getmtime(path.join(recipe.built_directory, "dataset_info.json"))
-            
-            if recipe.modification_time > modification_time:
-                rebuild = True
-        except FileNotFoundError:
+
+        if not self.is_up_to_date(recipe):
             rebuild = True
-        
+
         if not rebuild:
             log_ok(f"{recipe.built_directory} is up to date.")
             recipe.built = True
-            if recipe.config.test_split_ratio > 0:
-                recipe.built_dataset = DatasetDict.load_from_disk(recipe.built_directory)
-            else:
-                recipe.built_dataset = Dataset.load_from_disk(recipe.built_directory)
+            recipe.built_dataset = load_output(recipe.built_directory)
         recipe.modified = rebuild
         return rebuild
 
+    def is_up_to_date(self, recipe: DataRecipe) -> bool:
+        """Check the fingerprint recorded by the last build of a recipe."""
+        try:
+            with open(path.join(recipe.built_directory, "build.json"), "rb") as f:
+                built_fingerprint = json.loads(f.read())["fingerprint"]
+        except FileNotFoundError:
+            return False
+        return built_fingerprint == self.recipe_fingerprint(recipe)
+
+    def resolve_dependencies(self, recipe_name: str) -> dict[str, list[str]]:
+        """Resolve the graph of recipes that a recipe depends on.
+
+        Returns a map of each recipe to the recipes it references, ordered so that
+        every recipe comes after its dependencies.
+        Raises RecursionError if there are circular dependencies.
+        """
+        graph: dict[str, list[str]] = { }
+        visiting: list[str] = [ ]
+        def visit(name: str):
+            if name in graph:
+                return
+            if name in visiting:
+                cycle = visiting[visiting.index(name):] + [ name ]
+                raise RecursionError(f"Circular dependency between recipes: {' -> '.join(cycle)}")
+            visiting.append(name)
+            recipe = self.get_recipe(name)
+            for referenced_name in recipe.references:
+                visit(referenced_name)
+            visiting.pop()
+            graph[name] = list(recipe.references)
+        visit(recipe_name)
+        return graph
+
     def build(self, recipe_name: str) -> DataRecipe:
+        """Build a recipe and everything it depends on."""
+        graph = self.resolve_dependencies(recipe_name)
+        if self.options.workers > 1:
+            self.build_parallel(graph)
+        return self.build_recipe(recipe_name)
+
+    def build_parallel(self, graph: dict[str, list[str]]):
+        """Build every out of date recipe in the graph on a process pool,
+        starting each one as soon as all of its dependencies are built.
+        """
+        pending: dict[str, set[str]] = { }
+        for name, references in graph.items():
+            if self.is_up_to_date(self.get_recipe(name)):
+                continue
+            pending[name] = set(references)
+        for references in pending.values():
+            references.intersection_update(pending.keys())
+        if len(pending) == 0:
+            return
+
+        workers = min(self.options.workers, len(pending))
+        log_info(f"Building {len(pending)} recipes with {workers} workers...")
+        # Fork so workers don't re-run the CLI script on startup
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("fork")) as pool:
+            running = { }
+            while len(pending) > 0 or len(running) > 0:
+                for name in [name for name, references in pending.items() if len(references) == 0]:
+                    del pending[name]
+                    future = pool.submit(build_worker, self.sources_directory, self.recipes_directory,
+                                         self.output_directory, self.options, name)
+                    running[future] = name
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    future.result()
+                    for references in pending.values():
+                        references.discard(name)
+
+    def build_recipe(self, recipe_name: str) -> DataRecipe:
         recipe = self.get_recipe(recipe_name)
         if recipe.built:
             return recipe
@@ -61,71 +156,460 @@ class RecipeBuilder:
 
         recipe.building = True
         start_time = time()
-        log_info(f"Building recipe '{recipe_name}'...")
+        cache_hits, cache_misses = self.stage_cache.hits, self.stage_cache.misses
+        for referenced_name in recipe.references:
+            self.build_recipe(referenced_name)
+        new_files = self.appendable_files(recipe)
+        if new_files is not None:
+            log_info(f"Appending new files to recipe '{recipe_name}'...")
+        else:
+            log_info(f"Building recipe '{recipe_name}'...")
+        self.profiler.begin_recipe(recipe_name)
 
-        sources: list[str] = [ ]
+        # Save it, the fingerprint is written last so an interrupted save is never considered up to date
+        build_json = path.join(recipe.built_directory, "build.json")
+        if path.isfile(build_json):
+            os.remove(build_json)
+        if new_files is not None:
+            total_rows = self.append(recipe, new_files)
+        elif self.options.streaming:
+            total_rows = self.stream(recipe)
+        else:
+            # Run final operations on the interleaved sources
+            recipe.built_dataset = self.apply_operations(self.interleave_fingerprint(recipe),
+                                                         recipe.config.final_operations,
+                                                         lambda columns, filter: self.interleave(recipe),
+                                                         label=f"'{recipe_name}'")
+            total_rows = len(recipe.built_dataset)
+            self.save(recipe, recipe.built_dataset)
+        with open(build_json, "w") as f:
+            json.dump({ "fingerprint": self.recipe_fingerprint(recipe), "manifest": self.manifest(recipe) }, f, indent=4)
+        recipe.built = True
+        recipe.building = False
+        self.profiler.end_recipe()
+        self.profiler.write(recipe_name, recipe.built_directory,
+                            self.stage_cache.hits - cache_hits, self.stage_cache.misses - cache_misses)
+        if new_files is not None:
+            log_ok(f"Appended {total_rows} rows to '{recipe_name}' in {time() - start_time} seconds")
+        else:
+            log_ok(f"Built '{recipe_name}' in {time() - start_time} seconds ({total_rows} rows)")
+        return recipe
+
+    def manifest(self, recipe: DataRecipe) -> dict:
+        """Record the files a build read from, to tell which ones are new on the next build."""
+        return {
+            "structure": self.structure_fingerprint(recipe),
+            "streaming": self.options.streaming,
+            "sources": { source_name: self.input_files(source_name, source_config) for source_name, source_config in recipe.sources.items() }
+        }
+
+    def appendable_files(self, recipe: DataRecipe) -> Optional[dict[str, list[str]]]:
+        """Find the files added to the sources of a recipe since it was last built, if the
+        new rows can simply be appended to it.
+
+        Returns None if the recipe needs a full rebuild: when it or one of the files it was
+        built from changed, when one of its operations needs to see every row, or when a
+        source has nothing new so the mixture can't be kept.
+        """
+        try:
+            with open(path.join(recipe.built_directory, "build.json"), "rb") as f:
+                manifest = json.loads(f.read()).get("manifest")
+        except FileNotFoundError:
+            return None
+        if manifest is None or manifest["structure"] != self.structure_fingerprint(recipe):
+            return None
+        if self.options.streaming or manifest.get("streaming", False):
+            # Appended rows follow the exact schedule, which a streamed build didn't
+            return None
+        if recipe.config.total_rows is not None:
+            return None
+        operations = [ op_config for source_config in recipe.sources.values() for op_config in source_config.operations ]
+        for op_config in operations + recipe.config.final_operations:
+            if not Operation.create(op_config.name).row_independent:
+                log_trace(f"'{op_config.name}' needs every row, '{recipe.name}' can't be appended to")
+                return None
+
+        new_files: dict[str, list[str]] = { }
+        for source_name, source_config in recipe.sources.items():
+            built_files = manifest["sources"].get(source_name, { })
+            files = self.input_files(source_name, source_config)
+            for file, stat in built_files.items():
+                if files.get(file) != stat:
+                    log_trace(f"{file} changed since '{recipe.name}' was built")
+                    return None
+            new_files[source_name] = [ file for file in files if file not in built_files ]
+            if len(new_files[source_name]) == 0 and source_config.probability > 0:
+                return None
+        return new_files
+
+    def append(self, recipe: DataRecipe, new_files: dict[str, list[str]]) -> int:
+        """Run only the new files of every source through the recipe, mixed with the same
+        probabilities, and add the result to the built recipe as new shards.
+
+        Returns the number of rows appended.
+        """
+        sources = { source_name: source_config for source_name, source_config in recipe.sources.items() if len(new_files[source_name]) > 0 }
         source_datasets: list[Dataset] = [ ]
+        for source_name, source_config in sources.items():
+            files = new_files[source_name]
+            log_info(f"\t{source_name:<40} {len(files)} new files")
+            key = fingerprint("files", self.source_fingerprint(recipe, source_name, source_config), files)
+            dataset = self.apply_operations(key, source_config.operations,
+                                            lambda columns, filter: self.load_files(source_name, source_config, files,
+                                                                                    columns=columns, filter=filter),
+                                            label=f"new files of '{source_name}'")
+            source_datasets.append(dataset)
+
+        append_key = fingerprint("append", self.interleave_fingerprint(recipe), new_files)
+        log_info(f"Distribution of the new rows of {recipe.name}:")
+        with self.profiler.stage("interleave", "interleave") as stage:
+            stage.input(source_datasets)
+            dataset = mix_datasets(source_datasets,
+                                   list(sources.keys()),
+                                   [ source_config.probability for source_config in sources.values() ],
+                                   [ source_config.epochs for source_config in sources.values() ],
+                                   RecipeBuilder.interleave_seed,
+                                   append_key,
+                                   stopping_strategy=recipe.config.stopping_strategy,
+                                   source_column=recipe.config.source_column)
+            stage.output(dataset)
+        dataset = self.apply_operations(append_key, recipe.config.final_operations, lambda columns, filter: dataset,
+                                        label=f"new rows of '{recipe.name}'")
+
+        # New files may have been read with slightly different types
+        split_directory = path.join(recipe.built_directory, next(iter(recipe.splits))) if len(recipe.splits) > 0 else recipe.built_directory
+        features = DatasetInfo.from_directory(split_directory).features
+        if features is not None and features != dataset.features:
+            dataset = dataset.cast(features)
+
+        with self.profiler.stage("save", "save") as stage:
+            stage.input(dataset)
+            writers = self.split_writers(recipe, dataset.features, prefix=f"data-{append_key[:8]}", append=True)
+            for table in dataset.with_format("arrow").iter(batch_size=1000):
+                self.write_splits(recipe, writers, table)
+            total_rows = sum(writer.close() for writer in writers.values())
+            stage.output(None, total_rows)
+            stage.bytes_out = sum(shard["num_bytes"] for writer in writers.values() for shard in writer.shard_infos)
+
+        recipe.built_dataset = load_output(recipe.built_directory)
+        return total_rows
+
+    def interleave(self, recipe: DataRecipe) -> Dataset:
+        """Run every source of the recipe through its operations and mix them together."""
+        interleave_key = self.interleave_fingerprint(recipe)
+        dataset = self.stage_cache.load(interleave_key)
+        if dataset is not None:
+            log_info(f"Reusing cached sources of '{recipe.name}'")
+            with self.profiler.stage("interleave", "interleave") as stage:
+                stage.cache_hit = True
+                stage.output(dataset)
+            return dataset
+
+        source_datasets: list[Dataset] = [ ]
+        for source_name, source_config in recipe.sources.items():
+            dataset = self.apply_operations(self.source_fingerprint(recipe, source_name, source_config),
+                                            source_config.operations,
+                                            lambda columns, filter: self.load_source(recipe, source_name, source_config,
+                                                                                     columns=columns, filter=filter),
+                                            label=f"'{source_name}' of '{recipe.name}'")
+            source_datasets.append(dataset)
+
+        log_info(f"Distribution of {recipe.name} after interleaving:")
+        with self.profiler.stage("interleave", "interleave") as stage:
+            stage.input(source_datasets)
+            dataset = mix_datasets(source_datasets,
+                                   list(recipe.sources.keys()),
+                                   [ source_config.probability for source_config in recipe.sources.values() ],
+                                   [ source_config.epochs for source_config in recipe.sources.values() ],
+                                   RecipeBuilder.interleave_seed,
+                                   interleave_key,
+                                   total_rows=recipe.config.total_rows,
+                                   stopping_strategy=recipe.config.stopping_strategy,
+                                   source_column=recipe.config.source_column)
+            dataset = self.stage_cache.store(interleave_key, dataset, f"{recipe.name} interleave")
+            stage.output(dataset)
+        return dataset
+
+    def save(self, recipe: DataRecipe, dataset: Dataset):
+        """Write the output of a recipe in its output format, split if it has a test split."""
+        if path.isdir(recipe.built_directory):
+            shutil.rmtree(recipe.built_directory)
+        if len(recipe.splits) == 0:
+            with self.profiler.stage("save", "save") as stage:
+                stage.input(dataset)
+                stage.output(None, write_dataset(dataset, recipe.built_directory, recipe.config.output))
+                stage.bytes_out = directory_size(recipe.built_directory)
+            return
+
+        with self.profiler.stage("split", "split") as stage:
+            stage.input(dataset)
+            ratios = list(recipe.splits.values())
+            columns = recipe.config.split_columns
+            keys = dataset.select_columns(columns) if columns is not None else dataset
+            assignments = keys.with_format("arrow").map(lambda table: pa.table({ "split": assign_splits(table, ratios, columns) }),
+                                                        batched=True,
+                                                        remove_columns=keys.column_names,
+                                                        num_proc=num_proc,
+                                                        desc="Splitting")
+            assignments = assignments.data.column("split").to_numpy()
+        # Each split is gathered into contiguous shards of its own
+        for i, split in enumerate(recipe.splits):
+            with self.profiler.stage(f"save {split}", "save") as stage:
+                split_dataset = dataset.select(np.nonzero(assignments == i)[0])
+                stage.input(split_dataset)
+                stage.output(None, write_dataset(split_dataset, path.join(recipe.built_directory, split), recipe.config.output))
+                stage.bytes_out = directory_size(path.join(recipe.built_directory, split))
+        with open(path.join(recipe.built_directory, "dataset_dict.json"), "w") as f:
+            json.dump({ "splits": list(recipe.splits.keys()) }, f)
+
+    def split_writers(self, recipe: DataRecipe, features: Features, prefix: str = "data", append: bool = False) -> dict[str, ShardWriter]:
+        """Open a shard writer for every split of a recipe's output."""
+        if len(recipe.splits) == 0:
+            return { "train": ShardWriter(recipe.built_directory, self.options.shard_rows, features, prefix, append, recipe.config.output) }
+        return { split: ShardWriter(path.join(recipe.built_directory, split), self.options.shard_rows, features, prefix, append, recipe.config.output)
+                 for split in recipe.splits }
+
+    def write_splits(self, recipe: DataRecipe, writers: dict[str, ShardWriter], table: pa.Table):
+        """Write each row of a table to the writer of its split."""
+        if len(recipe.splits) == 0:
+            writers["train"].write(table)
+            return
+        assignments = assign_splits(table, list(recipe.splits.values()), recipe.config.split_columns)
+        for i, split in enumerate(recipe.splits):
+            writers[split].write(table.filter(assignments == i))
+
+    def stream(self, recipe: DataRecipe) -> int:
+        """Build a recipe as a stream of batches, writing fixed-size shards as they are produced
+        so memory and disk use don't grow with the size of the sources.
+
+        Streamed builds bypass the stage cache. Returns the number of rows written.
+        """
+        source_datasets: list[IterableDataset] = [ ]
         source_probabilities: list[float] = [ ]
-        total_rows = 0.0
-        use_probabilities = False
         for source_name, source_config in recipe.sources.items():
-            if source_config.probability != 1: 
-                use_probabilities = True
-            # Resolve referenced source/recipe into a dataset
-            dataset: Dataset
-            if source_config.type == "source":
-                source = self.get_source(source_name)
-                dataset = source.dataset
-                if isinstance(dataset, DatasetDict):
-                    dataset = concatenate_datasets(dataset.values())
-            elif source_config.type == "recipe":
-                if source_name == recipe_name:
-                    raise RecursionError(f"Recipe '{recipe_name}' tried to use itself as a source")
-                dependency = self.build(source_name)
-                dataset = dependency.built_dataset
-                if isinstance(dataset, DatasetDict):
-                    dataset = concatenate_datasets(dataset.values())
-            dataset = self.apply_operations(dataset, source_config.operations)
-            sources.append(source_name)
+            if source_config.epochs != 1:
+                raise ValueError(f"Streaming builds can't upsample '{source_name}', its epochs must be 1")
+            dataset = self.load_source(recipe, source_name, source_config, streaming=True)
+            for op_config in source_config.operations:
+                dataset = Operation.create(op_config.name)(dataset, **op_config.args)
+            if recipe.config.source_column is not None:
+                dataset = self.add_source_column(dataset, recipe.config.source_column, source_name)
             source_datasets.append(dataset)
             source_probabilities.append(source_config.probability)
-            total_rows += len(dataset)
-        
-        # Interleave all the sources based on their probabilities
-        seed = 42
-        if use_probabilities:
-            adjusted_probabilities = np.array(source_probabilities) / np.array(source_probabilities).sum()
-            recipe.built_dataset = interleave_datasets(source_datasets, probabilities=adjusted_probabilities, seed=seed)
-
-            log_info(f"Approximate distribution of {recipe.name} after interleaving:")
-            interleaved_examples = len(recipe.built_dataset)
-            for i, source_name in enumerate(sources):
-                approx_examples = math.floor(adjusted_probabilities[i] * interleaved_examples)
-                approx_percent = (approx_examples / interleaved_examples) * 100
-                log_info(f"\t{source_name:<40} {approx_examples} examples ({approx_percent:.2f}%)")
-        else:
-            recipe.built_dataset = interleave_datasets(source_datasets, seed=seed)
 
-        # Run final operations
-        recipe.built_dataset = self.apply_operations(recipe.built_dataset, recipe.config.final_operations)
+        # Source lengths aren't known upfront, so rows are picked at random as they stream by
+        seed = RecipeBuilder.interleave_seed
+        adjusted_probabilities = np.array(source_probabilities) / np.array(source_probabilities).sum()
+        dataset = interleave_datasets(source_datasets, probabilities=adjusted_probabilities, seed=seed,
+                                      stopping_strategy=recipe.config.stopping_strategy)
+        if recipe.config.total_rows is not None:
+            dataset = dataset.take(recipe.config.total_rows)
+        for op_config in recipe.config.final_operations:
+            dataset = Operation.create(op_config.name)(dataset, **op_config.args)
+
+        # Start from a clean directory so shards of a previous build don't linger
+        if path.isdir(recipe.built_directory):
+            shutil.rmtree(recipe.built_directory)
+        # Every stage runs lazily as the output is written, so they are profiled as one
+        with self.profiler.stage("stream", "save") as stage:
+            writers = self.split_writers(recipe, dataset.features)
+            for table in dataset.with_format("arrow").iter(batch_size=1000):
+                self.write_splits(recipe, writers, table)
+            total_rows = sum(writer.close() for writer in writers.values())
+            stage.output(None, total_rows)
+            stage.bytes_out = sum(shard["num_bytes"] for writer in writers.values() for shard in writer.shard_infos)
 
-        # Save it
-        if recipe.config.test_split_ratio > 0:
-            splits = recipe.built_dataset.train_test_split(test_size=recipe.config.test_split_ratio)
-            splits.save_to_disk(recipe.built_directory)
+        if len(recipe.splits) > 0:
+            with open(path.join(recipe.built_directory, "dataset_dict.json"), "w") as f:
+                json.dump({ "splits": list(writers.keys()) }, f)
+        recipe.built_dataset = load_output(recipe.built_directory)
+        return total_rows
+
+    def load_source(self, recipe: DataRecipe, source_name: str, source_config: DataRecipeSourceConfig, streaming: bool = False,
+                    columns: Optional[set[str]] = None, filter: Optional[pc.Expression] = None) -> Dataset | IterableDataset:
+        """Resolve a referenced source/recipe into a dataset.
+
+        Sources only read the given columns and may skip rows that don't match filter.
+        """
+        dataset: Dataset | IterableDataset
+        if source_config.type == "source":
+            source = self.get_source(source_name)
+            with self.profiler.stage(f"load {source_name}", "load") as stage:
+                dataset = source.stream() if streaming else source.load(columns, filter)
+                stage.output(dataset)
+        elif source_config.type == "recipe":
+            if source_name == recipe.name:
+                raise RecursionError(f"Recipe '{recipe.name}' tried to use itself as a source")
+            with self.profiler.stage(f"load {source_name}", "load") as stage:
+                dependency = self.build_recipe(source_name)
+                stage.output(dependency.built_dataset)
+            dataset = dependency.built_dataset
+            if columns is not None:
+                column_names = dataset.column_names
+                if isinstance(column_names, dict):
+                    column_names = next(iter(column_names.values()))
+                dataset = dataset.select_columns([column for column in column_names if column in columns])
+            if streaming:
+                if isinstance(dataset, DatasetDict):
+                    dataset = DatasetDict({ k: v.to_iterable_dataset(num_shards=len(v.cache_files) or 1) for k, v in dataset.items() })
+                else:
+                    dataset = dataset.to_iterable_dataset(num_shards=len(dataset.cache_files) or 1)
+        return concatenate_splits(dataset)
+
+    def add_source_column(self, dataset: Dataset | IterableDataset, column: str, source_name: str) -> Dataset | IterableDataset:
+        """Add a column holding the name of the source every row came from."""
+        if isinstance(dataset, IterableDataset):
+            return dataset.map(lambda x: { column: source_name })
+        return dataset.with_format("arrow").map(lambda table: table.append_column(column, pa.repeat(source_name, len(table))),
+                                                batched=True,
+                                                num_proc=num_proc,
+                                                desc=f"Adding {column}").with_format(dataset.format["type"])
+
+    def load_files(self, source_name: str, source_config: DataRecipeSourceConfig, files: list[str],
+                   columns: Optional[set[str]] = None, filter: Optional[pc.Expression] = None) -> Dataset:
+        """Load only some of the files of a source, or some of the shards of a built recipe."""
+        with self.profiler.stage(f"load new files of {source_name}", "load") as stage:
+            if source_config.type == "recipe":
+                features = DatasetInfo.from_directory(path.dirname(files[0])).features
+                dataset = load_shards(files, self.get_recipe(source_name).config.output.format, features)
+                if columns is not None:
+                    dataset = dataset.select_columns([ column for column in dataset.column_names if column in columns ])
+            else:
+                dataset = self.get_source(source_name).load_files(files, columns, filter)
+            dataset = concatenate_splits(dataset)
+            stage.output(dataset)
+        return dataset
+
+    def input_files(self, source_name: str, source_config: DataRecipeSourceConfig) -> dict[str, list]:
+        """Size and modification time of every file a recipe source reads from.
+        Recipes used as a source read from the shards of their output.
+        """
+        if source_config.type == "recipe":
+            files = output_files(self.get_recipe(source_name).built_directory)
         else:
-            recipe.built_dataset.save_to_disk(recipe.built_directory)
-        recipe.built = True
-        recipe.building = False
-        log_ok(f"Built '{recipe_name}' in {time() - start_time} seconds ({len(recipe.built_dataset)} rows)")
-        return recipe
+            files = self.get_source(source_name).files()
+        stats = { }
+        for file in files:
+            try:
+                stat = os.stat(file)
+                stats[file] = [ stat.st_size, stat.st_mtime ]
+            except FileNotFoundError:
+                stats[file] = None
+        return stats
 
-    def apply_operations(self, dataset: Dataset | DatasetDict, operations: list[Operation]) -> Dataset | DatasetDict:
-        for op_config in operations:
+    def apply_operations(self, key: str, operations: list[DataRecipeOperationConfig],
+                         load_input: Callable[[Optional[set[str]], Optional[pc.Expression]], Dataset],
+                         label: str = "dataset") -> Dataset:
+        """Apply a chain of operations to the dataset returned by load_input.
+
+        Each stage of the chain is fingerprinted from the one before it, so the chain
+        resumes from the last stage found in the stage cache, and load_input is only
+        called if nothing could be reused. It is passed the columns and row filter
+        that the operations actually need from it. Operations that change the
+        number of rows are logged with the label.
+        """
+        keys = self.operation_fingerprints(key, operations)
+        start = 0
+        dataset = None
+        for i in range(len(operations), 0, -1):
+            dataset = self.stage_cache.load(keys[i])
+            if dataset is not None:
+                log_info(f"Reusing cached output of '{operations[i - 1].name}'")
+                with self.profiler.stage(f"{operations[i - 1].name} on {label}", "operation") as stage:
+                    stage.cache_hit = True
+                    stage.output(dataset)
+                start = i
+                break
+        if dataset is None:
+            columns, filter = self.plan_operations(operations)
+            dataset = load_input(columns, filter)
+
+        for i in range(start, len(operations)):
+            op_config = operations[i]
             op = Operation.create(op_config.name)
-            dataset = op(dataset, **op_config.args)
+            rows_before = len(dataset)
+            with self.profiler.stage(f"{op_config.name} on {label}", "operation") as stage:
+                stage.input(dataset)
+                dataset = op(dataset, **op_config.args)
+                if op.cacheable:
+                    dataset = self.stage_cache.store(keys[i + 1], dataset, op_config.name)
+                stage.output(dataset)
+            if len(dataset) != rows_before:
+                log_info(f"'{op_config.name}' on {label}: {rows_before} -> {len(dataset)} rows")
         return dataset
-    
+
+    def plan_operations(self, operations: list[DataRecipeOperationConfig]) -> tuple[Optional[set[str]], Optional[pc.Expression]]:
+        """Work out which columns of its input a chain of operations reads, and which rows
+        are filtered out before anything else runs, so the rest never has to be loaded.
+
+        Returns the needed columns (None for all of them) and the row filter (None for no filter).
+        """
+        ops = [ (Operation.create(op_config.name), op_config.args) for op_config in operations ]
+        # Walk backwards from the output, which needs every column
+        columns = None
+        for op, args in reversed(ops):
+            columns = op.required_columns(columns, **args)
+
+        # Only filters at the start of the chain see the rows as they are loaded
+        filter = None
+        for op, args in ops:
+            expression = op.pushdown_filter(**args)
+            if expression is None:
+                break
+            filter = expression if filter is None else filter & expression
+        return columns, filter
+
+    def operation_fingerprints(self, key: str, operations: list[DataRecipeOperationConfig]) -> list[str]:
+        """Fingerprint every stage of an operation chain, starting with the input's key.
+
+        The columns and row filter pushed down into the input change what every stage
+        holds, so they're part of every key after the input's.
+        """
+        columns, filter = self.plan_operations(operations)
+        keys = [ key ]
+        if columns is not None or filter is not None:
+            key = fingerprint("pushdown", key, sorted(columns) if columns is not None else None,
+                              str(filter) if filter is not None else None)
+        for op_config in operations:
+            key = fingerprint("operation", key, op_config.name, op_config.args)
+            keys.append(key)
+        return keys
+
+    def source_fingerprint(self, recipe: DataRecipe, source_name: str, source_config: DataRecipeSourceConfig) -> str:
+        if source_config.type == "recipe":
+            return self.recipe_fingerprint(self.get_recipe(source_name))
+        return self.get_source(source_name).fingerprint()
+
+    def interleave_fingerprint(self, recipe: DataRecipe) -> str:
+        source_keys = [ ]
+        for source_name, source_config in recipe.sources.items():
+            source_key = self.source_fingerprint(recipe, source_name, source_config)
+            source_key = self.operation_fingerprints(source_key, source_config.operations)[-1]
+            source_keys.append((source_name, source_key, source_config.probability, source_config.epochs))
+        return fingerprint("mixture", source_keys, RecipeBuilder.interleave_seed, recipe.config.source_column,
+                           recipe.config.total_rows, recipe.config.stopping_strategy)
+
+    def structure_fingerprint(self, recipe: DataRecipe) -> str:
+        """Fingerprint a recipe and everything it depends on, except for the files sources read from."""
+        sources = { }
+        for source_name, source_config in recipe.sources.items():
+            if source_config.type == "recipe":
+                sources[source_name] = self.structure_fingerprint(self.get_recipe(source_name))
+            else:
+                sources[source_name] = self.get_source(source_name).config.model_dump(exclude={ "source_files", "description" })
+        return fingerprint("structure", recipe.config.model_dump(), sources)
+
+    def recipe_fingerprint(self, recipe: DataRecipe) -> str:
+        """Fingerprint everything that goes into a recipe's output,
+        including every source and recipe it depends on.
+        """
+        if recipe.fingerprint == "":
+            final_key = self.operation_fingerprints(self.interleave_fingerprint(recipe), recipe.config.final_operations)[-1]
+            # Streamed builds mix sources at random instead of following the exact schedule, so their output differs
+            mode = [ "streaming" ] if self.options.streaming else [ ]
+            recipe.fingerprint = fingerprint("recipe", final_key, recipe.splits, recipe.config.split_columns, recipe.config.output.model_dump(), *mode)
+        return recipe.fingerprint
+
     def get_source(self, name: str) -> DataSource:
         source = RecipeBuilder.source_cache.get(name)
         if source is not None: return source
@@ -138,8 +622,16 @@ class RecipeBuilder:
         RecipeBuilder.recipe_cache[name] = recipe = DataRecipe(path.join(self.recipes_directory, name + ".json"))
         recipe.built_directory = path.join(self.output_directory, recipe.name)
         return recipe
-    
 
 
+    interleave_seed = 42
     recipe_cache: dict[str, DataRecipe] = { }
-    source_cache: dict[str, DataSource] = { }
\ No newline at end of file
+    source_cache: dict[str, DataSource] = { }
+
+def build_worker(sources_directory: str, recipes_directory: str, output_directory: str, options: BuildOptions, recipe_name: str) -> str:
+    """Build a single recipe inside a worker process. Its dependencies must already be built."""
+    # Recipes cached by an earlier task may have been rebuilt by other workers since
+    RecipeBuilder.recipe_cache.clear()
+    builder = RecipeBuilder(sources_directory, recipes_directory, output_directory, options)
+    builder.build_recipe(recipe_name)
+    return recipe_name
@@ -0,0 +1,272 @@
+import os
+import os.path as path
+import json
+import math
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from multiprocessing import get_context
+from datasets import Dataset, DatasetDict, DatasetInfo, Features, concatenate_datasets, load_dataset
+from datasets.arrow_writer import ArrowWriter
+from datasets.fingerprint import generate_random_fingerprint
+from datasets.utils.py_utils import convert_file_size_to_int
+from data_recipe import DataRecipeOutputConfig
+from typing import Optional
+from common import *
+
+extensions = { "arrow": "arrow", "parquet": "parquet", "jsonl": "jsonl" }
+
+def json_lines(table: pa.Table, batch_size: int = 10_000):
+    """Rows of a table as JSON lines, with floats written at full precision and integers kept as integers.
+    NaN isn't valid JSON and is written as null, values JSON has no type for as strings.
+    """
+    for i, column in enumerate(table.columns):
+        if pa.types.is_floating(column.type):
+            table = table.set_column(i, table.field(i), pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column))
+    for batch in table.to_batches(max_chunksize=batch_size):
+        for row in batch.to_pylist():
+            yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+
+class ShardFile:
+    """A single output shard, written in one of the output formats."""
+
+    def __init__(self, file_path: str, features: Features, output: DataRecipeOutputConfig):
+        self.output = output
+        self.num_rows = 0
+        self.pending: list[pa.Table] = [ ]
+        self.pending_rows = 0
+        match output.format:
+            case "arrow":
+                self.writer = ArrowWriter(features=features, path=file_path)
+            case "parquet":
+                compression = None if output.compression == "none" else output.compression
+                self.writer = pq.ParquetWriter(file_path, features.arrow_schema, compression=compression)
+            case "jsonl":
+                self.writer = open(file_path, "w", encoding="utf-8")
+
+    def write(self, table: pa.Table):
+        self.num_rows += len(table)
+        match self.output.format:
+            case "arrow":
+                self.writer.write_table(table)
+            case "parquet":
+                # Gather small tables so row groups have row_group_size rows
+                self.pending.append(table)
+                self.pending_rows += len(table)
+                if self.pending_rows >= self.output.row_group_size:
+                    self.flush()
+            case "jsonl":
+                self.writer.writelines(json_lines(table))
+
+    def flush(self):
+        if self.pending_rows == 0:
+            return
+        table = pa.concat_tables(self.pending)
+        full_groups = len(table) - len(table) % self.output.row_group_size
+        self.writer.write_table(table.slice(0, full_groups), row_group_size=self.output.row_group_size)
+        self.pending = [ table.slice(full_groups) ]
+        self.pending_rows = len(table) - full_groups
+
+    def close(self) -> int:
+        match self.output.format:
+            case "arrow":
+                self.writer.finalize()
+                self.writer.close()
+            case "parquet":
+                if self.pending_rows > 0:
+                    self.writer.write_table(pa.concat_tables(self.pending), row_group_size=self.output.row_group_size)
+                self.writer.close()
+            case "jsonl":
+                self.writer.close()
+        return self.num_rows
+
+def write_index(directory: str, features: Features, output: DataRecipeOutputConfig, shards: list[dict], append: bool = False):
+    """Record the shards of an output directory in shards.json, with the rows each one holds,
+    so readers can find a row's shard without opening the others.
+
+    Arrow outputs also get the metadata of Dataset.save_to_disk() so they can be loaded with Dataset.load_from_disk().
+    """
+    if append:
+        with open(path.join(directory, "shards.json"), "rb") as f:
+            shards = json.loads(f.read())["shards"] + shards
+    offset = 0
+    for shard in shards:
+        shard["offset"] = offset
+        offset += shard["num_rows"]
+    with open(path.join(directory, "shards.json"), "w") as f:
+        json.dump({ "format": output.format, "num_rows": offset, "shards": shards }, f, indent=2)
+
+    if output.format == "arrow":
+        with open(path.join(directory, "state.json"), "w") as f:
+            json.dump({
+                "_data_files": [ { "filename": shard["filename"] } for shard in shards ],
+                "_fingerprint": generate_random_fingerprint(),
+                "_format_columns": None,
+                "_format_kwargs": { },
+                "_format_type": None,
+                "_output_all_columns": False,
+                "_split": None
+            }, f, indent=2)
+    if not append:
+        DatasetInfo(features=features).write_to_directory(directory, pretty_print=True)
+
+class ShardWriter:
+    """Incrementally writes tables into shards of at most shard_rows rows and max_shard_size bytes.
+
+    The directory is indexed like the output of write_dataset(), so it can be loaded
+    with load_output() once the writer is closed.
+    With append, the shards are added to the dataset already in the directory.
+    """
+
+    def __init__(self, directory: str, shard_rows: int, features: Optional[Features] = None,
+                 prefix: str = "data", append: bool = False, output: Optional[DataRecipeOutputConfig] = None):
+        self.directory = directory
+        self.shard_rows = shard_rows
+        self.features = features
+        self.prefix = prefix
+        self.append = append
+        self.output = output or DataRecipeOutputConfig()
+        self.max_shard_size = convert_file_size_to_int(self.output.max_shard_size)
+        self.shards: list[str] = [ ]
+        self.shard_infos: list[dict] = [ ]
+        self.num_rows = 0
+        self.writer: ShardFile = None
+        self.shard_num_rows = 0
+        self.shard_num_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, table: pa.Table):
+        if self.features is None:
+            self.features = Features.from_arrow_schema(table.schema)
+        offset = 0
+        while offset < len(table):
+            if self.writer is None:
+                self.open_shard()
+            count = min(len(table) - offset, self.shard_rows - self.shard_num_rows)
+            part = table.slice(offset, count)
+            self.writer.write(part)
+            self.shard_num_rows += count
+            self.shard_num_bytes += part.nbytes
+            self.num_rows += count
+            offset += count
+            if self.shard_num_rows >= self.shard_rows or self.shard_num_bytes >= self.max_shard_size:
+                self.close_shard()
+
+    def open_shard(self):
+        shard_path = path.join(self.directory, f"{self.prefix}-{len(self.shards):05d}.{extensions[self.output.format]}.incomplete")
+        self.writer = ShardFile(shard_path, self.features, self.output)
+        self.shards.append(shard_path)
+        self.shard_num_rows = 0
+        self.shard_num_bytes = 0
+
+    def close_shard(self):
+        if self.writer is None:
+            return
+        self.shard_infos.append({ "num_rows": self.writer.close() })
+        self.writer = None
+        log_trace(f"Wrote {self.shard_num_rows} rows to {self.shards[-1]}")
+
+    def close(self) -> int:
+        """Finish the last shard and write the dataset metadata. Returns the number of rows written."""
+        self.close_shard()
+        if len(self.shards) == 0 and not self.append:
+            # Keep empty outputs loadable
+            if self.features is None:
+                self.features = Features()
+            self.open_shard()
+            self.close_shard()
+
+        for i, shard_path in enumerate(self.shards):
+            filename = f"{self.prefix}-{i:05d}-of-{len(self.shards):05d}.{extensions[self.output.format]}"
+            os.replace(shard_path, path.join(self.directory, filename))
+            self.shard_infos[i]["filename"] = filename
+            self.shard_infos[i]["num_bytes"] = path.getsize(path.join(self.directory, filename))
+        write_index(self.directory, self.features, self.output, self.shard_infos, self.append)
+        return self.num_rows
+
+# Dataset being written by write_dataset(), inherited by forked workers
+shared_dataset: Dataset = None
+
+def write_shard(task: tuple[str, int, int, DataRecipeOutputConfig]) -> dict:
+    """Write one contiguous shard of shared_dataset."""
+    file_path, index, num_shards, output = task
+    shard = shared_dataset.shard(num_shards, index, contiguous=True)
+    writer = ShardFile(file_path, shard.features, output)
+    for table in shard.with_format("arrow").iter(batch_size=output.row_group_size):
+        writer.write(table)
+    return { "filename": path.basename(file_path), "num_rows": writer.close(), "num_bytes": path.getsize(file_path) }
+
+def write_dataset(dataset: Dataset, directory: str, output: Optional[DataRecipeOutputConfig] = None) -> int:
+    """Write a dataset to a directory as contiguous shards of about max_shard_size bytes,
+    several shards at a time. Returns the number of rows written.
+    """
+    global shared_dataset
+    output = output or DataRecipeOutputConfig()
+    os.makedirs(directory, exist_ok=True)
+    num_bytes = dataset.data.nbytes
+    if dataset._indices is not None and len(dataset.data) > 0:
+        num_bytes = num_bytes * len(dataset) // len(dataset.data)
+    num_shards = max(1, min(math.ceil(num_bytes / convert_file_size_to_int(output.max_shard_size)), len(dataset)))
+    extension = extensions[output.format]
+    tasks = [ (path.join(directory, f"data-{i:05d}-of-{num_shards:05d}.{extension}"), i, num_shards, output) for i in range(num_shards) ]
+
+    shared_dataset = dataset
+    try:
+        if num_shards == 1:
+            shards = [ write_shard(tasks[0]) ]
+        else:
+            with get_context("fork").Pool(min(num_proc, num_shards)) as pool:
+                shards = pool.map(write_shard, tasks)
+    finally:
+        shared_dataset = None
+    write_index(directory, dataset.features, output, shards)
+    log_trace(f"Wrote {len(dataset)} rows to {num_shards} {output.format} shards in {directory}")
+    return len(dataset)
+
+def output_directories(directory: str) -> dict[str, str]:
+    """Directories of the splits of a built output, or of the whole output if it has no splits."""
+    dataset_dict_json = path.join(directory, "dataset_dict.json")
+    if not path.isfile(dataset_dict_json):
+        return { "train": directory }
+    with open(dataset_dict_json, "rb") as f:
+        return { split: path.join(directory, split) for split in json.loads(f.read())["splits"] }
+
+def output_files(directory: str) -> list[str]:
+    """Paths of the shards of a built output, in order."""
+    files = [ ]
+    for split_directory in output_directories(directory).values():
+        index_json = path.join(split_directory, "shards.json")
+        if path.isfile(index_json):
+            with open(index_json, "rb") as f:
+                files += [ path.join(split_directory, shard["filename"]) for shard in json.loads(f.read())["shards"] ]
+        else:
+            with open(path.join(split_directory, "state.json"), "rb") as f:
+                files += [ path.join(split_directory, data_file["filename"]) for data_file in json.loads(f.read())["_data_files"] ]
+    return files
+
+def load_shards(files: list[str], format: str, features: Optional[Features] = None) -> Dataset:
+    """Load some of the shards of a built output as a single dataset."""
+    if format == "arrow":
+        return concatenate_datasets([ Dataset.from_file(file) for file in files ])
+    return load_dataset("json" if format == "jsonl" else format, data_files=files, features=features, split="train")
+
+def load_output(directory: str) -> Dataset | DatasetDict:
+    """Load the output of a build, whichever format it was written in."""
+    directories = output_directories(directory)
+    splits = { }
+    for split, split_directory in directories.items():
+        index_json = path.join(split_directory, "shards.json")
+        if not path.isfile(index_json):
+            splits[split] = Dataset.load_from_disk(split_directory)
+            continue
+        with open(index_json, "rb") as f:
+            index = json.loads(f.read())
+        if index["format"] == "arrow":
+            splits[split] = Dataset.load_from_disk(split_directory)
+        else:
+            features = DatasetInfo.from_directory(split_directory).features
+            splits[split] = load_shards([ path.join(split_directory, shard["filename"]) for shard in index["shards"] ],
+                                        index["format"], features)
+    if path.isfile(path.join(directory, "dataset_dict.json")):
+        return DatasetDict(splits)
+    return splits["train"]
@@ -0,0 +1,118 @@
+import os
+import os.path as path
+import json
+import shutil
+import hashlib
+from time import time
+from datasets import Dataset
+from common import *
+
+def fingerprint(*parts) -> str:
+    """Hash any number of JSON-serializable parts into a stable hex digest."""
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()[:32]
+
+def directory_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            size += path.getsize(path.join(root, file))
+    return size
+
+class StageCache:
+    """Content-addressed store for the output of individual build stages.
+
+    Every entry is a dataset saved with save_to_disk() under a directory named
+    after the fingerprint of the stage that produced it. Once the cache grows past
+    max_size bytes, the least recently used entries are evicted. Entries that were
+    used during the current build are never evicted.
+    A max_size of 0 disables the cache entirely.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.used: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        if self.enabled and not path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def entry_directory(self, key: str) -> str:
+        return path.join(self.directory, key)
+
+    def contains(self, key: str) -> bool:
+        return self.enabled and path.isfile(path.join(self.entry_directory(key), "stage.json"))
+
+    def load(self, key: str) -> Dataset | None:
+        if not self.contains(key):
+            self.misses += 1
+            return None
+        directory = self.entry_directory(key)
+        try:
+            dataset = Dataset.load_from_disk(directory)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(path.join(directory, "stage.json"))
+        self.used.add(key)
+        self.hits += 1
+        log_trace(f"Stage cache hit {key}")
+        return dataset
+
+    def store(self, key: str, dataset: Dataset, description: str) -> Dataset:
+        """Save a stage's output and return the memory-mapped copy from the cache."""
+        if not self.enabled:
+            return dataset
+        directory = self.entry_directory(key)
+        temp_directory = f"{directory}.tmp{os.getpid()}"
+        dataset.save_to_disk(temp_directory, num_proc=num_proc if len(dataset) >= num_proc else None)
+        with open(path.join(temp_directory, "stage.json"), "w") as f:
+            json.dump({
+                "description": description,
+                "size": directory_size(temp_directory),
+                "created": time()
+            }, f, indent=4)
+        try:
+            os.rename(temp_directory, directory)
+        except OSError:
+            # Another build stored the same stage first, keep theirs
+            shutil.rmtree(temp_directory, ignore_errors=True)
+        self.used.add(key)
+        log_trace(f"Stored stage {key} ({description})")
+        return Dataset.load_from_disk(directory)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        if not self.enabled:
+            return
+        entries = [ ]
+        total_size = 0
+        for key in os.listdir(self.directory):
+            stage_json = path.join(self.entry_directory(key), "stage.json")
+            if not path.isfile(stage_json):
+                # Leftovers of an interrupted store
+                if ".tmp" in key:
+                    shutil.rmtree(self.entry_directory(key), ignore_errors=True)
+                continue
+            with open(stage_json, "rb") as f:
+                size = json.loads(f.read())["size"]
+            entries.append((path.getmtime(stage_json), key, size))
+            total_size += size
+
+        entries.sort()
+        for _, key, size in entries:
+            if total_size <= self.max_size:
+                break
+            if key in self.used:
+                continue
+            shutil.rmtree(self.entry_directory(key), ignore_errors=True)
+            total_size -= size
+            log_trace(f"Evicted stage {key} ({size} bytes)")
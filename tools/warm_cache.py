@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from datasets import Dataset, DatasetDict
+from typing import Any, Callable, Optional
+from common import *
+
+def memory_size(value: Any) -> int:
+    """Estimate the memory held by a cached object.
+
+    Datasets only count the tables held in memory, memory-mapped ones are paged in and out
+    by the OS. Models count their parameters and buffers. Tokenizers and configs are small
+    next to those and count as nothing.
+    """
+    if isinstance(value, DatasetDict):
+        return sum(memory_size(dataset) for dataset in value.values())
+    if isinstance(value, Dataset):
+        return value.data.nbytes if len(value.cache_files) == 0 else 0
+    if hasattr(value, "parameters") and hasattr(value, "buffers"):
+        return sum(tensor.numel() * tensor.element_size() for tensor in list(value.parameters()) + list(value.buffers()))
+    return 0
+
+class WarmCache:
+    """Keeps objects that are slow to load, like sources, tokenizers and models, in memory
+    so later builds in the same process can reuse them.
+
+    Keys are tuples starting with the kind of object. Once the estimated size of the
+    entries grows past max_size bytes, the least recently used ones are dropped.
+    A max_size of None never drops anything.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, load: Callable[[], Any]) -> Any:
+        """Return the cached object, or load it and cache it."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        value = load()
+        self.entries[key] = (value, memory_size(value))
+        self.evict()
+        return value
+
+    def invalidate(self, predicate: Callable[[tuple], bool]) -> int:
+        """Drop every entry whose key matches predicate. Returns the number of entries dropped."""
+        keys = [ key for key in self.entries.keys() if predicate(key) ]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def evict(self):
+        """Drop the least recently used entries until the cache fits in max_size.
+        The most recent entry is always kept, even if it's larger than max_size on its own.
+        """
+        if self.max_size is None:
+            return
+        while len(self.entries) > 1 and self.size() > self.max_size:
+            key, _ = self.entries.popitem(last=False)
+            log_trace(f"Dropped {key} from the warm cache")
+
+    def size(self) -> int:
+        return sum(size for _, size in self.entries.values())
+
+# Shared by everything loaded in this process
+warm_cache = WarmCache()
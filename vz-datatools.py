@@ -1,9 +1,12 @@
 import sys
 import os
+import json
 import os.path as path
-import importlib
 from argparse import ArgumentParser
 from pathlib import Path
+from time import time
+
+start_time = time()
 
 main_directory = path.dirname(path.realpath(__file__))
 tools_directory = path.join(main_directory, "tools")
@@ -19,7 +22,7 @@ if not path.isdir(recipes_directory):
 if not path.isdir(output_directory):
     os.mkdir(output_directory)
 
-usage = "usage: vz-datatools [-h] {build,list-recipes,list-operations}"
+usage = "usage: vz-datatools [-h] {build,plan,serve,benchmark,list-recipes,list-operations}"
 if len(sys.argv) < 2:
     print(usage)
     exit()
@@ -37,9 +40,9 @@ def list_recipes():
         print(f"\t{recipe_json.name[:-5]}")
 
 def load_operations():
-    paths = Path(path.join(tools_directory, "operations")).glob("*.py")
-    for operation_script in paths:
-        importlib.import_module(f"tools.operations.{operation_script.name[:-3]}")
+    # Operation modules are only imported when a recipe uses them
+    Operation.discover(path.join(tools_directory, "operations"), "tools.operations")
+    log_trace(f"Started in {time() - start_time:.3f} seconds")
 
 match action:
     case "build":
@@ -48,17 +51,160 @@ match action:
             description="Simple framework for mixing together HF datasets"
         )
         build_parser.add_argument("recipe", help="Data recipe to build.")
+        build_parser.add_argument("--cache-size", type=float, default=256,
+                                  help="Size limit of the stage cache in GB, 0 disables it. (Default: 256)")
+        build_parser.add_argument("--inference-cache-size", type=float, default=64,
+                                  help="Size limit of the cache of model outputs in GB, 0 disables it. (Default: 64)")
+        build_parser.add_argument("--workers", type=int, default=1,
+                                  help="Number of independent recipes to build in parallel. (Default: 1)")
+        build_parser.add_argument("--streaming", action="store_true",
+                                  help="Stream sources through the pipeline and write the output in shards as it is produced.")
+        build_parser.add_argument("--shard-rows", type=int, default=100_000,
+                                  help="Number of rows per output shard when streaming. (Default: 100000)")
+        build_parser.add_argument("--profile", action="store_true",
+                                  help="Write the time, rows, bytes and memory of every build stage to profile.json in the built recipe.")
+        build_parser.add_argument("--chrome-trace", action="store_true",
+                                  help="Also write the profile as a Chrome trace to profile.trace.json. Implies --profile.")
+        build_parser.add_argument("--server", action="store_true",
+                                  help="Submit the build to the server started with 'serve' instead of building in this process.")
         args = build_parser.parse_args(sys.argv[2:])
+        if args.server:
+            # Clients don't need the rest of tools, which is slow to import
+            from build_client import *
+            try:
+                response = submit_request(output_directory, {
+                    "action": "build",
+                    "recipe": args.recipe,
+                    "options": { "workers": args.workers, "streaming": args.streaming, "shard_rows": args.shard_rows,
+                                 "profile": args.profile, "chrome_trace": args.chrome_trace }
+                })
+            except ConnectionRefusedError as e:
+                log_failed(e)
+                exit(1)
+            print(response["output"], end="")
+            exit(0 if response["ok"] else 1)
         from tools import *
         load_operations()
-        builder = RecipeBuilder(sources_directory, recipes_directory, output_directory)
+        options = BuildOptions(cache_size=int(args.cache_size * 1024**3), workers=args.workers,
+                               inference_cache_size=int(args.inference_cache_size * 1024**3),
+                               streaming=args.streaming, shard_rows=args.shard_rows,
+                               profile=args.profile, chrome_trace=args.chrome_trace)
+        builder = RecipeBuilder(sources_directory, recipes_directory, output_directory, options)
         try:
             builder.build(args.recipe)
         except FileNotFoundError:
             log_failed(f"Invalid recipe '{args.recipe}'")
             list_recipes()
+        builder.stage_cache.evict()
+        evict_arrow_cache()
         exit()
 
+    case "plan":
+        plan_parser = ArgumentParser(
+            prog="vz-datatools plan",
+            description="Estimate what building a recipe would do without building it"
+        )
+        plan_parser.add_argument("recipe", help="Data recipe to plan.")
+        plan_parser.add_argument("--sample-rows", type=int, default=1000,
+                                 help="Number of rows operations are timed on, 0 skips running them. (Default: 1000)")
+        args = plan_parser.parse_args(sys.argv[2:])
+        from tools import *
+        load_operations()
+        builder = RecipeBuilder(sources_directory, recipes_directory, output_directory)
+        planner = BuildPlanner(builder, args.sample_rows)
+        try:
+            plans = planner.plan(args.recipe)
+        except FileNotFoundError:
+            log_failed(f"Invalid recipe '{args.recipe}'")
+            list_recipes()
+            exit()
+        planner.report(plans)
+        exit()
+
+    case "serve":
+        serve_parser = ArgumentParser(
+            prog="vz-datatools serve",
+            description="Build recipes submitted with 'build --server' in a long-running process that keeps sources and models loaded"
+        )
+        serve_parser.add_argument("recipes", nargs="*",
+                                  help="Recipes rebuilt by --watch. (Default: every recipe that was built before)")
+        serve_parser.add_argument("--watch", action="store_true",
+                                  help="Rebuild recipes as soon as they or anything they use changes.")
+        serve_parser.add_argument("--interval", type=float, default=2.0,
+                                  help="Seconds between checks for changes when watching. (Default: 2)")
+        serve_parser.add_argument("--memory", type=float, default=16,
+                                  help="Memory in GB that loaded sources and models can use before the least recently used are dropped. (Default: 16)")
+        serve_parser.add_argument("--cache-size", type=float, default=256,
+                                  help="Size limit of the stage cache in GB, 0 disables it. (Default: 256)")
+        serve_parser.add_argument("--inference-cache-size", type=float, default=64,
+                                  help="Size limit of the cache of model outputs in GB, 0 disables it. (Default: 64)")
+        serve_parser.add_argument("--status", action="store_true",
+                                  help="Show what the running server holds in memory instead of starting one.")
+        serve_parser.add_argument("--stop", action="store_true",
+                                  help="Stop the running server instead of starting one.")
+        args = serve_parser.parse_args(sys.argv[2:])
+        if args.status or args.stop:
+            from build_client import *
+            try:
+                response = submit_request(output_directory, { "action": "stop" if args.stop else "status" })
+            except ConnectionRefusedError as e:
+                log_failed(e)
+                exit(1)
+            print(response["output"], end="")
+            exit()
+        from tools import *
+        load_operations()
+        server = BuildServer(sources_directory, recipes_directory, output_directory,
+                             BuildOptions(cache_size=int(args.cache_size * 1024**3),
+                                          inference_cache_size=int(args.inference_cache_size * 1024**3)),
+                             memory=int(args.memory * 1024**3),
+                             watch=args.recipes if args.watch else None,
+                             interval=args.interval)
+        server.serve()
+        exit()
+
+    case "benchmark":
+        benchmark_parser = ArgumentParser(
+            prog="vz-datatools benchmark",
+            description="Measure the build pipeline on synthetic data"
+        )
+        benchmark_parser.add_argument("--rows", type=int, default=100_000,
+                                      help="Number of rows of every synthetic source. (Default: 100000)")
+        benchmark_parser.add_argument("--width", type=int, default=8,
+                                      help="Number of extra feature columns of every synthetic source. (Default: 8)")
+        benchmark_parser.add_argument("--files", type=int, default=4,
+                                      help="Number of files every synthetic source is split into. (Default: 4)")
+        benchmark_parser.add_argument("--repeat", type=int, default=3,
+                                      help="Number of runs of each benchmark, the fastest one is reported. (Default: 3)")
+        benchmark_parser.add_argument("--only", action="append", default=[],
+                                      help="Only run this benchmark, can be given several times.")
+        benchmark_parser.add_argument("--baseline", default=path.join(main_directory, "benchmark.json"),
+                                      help="Results to compare against. (Default: benchmark.json)")
+        benchmark_parser.add_argument("--save-baseline", action="store_true",
+                                      help="Save the results as the new baseline.")
+        benchmark_parser.add_argument("--tolerance", type=float, default=0.15,
+                                      help="Largest relative drop in throughput or growth in memory that isn't a regression. (Default: 0.15)")
+        benchmark_parser.add_argument("--workspace",
+                                      help="Directory the synthetic data is generated and built in, kept afterwards. (Default: a temporary directory)")
+        args = benchmark_parser.parse_args(sys.argv[2:])
+        # Benchmarks never reach the network
+        os.environ["HF_HUB_OFFLINE"] = "1"
+        os.environ["HF_DATASETS_OFFLINE"] = "1"
+        from tools import *
+        load_operations()
+        options = BenchmarkOptions(rows=args.rows, width=args.width, files=args.files, repeat=args.repeat, only=args.only)
+        report = run_benchmarks(options, args.workspace)
+        baseline = None
+        if path.isfile(args.baseline):
+            with open(args.baseline, "rb") as f:
+                baseline = json.loads(f.read())
+        regressions = compare_benchmarks(report, baseline, args.tolerance)
+        if args.save_baseline:
+            with open(args.baseline, "w") as f:
+                json.dump(report, f, indent=4)
+            log_info(f"Saved baseline to {args.baseline}")
+        exit(1 if len(regressions) > 0 else 0)
+
     case "list-recipes":
         list_recipes()
         exit()
@@ -67,8 +213,9 @@ match action:
         from tools import *
         load_operations()
         print("Available operations:")
-        for name in Operation.registered_operations.keys():
-            print(f"\t{name}")
+        for name, docstring in Operation.available_operations().items():
+            summary = docstring.strip().split("\n")[0]
+            print(f"\t{name:<24} {summary}")
         exit()
 
 